@@ -1,15 +1,25 @@
 import os
 import sys
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+import base64
+import functools
+import hmac
+import threading
+import time
 import uuid
+import numpy as np
 
 # Add src directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
 
-from feature_extractor import FeatureExtractor
 from similarity_search import SimilaritySearch
+from micro_batcher import MicroBatcher
+from metrics import REGISTRY, REQUEST_SECONDS, REQUESTS, Gauge, SamplingProfiler, stage_timer
+from metadata import parse_filters
+from thumbnails import ThumbnailCache
+from index_jobs import JOBS_SUPPORTED, IndexJobQueue, IndexLock, index_version, list_jobs, load_job, run_index_job
 import config
 
 # Determine if we're serving React build or development mode
@@ -28,6 +38,35 @@ app.config['UPLOAD_FOLDER'] = config.UPLOAD_DIR
 # Initialize components
 feature_extractor = None
 similarity_search = None
+search_batcher = None
+index_jobs = None
+thumbnails = ThumbnailCache() if config.THUMBNAILS else None
+
+# Identifies the index files similarity_search was loaded from (see index_jobs.index_version)
+loaded_index_version = None
+index_swap_lock = threading.Lock()
+
+# Set once the index and model are loaded and the model is warmed up
+models_ready = threading.Event()
+startup_error = None
+
+
+def _index_gauge(read):
+    """Gauge callback reading the loaded index, or nothing before it is loaded"""
+    return lambda: read(similarity_search) if similarity_search and similarity_search.is_indexed else None
+
+
+Gauge('model_ready', '1 once the model is loaded and warmed up').set_function(lambda: int(models_ready.is_set()))
+Gauge('index_images', 'Searchable images in the loaded index').set_function(
+    _index_gauge(lambda searcher: searcher.num_images))
+Gauge('index_deleted_images', 'Tombstoned rows awaiting compaction').set_function(
+    _index_gauge(lambda searcher: len(searcher.image_paths) - searcher.num_images))
+Gauge('index_feature_dim', 'Width of the stored feature vectors').set_function(
+    _index_gauge(lambda searcher: searcher.features.shape[1]))
+Gauge('index_feature_bytes', 'Size of the stored feature matrix').set_function(
+    _index_gauge(lambda searcher: searcher.features.nbytes))
+Gauge('embedding_cache_memory_bytes', 'Memory held by the embedding cache LRU tier').set_function(
+    lambda: feature_extractor.cache.stats()['memory_bytes'] if feature_extractor and feature_extractor.cache else None)
 
 
 def allowed_file(filename):
@@ -36,41 +75,358 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in config.ALLOWED_EXTENSIONS
 
 
-def initialize_models():
-    """Initialize feature extractor and similarity search"""
-    global feature_extractor, similarity_search
+@functools.lru_cache(maxsize=65536)
+def image_url(path):
+    """Convert an indexed image path to a URL served by the /images route (memoized, as results repeat)"""
+    rel_path = os.path.relpath(path, config.DATA_DIR)
+    return f"images/{rel_path.replace(chr(92), '/')}"
+
+
+@functools.lru_cache(maxsize=65536)
+def thumbnail_url(path):
+    """URL of the default-size thumbnail of an indexed image, served by the /thumbnails route"""
+    return f"thumbnails/{thumbnails.sizes[0]}/{image_url(path)[len('images/'):]}"
+
+
+def format_results(results):
+    """Rewrite result paths as image URLs, link thumbnails and flag exact matches"""
+    for result in results:
+        if thumbnails is not None:
+            result['thumbnail'] = thumbnail_url(result['path'])
+        result['path'] = image_url(result['path'])
+        if result['similarity'] > 0.99:
+            result['is_exact_match'] = True
+    return results
+
+
+def image_path_from_url(url):
+    """Inverse of image_url(): map an /images URL (or a plain path) to an indexed path"""
+    url = url.lstrip('/')
+    if url.startswith('images/'):
+        return os.path.join(config.DATA_DIR, *url[len('images/'):].split('/'))
+    return url
+
+
+def save_upload(filename, data):
+    """Save uploaded bytes under a unique name and return the name"""
+    unique_filename = f"{uuid.uuid4()}_{secure_filename(filename)}"
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename), 'wb') as f:
+        f.write(data)
+    return unique_filename
+
+
+def parse_vector(value):
+    """
+    Decode a query vector sent as a JSON list or as base64 little-endian float32
+    
+    Raises:
+        ValueError: If the value is neither
+    """
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value, validate=True), dtype='<f4')
+    if isinstance(value, list):
+        return np.asarray(value, dtype=np.float32)
+    raise ValueError('Vector must be a list of numbers or a base64 string')
+
+
+def read_filters(values, searcher):
+    """
+    Parse the metadata filters of a request (see metadata.parse_filters)
+    
+    Args:
+        values: Query or form parameters, or a JSON object
+        searcher: The SimilaritySearch the request will be answered from
+    
+    Returns:
+        Tuple of (filters or None, error response or None)
+    """
+    if not hasattr(values, 'get'):
+        return None, (jsonify({'error': 'Filters must be an object'}), 400)
+    try:
+        filters = parse_filters(values)
+    except ValueError as e:
+        return None, (jsonify({'error': str(e)}), 400)
+    if filters and searcher.metadata is None:
+        return None, (jsonify({'error': 'Filtering needs the metadata index. Build it with: python src/metadata.py'}), 503)
+    return filters, None
+
+
+def read_search_options(values):
+    """
+    Parse 'top_k' and 'nprobe' from form or query parameters, or a JSON object
+    
+    Returns:
+        Tuple of (top_k, nprobe or None, error response or None)
+    """
+    try:
+        top_k = int(values.get('top_k', config.TOP_K))
+        nprobe = values.get('nprobe')
+        nprobe = int(nprobe) if nprobe not in (None, '') else None
+    except (TypeError, ValueError):
+        return None, None, (jsonify({'error': "'top_k' and 'nprobe' must be integers"}), 400)
+    if top_k < 1 or (nprobe is not None and nprobe < 1):
+        return None, None, (jsonify({'error': "'top_k' and 'nprobe' must be at least 1"}), 400)
+    return top_k, nprobe, None
+
+
+def read_json_object():
+    """
+    Parse a JSON request body that must be an object
+    
+    Returns:
+        Tuple of (dict or None, error response or None)
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return None, (jsonify({'error': 'Expected a JSON object'}), 400)
+    return payload, None
+
+
+def process_search_batch(items):
+    """
+    Answer a batch of queued /api/search requests together
+    
+    Args:
+        items: List of (searcher, image bytes, top_k, nprobe, filters) tuples;
+            each request is answered from the searcher its handler checked,
+            even if the served index was swapped while it was queued
+        
+    Returns:
+        List of result lists, None where features could not be extracted
+    """
+    features = feature_extractor.extract_features_from_bytes_batch([item[1] for item in items])
+    
+    # Requests can only share a scan if they search the same index, probe
+    # the same number of lists and filter the same way
+    groups = {}
+    for i, (searcher, _, _, nprobe, filters) in enumerate(items):
+        if features[i] is not None:
+            key = (searcher, nprobe, tuple(sorted(filters.items())) if filters else None)
+            groups.setdefault(key, []).append(i)
+    
+    results = [None] * len(items)
+    for (searcher, nprobe, _), group in groups.items():
+        queries = np.array([features[i] for i in group])
+        top_k = max(items[i][2] for i in group)
+        filters = items[group[0]][4]
+        group_results = searcher.find_similar_images_batch(queries, top_k, nprobe=nprobe, filters=filters)
+        for i, query_results in zip(group, group_results):
+            results[i] = query_results[:items[i][2]]
+    
+    return results
+
+
+def swap_index(searcher, version):
+    """
+    Serve searches from another SimilaritySearch, e.g. one an indexing job just wrote
+    
+    Rebinding the global is atomic, so searches take no lock: each request
+    reads similarity_search once and keeps using that searcher, whose
+    memory-mapped files stay valid after they are replaced on disk. That
+    holds on POSIX systems only, so jobs are refused on Windows.
+    """
+    global similarity_search, loaded_index_version
+    with index_swap_lock:
+        old = similarity_search
+        similarity_search = searcher
+        loaded_index_version = version
+    
+    if old is not None and old is not searcher and old.shards is not None:
+        # Requests that took the old searcher may still be waiting on its shards
+        threading.Timer(2 * config.SHARD_TIMEOUT_MS / 1000, old.close_shards).start()
+    print(f"Now serving the index with {searcher.num_images} images")
+
+
+def watch_index():
+    """Reload the index whenever an indexing job, in any server process, replaced it"""
+    global loaded_index_version
+    while True:
+        time.sleep(config.INDEX_RELOAD_INTERVAL_SECONDS)
+        version = index_version()
+        if version == loaded_index_version:
+            continue
+        
+        # Waits for a job that is rewriting the files to finish
+        with IndexLock(shared=True):
+            version = index_version()
+            searcher = SimilaritySearch()
+            loaded = searcher.load_index()
+        if loaded:
+            swap_index(searcher, version)
+        else:
+            print("Keeping the current index")
+            loaded_index_version = version
+
+
+def load_models():
+    """Load the index, then the model, and warm the model up with dummy inferences"""
+    global feature_extractor, similarity_search, search_batcher, index_jobs, loaded_index_version, startup_error
+    
+    try:
+        start = time.perf_counter()
+        searcher = SimilaritySearch()
+        
+        # Load index
+        version = index_version()
+        if not searcher.load_index():
+            print("Warning: No index loaded. Build index first using indexer.py")
+        
+        # Searches by id or vector need no model and are served from here on
+        similarity_search = searcher
+        loaded_index_version = version
+        if config.INDEX_RELOAD_INTERVAL_SECONDS:
+            threading.Thread(target=watch_index, name='index-watcher', daemon=True).start()
+        
+        # Imported here rather than at the top: importing TensorFlow alone
+        # takes seconds, and the server should answer health checks meanwhile
+        from feature_extractor import FeatureExtractor
+        extractor = FeatureExtractor()
+        extractor.warm_up()
+        
+        if config.SEARCH_MICRO_BATCHING:
+            search_batcher = MicroBatcher(process_search_batch, name='search-batcher')
+        if config.INDEX_JOBS_API and JOBS_SUPPORTED:
+            # Jobs share the loaded model, and their index replaces the served one when they succeed
+            index_jobs = IndexJobQueue(lambda job: run_index_job(job, extractor),
+                                       on_success=lambda job, searcher: swap_index(searcher, index_version()))
+        feature_extractor = extractor
+        models_ready.set()
+        
+        print(f"Models initialized in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        startup_error = str(e)
+        print(f"Error initializing models: {startup_error}")
+
+
+def initialize_models(background=None):
+    """
+    Initialize feature extractor and similarity search
+    
+    Args:
+        background: Load on a background thread and return at once (default
+            from config). The server is live immediately and reports ready
+            on /api/health/ready once loading and warm-up have finished.
+    """
+    if background is None:
+        background = config.BACKGROUND_WARMUP
     
     print("Initializing models...")
-    feature_extractor = FeatureExtractor()
-    similarity_search = SimilaritySearch()
+    if not background:
+        load_models()
+        return
     
-    # Load index
-    if not similarity_search.load_index():
-        print("Warning: No index loaded. Build index first using indexer.py")
+    threading.Thread(target=load_models, name='model-warmup', daemon=True).start()
+
+
+def startup_state():
+    """'ready', 'loading' or 'failed'"""
+    if models_ready.is_set():
+        return 'ready'
+    return 'failed' if startup_error is not None else 'loading'
+
+
+def model_unavailable():
+    """Error response for requests that need the model while it is not loaded, else None"""
+    if feature_extractor is not None:
+        return None
+    if startup_error is not None:
+        return jsonify({'error': f'Model failed to load: {startup_error}'}), 503
+    return jsonify({'error': 'Model is still loading, try again shortly'}), 503, {'Retry-After': '5'}
+
+
+@app.before_request
+def start_request_metrics():
+    """Time API requests, and start the profiler when ?profile=1 is allowed and asked for"""
+    if not request.path.startswith('/api/'):
+        return
+    g.request_start = time.perf_counter()
+    if config.REQUEST_PROFILING and request.args.get('profile') in ('1', 'true'):
+        # Micro-batched searches decode and run the model on the batcher thread
+        threads = [threading.get_ident()]
+        if search_batcher is not None:
+            threads.append(search_batcher.thread_id)
+        g.profiler = SamplingProfiler(threads).start()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request by endpoint and status, and attach the profile if one was taken"""
+    start = g.pop('request_start', None)
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+    REQUESTS.labels(endpoint, response.status_code).inc()
     
-    print("Models initialized!")
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        report = profiler.stop().report()
+        body = response.get_json(silent=True) if response.is_json else None
+        if isinstance(body, dict):
+            body['profile'] = report
+            response.set_data(app.json.dumps(body))
+    return response
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint: stage timings, counters and gauges of this worker process"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    """Health check endpoint"""
+    """
+    Health check endpoint
+    
+    'status' is liveness: the process is up and answering. 'ready' turns
+    true once the index and model are loaded and the model is warmed up.
+    """
+    searcher = similarity_search
     return jsonify({
         'status': 'ok',
-        'indexed': similarity_search.is_indexed if similarity_search else False,
-        'total_images': len(similarity_search.image_paths) if similarity_search and similarity_search.is_indexed else 0
+        'ready': models_ready.is_set(),
+        'state': startup_state(),
+        'indexed': searcher.is_indexed if searcher else False,
+        'total_images': searcher.num_images if searcher else 0,
+        'model': searcher.model if searcher else None,
+        'shards': len(searcher.shards.shards) if searcher and searcher.shards else 0,
+        'result_cache': searcher.result_cache.stats() if searcher and searcher.result_cache else None
     })
 
 
+@app.route('/api/health/live', methods=['GET'])
+def liveness():
+    """Liveness probe: 200 as long as the process serves requests"""
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/api/health/ready', methods=['GET'])
+def readiness():
+    """Readiness probe: 503 until the worker is warm, so load balancers hold traffic back"""
+    if models_ready.is_set():
+        return jsonify({'ready': True, 'state': 'ready'})
+    response = {'ready': False, 'state': startup_state()}
+    if startup_error is not None:
+        response['error'] = startup_error
+    return jsonify(response), 503
+
+
 @app.route('/api/search', methods=['POST'])
 def search_similar():
     """
     Find similar images based on uploaded image
     
-    Expected: multipart/form-data with 'image' file and optional 'top_k' parameter
+    Expected: multipart/form-data with 'image' file and optional 'top_k' parameter,
+    plus optional metadata filters (see metadata.parse_filters)
     Returns: JSON with similar images
     """
-    if not similarity_search or not similarity_search.is_indexed:
+    searcher = similarity_search
+    if not searcher or not searcher.is_indexed:
         return jsonify({'error': 'Index not loaded. Please build index first.'}), 503
+    unavailable = model_unavailable()
+    if unavailable is not None:
+        return unavailable
     
     # Check if image file is present
     if 'image' not in request.files:
@@ -85,42 +441,130 @@ def search_similar():
         return jsonify({'error': 'Invalid file type'}), 400
     
     try:
-        # Save uploaded file
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
+        # Decoded straight from memory; nothing is written before the search
+        with stage_timer('read'):
+            data = file.read()
         
-        # Extract features
-        query_features = feature_extractor.extract_features(filepath)
+        top_k, nprobe, error = read_search_options(request.form)
+        if error is not None:
+            return error
+        filters, error = read_filters(request.values, searcher)
+        if error is not None:
+            return error
         
-        if query_features is None:
-            return jsonify({'error': 'Failed to extract features from image'}), 500
+        if search_batcher is not None:
+            # Share the forward pass and scan with concurrent requests
+            results = search_batcher((searcher, data, top_k, nprobe, filters))
+            
+            if results is None:
+                return jsonify({'error': 'Failed to extract features from image'}), 500
+        else:
+            # Extract features
+            query_features = feature_extractor.extract_features_from_bytes(data)
+            
+            if query_features is None:
+                return jsonify({'error': 'Failed to extract features from image'}), 500
+            
+            # Find similar images
+            results = searcher.find_similar_images(query_features, top_k, nprobe=nprobe, filters=filters)
         
-        # Get top_k parameter
-        top_k = request.form.get('top_k', config.TOP_K, type=int)
+        response = {'count': len(results)}
+        if config.SAVE_UPLOADS:
+            with stage_timer('save_upload'):
+                response['query_image'] = f"/uploads/{save_upload(file.filename, data)}"
         
-        # Find similar images
-        results = similarity_search.find_similar_images(query_features, top_k)
+        # Convert absolute paths to API-accessible URLs
+        with stage_timer('serialize'):
+            response['results'] = format_results(results)
+            return jsonify(response)
         
-        # Check if exact match exists (similarity > 0.99)
-        exact_match_found = False
-        if results and results[0]['similarity'] > 0.99:
-            exact_match_found = True
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/search/batch', methods=['POST'])
+def search_similar_batch():
+    """
+    Find similar images for many queries in one request
+    
+    Expected: either multipart/form-data with one or more 'images' files, or
+    JSON {"vectors": [[...], ...]} with pre-computed feature vectors.
+    Both accept an optional 'top_k' (and 'nprobe') parameter, and metadata
+    filters: as form fields, or as a JSON 'filters' object.
+    Returns: JSON with one result list per query, in request order
+    """
+    searcher = similarity_search
+    if not searcher or not searcher.is_indexed:
+        return jsonify({'error': 'Index not loaded. Please build index first.'}), 503
+    
+    try:
+        if request.is_json:
+            payload, error = read_json_object()
+            if error is not None:
+                return error
+            vectors = payload.get('vectors')
+            top_k, nprobe, error = read_search_options(payload)
+            if error is not None:
+                return error
+            filters, error = read_filters(payload.get('filters') or {}, searcher)
+            if error is not None:
+                return error
+            
+            if not vectors:
+                return jsonify({'error': 'No vectors provided'}), 400
+            if len(vectors) > config.MAX_BATCH_QUERIES:
+                return jsonify({'error': f'At most {config.MAX_BATCH_QUERIES} queries per batch'}), 400
+            
+            queries = np.asarray(vectors, dtype=np.float32)
+            dims = searcher.query_dims()
+            if queries.ndim != 2 or queries.shape[1] not in dims:
+                expected = ' or '.join(str(dim) for dim in sorted(dims))
+                return jsonify({'error': f'Vectors must have {expected} dimensions'}), 400
+            
+            labels = list(range(len(queries)))
+            failed = []
+        else:
+            files = request.files.getlist('images')
+            top_k, nprobe, error = read_search_options(request.form)
+            if error is not None:
+                return error
+            filters, error = read_filters(request.values, searcher)
+            if error is not None:
+                return error
+            
+            unavailable = model_unavailable()
+            if unavailable is not None:
+                return unavailable
+            if not files:
+                return jsonify({'error': 'No image files provided'}), 400
+            if len(files) > config.MAX_BATCH_QUERIES:
+                return jsonify({'error': f'At most {config.MAX_BATCH_QUERIES} queries per batch'}), 400
+            
+            uploads = []
+            failed = []
+            for file in files:
+                if file.filename == '' or not allowed_file(file.filename):
+                    failed.append(file.filename)
+                    continue
+                uploads.append((file.filename, file.read()))
+            
+            # One batched forward pass for all uploads, decoded in memory
+            features = feature_extractor.extract_features_from_bytes_batch([data for _, data in uploads])
+            labels = [name for (name, _), vector in zip(uploads, features) if vector is not None]
+            failed.extend(name for (name, _), vector in zip(uploads, features) if vector is None)
+            queries = np.array([vector for vector in features if vector is not None])
         
-        # Convert absolute paths to API-accessible URLs
-        for result in results:
-            # Get relative path from data directory for the /images route
-            rel_path = os.path.relpath(result['path'], config.DATA_DIR)
-            result['path'] = f"images/{rel_path.replace(chr(92), '/')}"
-            # Add flag for exact match
-            if result['similarity'] > 0.99:
-                result['is_exact_match'] = True
+        batch_results = []
+        if len(queries):
+            batch_results = searcher.find_similar_images_batch(queries, top_k, nprobe=nprobe, filters=filters)
         
         response = {
-            'query_image': f"/uploads/{unique_filename}",
-            'results': results,
-            'count': len(results)
+            'results': [
+                {'query': label, 'results': format_results(results), 'count': len(results)}
+                for label, results in zip(labels, batch_results)
+            ],
+            'failed': failed,
+            'count': len(batch_results)
         }
         
         return jsonify(response)
@@ -129,24 +573,130 @@ def search_similar():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/search/id', methods=['GET', 'POST'])
+def search_by_id():
+    """
+    Find images similar to one that is already indexed ("more like this")
+    
+    Expected: 'id' (a result id) or 'path' (an indexed path or /images URL),
+    plus optional 'top_k', 'nprobe' and metadata filters, as query or form parameters.
+    The stored feature vector is the query: no upload, disk read or model run.
+    Returns: JSON with similar images, excluding the query image
+    """
+    searcher = similarity_search
+    if not searcher or not searcher.is_indexed:
+        return jsonify({'error': 'Index not loaded. Please build index first.'}), 503
+    
+    try:
+        image_id = request.values.get('id', None, type=int)
+        path = request.values.get('path')
+        top_k, nprobe, error = read_search_options(request.values)
+        if error is not None:
+            return error
+        filters, error = read_filters(request.values, searcher)
+        if error is not None:
+            return error
+        
+        if image_id is None and path is None:
+            return jsonify({'error': "Provide an image 'id' or 'path'"}), 400
+        if image_id is None:
+            image_id = searcher.row_for_path(image_path_from_url(path))
+        if image_id is None or not searcher.is_live(image_id):
+            return jsonify({'error': 'Image not found in index'}), 404
+        
+        results = searcher.find_similar_by_index(image_id, top_k, nprobe=nprobe, filters=filters)
+        format_results(results)
+        
+        return jsonify({
+            'query_id': image_id,
+            'query_image': image_url(searcher.image_paths[image_id]),
+            'results': results,
+            'count': len(results)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/search/vector', methods=['POST'])
+def search_by_vector():
+    """
+    Find similar images for a pre-computed feature vector
+    
+    Expected: either JSON {"vector": [...] or "<base64 float32>", "top_k": 10},
+    or a raw body of little-endian float32 values with Content-Type
+    application/octet-stream and 'top_k'/'nprobe' as query parameters.
+    Metadata filters go in a JSON 'filters' object or in the query string.
+    The vector may have the extractor's or the index's dimension.
+    Returns: JSON with similar images
+    """
+    searcher = similarity_search
+    if not searcher or not searcher.is_indexed:
+        return jsonify({'error': 'Index not loaded. Please build index first.'}), 503
+    
+    try:
+        if request.is_json:
+            payload, error = read_json_object()
+            if error is not None:
+                return error
+            top_k, nprobe, error = read_search_options(payload)
+            if error is not None:
+                return error
+            filters, error = read_filters(payload.get('filters') or {}, searcher)
+            if error is not None:
+                return error
+            if 'vector' not in payload:
+                return jsonify({'error': 'No vector provided'}), 400
+            try:
+                query_features = parse_vector(payload['vector'])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            top_k, nprobe, error = read_search_options(request.args)
+            if error is not None:
+                return error
+            filters, error = read_filters(request.args, searcher)
+            if error is not None:
+                return error
+            data = request.get_data()
+            if len(data) % 4:
+                return jsonify({'error': 'Body must be little-endian float32 values'}), 400
+            query_features = np.frombuffer(data, dtype='<f4')
+        
+        dims = searcher.query_dims()
+        if query_features.ndim != 1 or len(query_features) not in dims:
+            expected = ' or '.join(str(dim) for dim in sorted(dims))
+            return jsonify({'error': f'Vector must have {expected} dimensions'}), 400
+        
+        results = searcher.find_similar_images(query_features, top_k, nprobe=nprobe, filters=filters)
+        format_results(results)
+        
+        return jsonify({'results': results, 'count': len(results)})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/random', methods=['GET'])
 def random_images():
-    """Get random images from index for browsing"""
-    if not similarity_search or not similarity_search.is_indexed:
+    """Get random images from index for browsing, optionally matching metadata filters"""
+    searcher = similarity_search
+    if not searcher or not searcher.is_indexed:
         return jsonify({'error': 'Index not loaded'}), 503
     
     try:
-        import random
         count = request.args.get('count', 20, type=int)
-        count = min(count, len(similarity_search.image_paths))
+        filters, error = read_filters(request.args, searcher)
+        if error is not None:
+            return error
+        rows = searcher.sample_rows(count, filters)
         
-        random_paths = random.sample(similarity_search.image_paths, count)
-        
-        # Convert to API-accessible URLs
-        results = []
-        for path in random_paths:
-            rel_path = os.path.relpath(path, config.DATA_DIR)
-            results.append({'path': f"images/{rel_path.replace(chr(92), '/')}"})
+        # Convert to API-accessible URLs; ids can be passed to /api/search/id
+        results = [{'id': int(row), 'path': searcher.image_paths[row]} for row in rows]
+        for result in results:
+            if thumbnails is not None:
+                result['thumbnail'] = thumbnail_url(result['path'])
+            result['path'] = image_url(result['path'])
         
         return jsonify({'results': results, 'count': len(results)})
         
@@ -154,10 +704,191 @@ def random_images():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/filters', methods=['GET'])
+def filter_facets():
+    """
+    Values the search endpoints can filter on
+    
+    Returns: JSON with the most common folders and extensions (with image
+    counts) and the range of mtime, size, width and height
+    """
+    searcher = similarity_search
+    if not searcher or not searcher.is_indexed:
+        return jsonify({'error': 'Index not loaded'}), 503
+    if searcher.metadata is None:
+        return jsonify({'error': 'Filtering needs the metadata index. Build it with: python src/metadata.py'}), 503
+    
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify(searcher.metadata.facets(searcher.deleted, limit))
+
+
+def data_path(value):
+    """
+    Resolve a path sent by a client (relative to DATA_DIR, absolute, or an
+    /images URL) to a path under DATA_DIR
+    
+    Returns:
+        The path, or None if it points outside DATA_DIR
+    """
+    if not isinstance(value, str):
+        return None
+    if value.lstrip('/').startswith('images/'):
+        value = image_path_from_url(value)
+    path = os.path.normpath(os.path.join(config.DATA_DIR, value))
+    root = os.path.realpath(config.DATA_DIR)
+    real = os.path.realpath(path)
+    if real != root and not real.startswith(root + os.sep):
+        return None
+    return path
+
+
+def index_jobs_denied():
+    """Error response when indexing jobs are disabled or the request lacks the configured token, else None"""
+    if not config.INDEX_JOBS_API:
+        return jsonify({'error': 'Indexing jobs are disabled'}), 404
+    if config.INDEX_JOBS_TOKEN:
+        expected = f"Bearer {config.INDEX_JOBS_TOKEN}".encode()
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected):
+            return jsonify({'error': 'Indexing jobs need the configured token'}), 401, {'WWW-Authenticate': 'Bearer'}
+    return None
+
+
+def index_jobs_unavailable():
+    """Error response when indexing jobs are denied or the model is not loaded yet, else None"""
+    denied = index_jobs_denied()
+    if denied is not None:
+        return denied
+    if not JOBS_SUPPORTED:
+        return jsonify({'error': "Indexing jobs are not supported on Windows, which cannot replace the index "
+                                 "files while the server has them open. Stop the server and run "
+                                 "'python src/indexer.py --sync' instead."}), 501
+    return model_unavailable()
+
+
+@app.route('/api/index/jobs', methods=['POST'])
+def submit_index_job():
+    """
+    Queue an indexing job; it runs in the background of the server
+    
+    Expected: JSON with either 'paths', a list of image files to add, or an
+    optional 'directory' to sync (default: the whole data directory). Paths
+    and directories are relative to the data directory (or /images URLs) and
+    must lie inside it. '"rebuild": true' rebuilds the index from the whole
+    data directory instead. Optional 'priority': higher runs first.
+    Returns: 202 with the job; poll /api/index/jobs/<id> for its progress
+    """
+    unavailable = index_jobs_unavailable()
+    if unavailable is not None:
+        return unavailable
+    
+    payload, error = read_json_object() if request.get_data() else ({}, None)
+    if error is not None:
+        return error
+    try:
+        priority = int(payload.get('priority', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': "'priority' must be an integer"}), 400
+    
+    if payload.get('paths') is not None:
+        paths = payload['paths']
+        if not isinstance(paths, list) or not paths:
+            return jsonify({'error': "'paths' must be a non-empty list"}), 400
+        resolved = [data_path(path) for path in paths]
+        invalid = [path for path, found in zip(paths, resolved)
+                   if found is None or not os.path.isfile(found) or not allowed_file(found)]
+        if invalid:
+            return jsonify({'error': 'Not image files in the data directory', 'paths': invalid[:20]}), 400
+        job = index_jobs.submit('add', paths=resolved, priority=priority)
+    elif payload.get('rebuild'):
+        if payload.get('directory'):
+            return jsonify({'error': 'A rebuild always indexes the whole data directory'}), 400
+        job = index_jobs.submit('build', directory=config.DATA_DIR, priority=priority)
+    else:
+        directory = data_path(payload.get('directory') or '')
+        if directory is None or not os.path.isdir(directory):
+            return jsonify({'error': 'Not a directory in the data directory'}), 400
+        job = index_jobs.submit('sync', directory=directory, priority=priority)
+    
+    return jsonify(job.to_dict()), 202, {'Location': f"/api/index/jobs/{job.id}"}
+
+
+@app.route('/api/index/jobs', methods=['GET'])
+def list_index_jobs():
+    """Recent indexing jobs of all server processes, newest first"""
+    denied = index_jobs_denied()
+    if denied is not None:
+        return denied
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify({'jobs': list_jobs(limit)})
+
+
+@app.route('/api/index/jobs/<job_id>', methods=['GET'])
+def index_job_status(job_id):
+    """State and progress ('processed' of 'total' images) of an indexing job"""
+    denied = index_jobs_denied()
+    if denied is not None:
+        return denied
+    job = index_jobs.get(job_id) if index_jobs is not None else load_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+
+@app.route('/api/index/jobs/<job_id>', methods=['DELETE'])
+def cancel_index_job(job_id):
+    """
+    Cancel an indexing job
+    
+    A queued job is dropped. A running one stops after its current batch
+    and leaves the index as it was, unless it is already writing the index.
+    """
+    unavailable = index_jobs_unavailable()
+    if unavailable is not None:
+        return unavailable
+    job = index_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 202
+
+
 @app.route('/images/<path:filename>')
 def serve_image(filename):
-    """Serve images from data directory"""
-    return send_from_directory(config.DATA_DIR, filename)
+    """Serve images from data directory, with ETag and Last-Modified for conditional requests"""
+    return send_from_directory(config.DATA_DIR, filename, max_age=config.IMAGE_CACHE_MAX_AGE)
+
+
+@app.route('/thumbnails/<int:size>/<path:filename>')
+def serve_thumbnail(size, filename):
+    """
+    Serve a thumbnail of an image in the data directory, its longest side size pixels
+    
+    Thumbnails are written while indexing, or here on first request. The
+    ETag is the content hash of the original, so a revalidating client gets
+    a 304 without the thumbnail being read or made. While THUMBNAIL_WORKERS
+    thumbnails are already being generated, the original is served instead.
+    """
+    if thumbnails is None or size not in thumbnails.sizes:
+        return jsonify({'error': 'Thumbnail size not available'}), 404
+    img_path = data_path(filename)
+    if img_path is None or not os.path.isfile(img_path):
+        return jsonify({'error': 'Image not found'}), 404
+    
+    try:
+        etag = f"{thumbnails.digest_for(img_path)}-{size}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = config.IMAGE_CACHE_MAX_AGE
+            return response
+        
+        path, _ = thumbnails.lookup(img_path, size)
+        if path is None:
+            return serve_image(filename)
+        return send_file(path, mimetype=thumbnails.mimetype, etag=etag, conditional=True,
+                         max_age=config.IMAGE_CACHE_MAX_AGE)
+    except OSError:
+        return jsonify({'error': 'Image not found'}), 404
 
 
 @app.route('/uploads/<path:filename>')
@@ -187,7 +918,10 @@ if __name__ == '__main__':
     print("Image Similarity Search Server")
     print("="*50)
     print(f"Server running at: http://localhost:5000")
-    print(f"Indexed images: {len(similarity_search.image_paths) if similarity_search and similarity_search.is_indexed else 0}")
+    if models_ready.is_set():
+        print(f"Indexed images: {similarity_search.num_images if similarity_search else 0}")
+    else:
+        print("Loading index and model in the background (see /api/health/ready)")
     print("="*50 + "\n")
     
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,94 @@
+"""
+Benchmark the registered embedding backbones on your own images:
+extraction throughput and retrieval quality.
+
+Usage:
+    python benchmarks/bench_backbones.py
+    python benchmarks/bench_backbones.py --images data --limit 2000 --backbones ResNet50 MobileNetV3Small
+
+For each backbone this reports:
+    img/s      batched extraction throughput, decoding included
+    1 img ms   median latency of extracting one image
+    dim        embedding width (index memory and search work scale with it)
+    P@k        share of each image's top-k neighbours that sit in the same
+               folder, when the images are sorted into two or more folders
+    R@k        share of the reference backbone's (the first one's) top-k
+               neighbours that this backbone also returns
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import config
+from backbones import BACKBONES
+from exact_search import ExactSearch
+from fingerprints import scan_image_files
+
+
+def neighbours(features, top_k):
+    """Top-k neighbour ids of every row, excluding the row itself"""
+    ids, _ = ExactSearch(features).search_batch(features, top_k + 1)
+    is_self = ids == np.arange(len(ids))[:, None]
+    order = np.argsort(is_self, axis=1, kind='stable')[:, :top_k]
+    return np.take_along_axis(ids, order, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', default=config.DATA_DIR)
+    parser.add_argument('--limit', type=int, default=2000, help='Images sampled from the directory')
+    parser.add_argument('--backbones', nargs='+', default=[backbone.name for backbone in BACKBONES.values()])
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--single', type=int, default=10, help='Images timed one at a time')
+    args = parser.parse_args()
+
+    from feature_extractor import FeatureExtractor
+
+    image_paths = sorted(scan_image_files(args.images))
+    if len(image_paths) > args.limit:
+        rng = np.random.default_rng(0)
+        image_paths = sorted(rng.choice(image_paths, args.limit, replace=False).tolist())
+    if len(image_paths) <= args.top_k:
+        print(f"Need more than {args.top_k} images in {args.images}")
+        return
+    print(f"Benchmarking on {len(image_paths)} images from {args.images}")
+
+    print(f"{'backbone':>18} {'img/s':>8} {'1 img ms':>9} {'dim':>6} "
+          f"{f'P@{args.top_k}':>7} {f'R@{args.top_k}':>7}")
+    reference = None
+    for name in args.backbones:
+        extractor = FeatureExtractor(use_cache=False, backbone=name)
+        extractor.warm_up()
+
+        start = time.perf_counter()
+        features, paths = extractor.extract_features_batch(image_paths, return_paths=True, verbose=False)
+        throughput = len(paths) / (time.perf_counter() - start)
+
+        latencies = []
+        for path in paths[:args.single]:
+            start = time.perf_counter()
+            extractor.extract_features(path)
+            latencies.append(time.perf_counter() - start)
+
+        top = neighbours(features, args.top_k)
+        labels = np.array([os.path.dirname(path) for path in paths])
+        precision = float(np.mean(labels[top] == labels[:, None])) if len(set(labels)) > 1 else float('nan')
+
+        if reference is None:
+            reference = (paths, top)
+        if paths == reference[0]:
+            recall = float(np.mean([len(np.intersect1d(a, b)) / args.top_k for a, b in zip(top, reference[1])]))
+        else:
+            # A backbone failed on different images, so the rows do not line up
+            recall = float('nan')
+
+        print(f"{name:>18} {throughput:>8.1f} {float(np.median(latencies)) * 1000:>9.1f} "
+              f"{features.shape[1]:>6} {precision:>7.3f} {recall:>7.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark exact top-K search: the original sklearn cosine_similarity +
+full argsort path against ExactSearch (BLAS dot product + argpartition).
+
+Usage:
+    python benchmarks/bench_exact_search.py
+    python benchmarks/bench_exact_search.py --sizes 10000 100000 --dim 512
+
+A 1M x 2048 float32 matrix needs 8 GB of RAM; lower --dim on smaller machines.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from exact_search import ExactSearch
+from synthetic import random_unit_vectors
+
+
+def baseline_search(features, query, top_k):
+    """The search path SimilaritySearch used before ExactSearch"""
+    from sklearn.metrics.pairwise import cosine_similarity
+    similarities = cosine_similarity(query.reshape(1, -1), features)[0]
+    top_indices = np.argsort(similarities)[::-1][:top_k]
+    return top_indices, similarities[top_indices]
+
+
+def time_queries(search, queries, top_k):
+    """Return the median latency in milliseconds over all queries"""
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query, top_k)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=2048)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--skip-baseline', action='store_true',
+                        help="Only time ExactSearch (the baseline copies the whole matrix)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    queries = random_unit_vectors(args.queries, args.dim, rng)
+
+    print(f"{'vectors':>10} {'baseline ms':>12} {'exact ms':>10} {'speedup':>8}")
+    for size in args.sizes:
+        features = random_unit_vectors(size, args.dim, rng)
+        engine = ExactSearch(features)
+
+        exact_ms = time_queries(engine.search, queries, args.top_k)
+        if args.skip_baseline:
+            print(f"{size:>10} {'-':>12} {exact_ms:>10.2f} {'-':>8}")
+        else:
+            # Both paths must agree before their timings mean anything
+            expected, _ = baseline_search(features, queries[0], args.top_k)
+            actual, _ = engine.search(queries[0], args.top_k)
+            assert np.array_equal(expected, actual), "ExactSearch results differ from baseline"
+
+            baseline_ms = time_queries(lambda q, k: baseline_search(features, q, k), queries, args.top_k)
+            print(f"{size:>10} {baseline_ms:>12.2f} {exact_ms:>10.2f} {baseline_ms / exact_ms:>7.1f}x")
+
+        del features, engine
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark the embedding model's inference paths: Keras predict (the old
+path) against a direct model call and a traced tf.function, at each
+weight precision, for single images and for batches.
+
+Usage:
+    python benchmarks/bench_inference.py
+    python benchmarks/bench_inference.py --modes predict function --precisions float32 bfloat16
+    python benchmarks/bench_inference.py --intra-op-threads 4 --inter-op-threads 1
+
+Reported latencies are medians of the model call alone (preprocessing and
+normalization included, image decoding excluded). 'cosine' is the mean
+similarity of each configuration's embeddings to the first one's
+(float32 predict by default).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import config
+
+
+def time_calls(fn, batch, repeats):
+    """Return the median latency of fn(batch) in milliseconds, after one untimed call"""
+    fn(batch)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(batch)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['predict', 'call', 'function'])
+    parser.add_argument('--precisions', nargs='+', default=['float32', 'float16', 'bfloat16', 'int8'])
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--intra-op-threads', type=int, default=None)
+    parser.add_argument('--inter-op-threads', type=int, default=None)
+    args = parser.parse_args()
+
+    # Thread pools must be sized before TensorFlow starts its runtime
+    config.TF_INTRA_OP_THREADS = args.intra_op_threads or config.TF_INTRA_OP_THREADS
+    config.TF_INTER_OP_THREADS = args.inter_op_threads or config.TF_INTER_OP_THREADS
+    from feature_extractor import FeatureExtractor
+    from backbones import get_backbone
+
+    rng = np.random.default_rng(0)
+    images = rng.uniform(0, 255, (args.batch_size, *get_backbone().image_size(), 3)).astype(np.float32)
+    # _embed preprocesses its input in place, so every call gets a fresh copy
+    single = lambda extractor: lambda batch: extractor._embed(batch[:1].copy())
+    batched = lambda extractor: lambda batch: extractor._embed(batch.copy())
+
+    print(f"{'mode':>9} {'precision':>10} {'1 image (ms)':>13} "
+          f"{f'batch of {args.batch_size} (ms/image)':>24} {'cosine':>8}")
+    reference = None
+    for precision in args.precisions:
+        for mode in args.modes:
+            extractor = FeatureExtractor(use_cache=False, inference_mode=mode, precision=precision)
+            features = extractor._embed(images.copy())
+            if reference is None:
+                reference = features
+            cosine = float(np.mean(np.sum(features * reference, axis=1)))
+
+            one = time_calls(single(extractor), images, args.repeats)
+            many = time_calls(batched(extractor), images, max(1, args.repeats // 4)) / args.batch_size
+            print(f"{mode:>9} {precision:>10} {one:>13.1f} {many:>24.1f} {cosine:>8.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark server cold starts: the old blocking startup (TensorFlow imported
+with the app, model built before the first request, no warm-up) against
+lazy imports with background loading and a warm-up inference.
+
+Each run starts a fresh interpreter and reports:
+    live    seconds until the server can answer /api/health/live
+    ready   seconds until the model is loaded (and warmed up)
+    first   milliseconds for the first image search's feature extraction
+    second  milliseconds for the next one
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeats 5
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('blocking', 'background')
+
+
+def random_image_bytes(rng):
+    """A PNG of random noise, different every call so no cache can answer it"""
+    from PIL import Image
+    pixels = rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def run_child(mode):
+    """Start the app in this fresh interpreter and print the timings as JSON"""
+    start = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+    import config
+    config.EMBEDDING_CACHE = False
+
+    if mode == 'blocking':
+        # What app.py did before: TensorFlow imported along with the app
+        # and the model built, without a warm-up, before serving anything
+        import feature_extractor  # noqa: F401
+        config.WARMUP_BATCH_SIZES = ()
+    import app
+
+    app.initialize_models(background=(mode == 'background'))
+    client = app.app.test_client()
+    assert client.get('/api/health/live').status_code == 200
+    live = time.perf_counter() - start
+
+    app.models_ready.wait()
+    ready = time.perf_counter() - start
+
+    rng = np.random.default_rng()
+    latencies = []
+    for _ in range(2):
+        data = random_image_bytes(rng)
+        request_start = time.perf_counter()
+        app.feature_extractor.extract_features_from_bytes(data)
+        latencies.append((time.perf_counter() - request_start) * 1000)
+
+    print(json.dumps({'live': live, 'ready': ready, 'first': latencies[0], 'second': latencies[1]}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return
+
+    print(f"{'startup':>10} {'live (s)':>10} {'ready (s)':>10} {'first (ms)':>11} {'second (ms)':>12}")
+    for mode in MODES:
+        runs = []
+        for _ in range(args.repeats):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode],
+                                    capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        median = {key: float(np.median([run[key] for run in runs])) for key in runs[0]}
+        print(f"{mode:>10} {median['live']:>10.2f} {median['ready']:>10.2f} "
+              f"{median['first']:>11.1f} {median['second']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
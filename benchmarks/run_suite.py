@@ -0,0 +1,437 @@
+"""
+Reproducible benchmark and load-test suite for indexing and search.
+
+Scenarios, each run in a fresh process so that its peak RSS is its own:
+    search     per-query and batched latency of SimilaritySearch on synthetic
+               feature matrices (exact, and IVF once ANN_MIN_IMAGES is reached)
+    indexing   ImageIndexer.build_index throughput on a synthetic image corpus
+    load       end-to-end /api/search latency (p50/p95/p99) and throughput
+               under concurrent clients against a local server
+
+Usage:
+    python benchmarks/run_suite.py
+    python benchmarks/run_suite.py --scenarios search --sizes 10000 100000 1000000
+    python benchmarks/run_suite.py --scenarios load --clients 1 8 32 --url http://localhost:5000
+    python benchmarks/run_suite.py --compare benchmarks/results/<older run>.json
+
+Everything runs against a scratch directory (--workdir, default: a new
+temporary one) with its own models directory, so the real index is never
+touched. The current config.py settings apply, so a run measures the
+configured backbone, ANN, quantization and sharding setup. Results are
+written as JSON together with the settings, environment and git commit;
+--compare prints how each metric moved against an earlier run.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+import config
+from synthetic import clustered_unit_vectors, make_image_corpus, use_models_dir
+
+
+SCENARIOS = ('search', 'indexing', 'load')
+RESULT_MARKER = 'BENCHMARK_RESULT '
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+# Settings that change what a run measures, recorded with every result
+RECORDED_SETTINGS = ('MODEL_NAME', 'IMAGE_SIZE', 'INFERENCE_MODE', 'INFERENCE_PRECISION', 'BATCH_SIZE',
+                     'ANN_INDEX_TYPE', 'ANN_MIN_IMAGES', 'IVF_NPROBE', 'QUANTIZATION', 'PCA_DIM',
+                     'INDEX_SHARDS', 'SEARCH_MICRO_BATCHING', 'SEARCH_MAX_BATCH_SIZE')
+
+
+def peak_rss_mb(pid=None):
+    """Peak resident set size of this process (or of pid, on Linux) in MB; None where unsupported"""
+    if pid is not None:
+        try:
+            with open(f'/proc/{pid}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def latency_stats(seconds):
+    """Percentiles and mean of a list of latencies, in milliseconds"""
+    ms = np.asarray(seconds) * 1000
+    return {
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'mean_ms': float(ms.mean()),
+    }
+
+
+def bench_search(args):
+    """Single-query latency and batched throughput on synthetic feature matrices"""
+    from similarity_search import SimilaritySearch
+    use_models_dir(os.path.join(args.workdir, 'search_models'))
+    rng = np.random.default_rng(0)
+
+    results = {}
+    for size in args.sizes:
+        print(f"Search benchmark: {size} x {args.dim}")
+        features = clustered_unit_vectors(size, args.dim, rng)
+        searcher = SimilaritySearch()
+        start = time.perf_counter()
+        searcher.save_index(features, [f"synthetic/{i:08d}.jpg" for i in range(size)])
+        searcher.build_ann_index()
+        if config.QUANTIZATION:
+            searcher.build_quantized_index()
+        entry = {'vectors': size, 'dim': args.dim, 'index_build_s': time.perf_counter() - start}
+        del features
+
+        # Queries near stored vectors, as real queries are near real images
+        queries = np.asarray(searcher.features[rng.integers(0, size, args.queries)])
+        queries += 0.1 / np.sqrt(args.dim) * rng.standard_normal(queries.shape, dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+        modes = {'exact': True}
+        if searcher.ann_index is not None or searcher.shards is not None or searcher.quantizer is not None:
+            modes['configured'] = False
+        for mode, exact in modes.items():
+            searcher.search(queries[0], args.top_k, exact=exact)
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                searcher.search(query, args.top_k, exact=exact)
+                latencies.append(time.perf_counter() - start)
+            entry[mode] = {'single': latency_stats(latencies)}
+
+            for batch_size in args.batch_sizes:
+                batch = queries[:batch_size]
+                searcher.search_batch(batch, args.top_k, exact=exact)
+                timings = []
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    searcher.search_batch(batch, args.top_k, exact=exact)
+                    timings.append(time.perf_counter() - start)
+                elapsed = float(np.median(timings))
+                entry[mode][f'batch_{len(batch)}'] = {
+                    'ms_per_query': elapsed * 1000 / len(batch),
+                    'queries_per_sec': len(batch) / elapsed,
+                }
+
+        searcher.close_shards()
+        results[f'{size}x{args.dim}'] = entry
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def corpus_dir(args):
+    return os.path.join(args.workdir, 'corpus')
+
+
+def bench_indexing(args):
+    """Images per second of a full ImageIndexer.build_index on a synthetic corpus"""
+    use_models_dir(os.path.join(args.workdir, 'models'))
+    # Every image is extracted: a warm embedding cache would skip the model
+    config.EMBEDDING_CACHE = False
+
+    print(f"Indexing benchmark: generating {args.images} images")
+    start = time.perf_counter()
+    make_image_corpus(corpus_dir(args), args.images, (args.image_size, args.image_size))
+    corpus_s = time.perf_counter() - start
+
+    from indexer import ImageIndexer
+    start = time.perf_counter()
+    indexer = ImageIndexer()
+    model_load_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if not indexer.build_index(corpus_dir(args), resume=False):
+        raise RuntimeError("Index build failed")
+    build_s = time.perf_counter() - start
+
+    return {
+        'images': indexer.similarity_search.num_images,
+        'image_size': args.image_size,
+        'model': indexer.feature_extractor.model_id,
+        'corpus_generation_s': corpus_s,
+        'model_load_s': model_load_s,
+        'build_s': build_s,
+        'images_per_sec': indexer.similarity_search.num_images / build_s,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def serve(args):
+    """Run the app on the scratch index (used by the load scenario)"""
+    use_models_dir(os.path.join(args.workdir, 'models'))
+    # Uploads repeat during a load test; measure the model and the search, not cache hits
+    config.EMBEDDING_CACHE = False
+    config.RESULT_CACHE = False
+    from app import app, initialize_models
+    initialize_models()
+    app.run(host='127.0.0.1', port=args.port, threaded=True)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args):
+    """Start a local server on the scratch index and wait until it reports ready"""
+    import requests
+
+    port = _free_port()
+    log = open(os.path.join(args.workdir, 'server.log'), 'w')
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port),
+                               '--workdir', args.workdir], stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + args.server_timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited during startup, see {log.name}")
+        try:
+            if requests.get(url + '/api/health/ready', timeout=1).status_code == 200:
+                return server, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"Server not ready after {args.server_timeout}s, see {log.name}")
+
+
+def run_clients(url, blobs, clients, requests_per_client, top_k):
+    """Send uploads from concurrent clients; return latencies, error count and wall time"""
+    import requests
+
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def client(client_id):
+        nonlocal errors
+        session = requests.Session()
+        for i in range(requests_per_client):
+            data = blobs[(client_id * requests_per_client + i) % len(blobs)]
+            start = time.perf_counter()
+            try:
+                response = session.post(url + '/api/search', files={'image': ('query.jpg', data, 'image/jpeg')},
+                                        data={'top_k': top_k}, timeout=120)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def bench_load(args):
+    """End-to-end /api/search latency percentiles under increasing concurrency"""
+    use_models_dir(os.path.join(args.workdir, 'models'))
+    server = None
+    if args.url:
+        url = args.url.rstrip('/')
+        paths = make_image_corpus(corpus_dir(args), args.images, (args.image_size, args.image_size))
+    else:
+        if not os.path.exists(config.FEATURE_STORE_FILE):
+            bench_indexing(args)
+        paths = make_image_corpus(corpus_dir(args), args.images, (args.image_size, args.image_size))
+        print("Load test: starting a local server")
+        server, url = start_server(args)
+
+    try:
+        blobs = []
+        for path in paths[:256]:
+            with open(path, 'rb') as f:
+                blobs.append(f.read())
+        run_clients(url, blobs, 1, 2, args.top_k)
+
+        results = {'url': url}
+        for clients in args.clients:
+            print(f"Load test: {clients} concurrent clients")
+            latencies, errors, wall_s = run_clients(url, blobs, clients, args.requests, args.top_k)
+            entry = {'clients': clients, 'requests': clients * args.requests, 'errors': errors,
+                     'requests_per_sec': len(latencies) / wall_s}
+            if latencies:
+                entry.update(latency_stats(latencies))
+            results[f'clients_{clients}'] = entry
+        if server is not None:
+            results['server_peak_rss_mb'] = peak_rss_mb(server.pid)
+        return results
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+BENCHMARKS = {'search': bench_search, 'indexing': bench_indexing, 'load': bench_load}
+
+
+def run_scenario(scenario, args):
+    """Run one scenario in a fresh interpreter and return its results"""
+    command = [sys.executable, os.path.abspath(__file__), '--child', scenario] + args.forwarded
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    result = None
+    for line in process.stdout:
+        if line.startswith(RESULT_MARKER):
+            result = json.loads(line[len(RESULT_MARKER):])
+        elif args.verbose:
+            print(f"  {line}", end='')
+    if process.wait() != 0 or result is None:
+        raise RuntimeError(f"Scenario '{scenario}' failed (rerun with --verbose for its output)")
+    return result
+
+
+def environment():
+    """Versions and hardware a run was measured on"""
+    from importlib import metadata
+
+    packages = {}
+    for package in ('numpy', 'tensorflow', 'tensorflow-cpu', 'keras', 'Flask'):
+        try:
+            packages[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            pass
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'git_commit': commit,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'packages': packages,
+    }
+
+
+def flatten(results, prefix=''):
+    """Yield (dotted key, value) for every numeric leaf of a results tree"""
+    for key, value in results.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            yield from flatten(value, name + '.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare(baseline, current, tolerance):
+    """Print every timing, throughput and memory metric of current against baseline"""
+    old = dict(flatten(baseline['results']))
+    print(f"\nCompared with {baseline['environment'].get('git_commit')} ({baseline['timestamp']}):")
+    regressions = 0
+    for key, value in flatten(current['results']):
+        if key not in old or not old[key] or not key.endswith(('_ms', '_s', '_mb', 'per_query', 'per_sec')):
+            continue
+        ratio = value / old[key]
+        higher_is_better = key.endswith('per_sec')
+        worse = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+        better = ratio > 1 + tolerance if higher_is_better else ratio < 1 - tolerance
+        marker = 'REGRESSION' if worse else 'improved' if better else ''
+        regressions += worse
+        print(f"  {key:<55} {old[key]:>12.2f} -> {value:>12.2f}  {ratio:>6.2f}x  {marker}")
+    print(f"{regressions} regressions beyond {tolerance:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--workdir', help='Scratch directory, reused between runs (default: a new temp dir)')
+    parser.add_argument('--output', help='Results file (default: benchmarks/results/<time>-<commit>.json)')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative change reported as a regression')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of each scenario')
+    search = parser.add_argument_group('search')
+    search.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    search.add_argument('--dim', type=int, default=2048)
+    search.add_argument('--queries', type=int, default=200)
+    search.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 256])
+    search.add_argument('--top-k', type=int, default=10)
+    search.add_argument('--repeats', type=int, default=5, help='Timed calls per batch size (median kept)')
+    images = parser.add_argument_group('indexing and load')
+    images.add_argument('--images', type=int, default=500, help='Synthetic images to generate and index')
+    images.add_argument('--image-size', type=int, default=256)
+    images.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    images.add_argument('--requests', type=int, default=25, help='Requests per client')
+    images.add_argument('--url', help='Load-test this running server instead of starting one')
+    images.add_argument('--server-timeout', type=int, default=600)
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    if args.child:
+        result = BENCHMARKS[args.child](args)
+        print(RESULT_MARKER + json.dumps(result))
+        return
+
+    if args.workdir is None:
+        args.workdir = tempfile.mkdtemp(prefix='iss-bench-')
+    os.makedirs(args.workdir, exist_ok=True)
+    # Children get the same settings; only the scenario differs
+    args.forwarded = [arg for arg in sys.argv[1:] if arg != '--verbose']
+    if '--workdir' not in args.forwarded:
+        args.forwarded += ['--workdir', args.workdir]
+    print(f"Scratch directory: {args.workdir}")
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'settings': {
+            'arguments': {key: value for key, value in vars(args).items()
+                          if key not in ('forwarded', 'child', 'serve', 'port', 'compare', 'output')},
+            'config': {name: getattr(config, name) for name in RECORDED_SETTINGS},
+        },
+        'results': {},
+    }
+    for scenario in args.scenarios:
+        print(f"Running {scenario} benchmark...")
+        start = time.perf_counter()
+        report['results'][scenario] = run_scenario(scenario, args)
+        print(f"  done in {time.perf_counter() - start:.1f}s")
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{report['environment']['git_commit'] or 'nogit'}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(json.load(f), report, args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
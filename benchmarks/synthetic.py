@@ -0,0 +1,96 @@
+"""
+Synthetic data for the benchmarks: feature matrices, image corpora, and an
+isolated models directory so benchmark runs never touch the real index.
+"""
+import os
+import sys
+
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+def random_unit_vectors(n, dim, rng, chunk_size=65536):
+    """Generate L2-normalized float32 vectors without a float64 temporary"""
+    vectors = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, chunk_size):
+        chunk = rng.standard_normal((min(chunk_size, n - start), dim), dtype=np.float32)
+        chunk /= np.linalg.norm(chunk, axis=1, keepdims=True)
+        vectors[start:start + len(chunk)] = chunk
+    return vectors
+
+
+def clustered_unit_vectors(n, dim, rng, clusters=None, spread=0.5):
+    """
+    Unit vectors drawn around random cluster centres
+
+    Real embeddings are clustered rather than uniform on the sphere, which
+    is what makes ANN indexes effective; uniform data would understate them.
+    """
+    if clusters is None:
+        clusters = max(1, int(np.sqrt(n)))
+    centres = random_unit_vectors(clusters, dim, rng)
+    vectors = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, 65536):
+        count = min(65536, n - start)
+        chunk = centres[rng.integers(0, clusters, count)]
+        chunk += spread / np.sqrt(dim) * rng.standard_normal((count, dim), dtype=np.float32)
+        chunk /= np.linalg.norm(chunk, axis=1, keepdims=True)
+        vectors[start:start + count] = chunk
+    return vectors
+
+
+def make_image_corpus(directory, count, size=(256, 256), classes=10, seed=0):
+    """
+    Write a corpus of JPEG images sorted into one folder per class
+
+    Each class has its own palette and shape style, so the images are
+    neither identical nor pure noise. Existing files are kept, so a corpus
+    is generated once and reused across runs.
+
+    Returns:
+        Sorted list of image paths
+    """
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(seed)
+    palettes = rng.integers(0, 256, (classes, 4, 3))
+    paths = []
+    for i in range(count):
+        label = i % classes
+        class_dir = os.path.join(directory, f"class_{label:02d}")
+        path = os.path.join(class_dir, f"img_{i:06d}.jpg")
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        os.makedirs(class_dir, exist_ok=True)
+
+        image_rng = np.random.default_rng([seed, i])
+        palette = palettes[label]
+        # Vertical gradient between two class colours, plus sensor-like noise
+        t = np.linspace(0, 1, size[0])[:, None, None]
+        pixels = (1 - t) * palette[0] + t * palette[1]
+        pixels = np.broadcast_to(pixels, (size[0], size[1], 3)) + image_rng.normal(0, 12, (size[0], size[1], 3))
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+        draw = ImageDraw.Draw(image)
+        for _ in range(image_rng.integers(3, 8)):
+            x0, y0 = image_rng.integers(0, size[1]), image_rng.integers(0, size[0])
+            x1, y1 = x0 + image_rng.integers(10, size[1] // 2), y0 + image_rng.integers(10, size[0] // 2)
+            colour = tuple(int(c) for c in palette[2 + image_rng.integers(0, 2)])
+            if label % 2:
+                draw.ellipse([x0, y0, x1, y1], fill=colour)
+            else:
+                draw.rectangle([x0, y0, x1, y1], fill=colour)
+        image.save(path, quality=90)
+    return sorted(paths)
+
+
+def use_models_dir(models_dir):
+    """Point every path setting under config.MODELS_DIR at another directory"""
+    old_dir = config.MODELS_DIR
+    for name in dir(config):
+        value = getattr(config, name)
+        if name.isupper() and isinstance(value, str) and (value == old_dir or value.startswith(old_dir + os.sep)):
+            setattr(config, name, models_dir + value[len(old_dir):])
+    os.makedirs(models_dir, exist_ok=True)
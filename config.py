@@ -10,20 +10,147 @@ STATIC_DIR = os.path.join(BASE_DIR, 'static')
 UPLOAD_DIR = os.path.join(STATIC_DIR, 'uploads')
 
 # Model configuration
-MODEL_NAME = 'ResNet50'
-IMAGE_SIZE = (224, 224)
+MODEL_NAME = 'ResNet50'  # Backbone: 'ResNet50', 'MobileNetV3Small', 'MobileNetV3Large', 'EfficientNetB0', 'EfficientNetV2B0'
+IMAGE_SIZE = None  # Model input (height, width); None uses the backbone's default
 BATCH_SIZE = 32
+DECODE_WORKERS = None  # Threads decoding images ahead of the model (default: CPU count)
+PREFETCH_BATCHES = 2  # Decoded batches queued ahead of inference
+
+# Inference runtime
+INFERENCE_MODE = 'function'  # 'function' (traced, fixed input signature), 'call' (eager model(x)) or 'predict' (Keras predict)
+INFERENCE_PRECISION = None  # 'bfloat16' (fast on CPUs with AVX512-BF16/AMX), 'float16', 'int8' (dense layers only), or None for float32
+
+# Embedding cache, keyed by image content hash and model
+EMBEDDING_CACHE = True
+EMBEDDING_CACHE_DIR = os.path.join(MODELS_DIR, 'embedding_cache')
+EMBEDDING_CACHE_MEMORY_MB = 256  # In-memory LRU tier size
+EMBEDDING_CACHE_DISK_MB = 4096  # Disk tier size; the least recently used entries are deleted beyond it (None: unbounded)
+CACHE_LOOKUP_BATCHES = 16  # Batches hashed and looked up ahead of inference
 
 # Feature extraction
+FEATURE_STORE_FILE = os.path.join(MODELS_DIR, 'features.idx')
+FEATURE_STORE_VERIFY = False  # Checksum the whole store on load (reads every page)
+
+# PCA projection of extractor features before they are indexed
+PCA_DIM = None  # e.g. 256 for ~8x less memory and search work; None keeps full width
+PCA_WHITEN = False  # Scale components to unit variance
+PCA_TRAIN_SIZE = 100000  # Vectors sampled to fit the projection
+PROJECTION_FILE = os.path.join(MODELS_DIR, 'projection.npz')
+
+# Incremental sync: per-file fingerprints and deleted-row tombstones
+FINGERPRINTS_FILE = os.path.join(MODELS_DIR, 'fingerprints.json')
+TOMBSTONES_FILE = os.path.join(MODELS_DIR, 'tombstones.npy')
+EXCLUDED_FILE = os.path.join(MODELS_DIR, 'excluded.json')  # Files builds and syncs skip (written by: python src/dedup.py --prune)
+COMPACTION_THRESHOLD = 0.2  # Compact once this fraction of rows is deleted
+
+# Index builds are checkpointed here and resumed after a crash
+BUILD_DIR = os.path.join(MODELS_DIR, 'build')
+SHARD_SIZE = 4096  # Images per checkpoint shard
+
+# Legacy pickle index, still loaded when no feature store exists
 FEATURES_FILE = os.path.join(MODELS_DIR, 'image_features.pkl')
 IMAGE_PATHS_FILE = os.path.join(MODELS_DIR, 'image_paths.pkl')
 
 # Similarity search
 TOP_K = 10  # Number of similar images to return
+SEARCH_CHUNK_SIZE = 65536  # Rows scored per matrix product in exact search
+SEARCH_QUERY_BLOCK_SIZE = 1024  # Queries scored per matrix product in batch search
+MAX_BATCH_QUERIES = 10000  # Upper limit for /api/search/batch
+
+# Micro-batching: concurrent /api/search requests share one forward pass and scan
+SEARCH_MICRO_BATCHING = True
+SEARCH_MAX_BATCH_SIZE = 16  # Flush when this many requests are queued
+SEARCH_MAX_BATCH_DELAY_MS = 5  # ...or when the oldest has waited this long
+
+# Approximate nearest-neighbour index
+ANN_INDEX_FILE = os.path.join(MODELS_DIR, 'ann_index.npz')
+ANN_INDEX_TYPE = 'ivf'  # 'ivf', or None to always use exact search
+ANN_MIN_IMAGES = 10000  # Smaller indexes are searched exactly
+IVF_NLIST = None  # Number of coarse centroids (default: 4 * sqrt(N))
+IVF_NPROBE = 16  # Lists scanned per query; higher = better recall, slower
+IVF_TRAIN_ITERATIONS = 20
+IVF_TRAIN_POINTS_PER_LIST = 64
+
+# Compressed feature codes, scored in place of the full vectors
+QUANTIZATION = None  # 'int8' (4x smaller), 'pq' (dim / PQ_SUBQUANTIZERS x smaller), or None
+QUANTIZER_FILE = os.path.join(MODELS_DIR, 'quantizer.npz')
+QUANTIZED_CODES_FILE = os.path.join(MODELS_DIR, 'quantized_codes.npy')
+PQ_SUBQUANTIZERS = 256  # Bytes per vector for 'pq'; must divide the feature dimension
+PQ_TRAIN_ITERATIONS = 20
+QUANTIZER_TRAIN_SIZE = 65536  # Vectors sampled to train the quantizer
+QUANTIZED_CHUNK_SIZE = 16384  # Codes scored at once
+RERANK_FACTOR = 4  # Re-score top_k * factor candidates on full vectors; 0 disables re-ranking
+
+# Per-image metadata (folder, extension, mtime, size, dimensions) for filtered search
+METADATA_FILE = os.path.join(MODELS_DIR, 'metadata.npz')
+FILTER_SCAN_FRACTION = 0.2  # Filters matching at most this share of the index scan only the matching rows
+
+# Precomputed k-NN graph for "more like this" lookups of indexed images
+KNN_GRAPH = False  # Build the graph with every index build (or run: python src/knn_graph.py)
+KNN_GRAPH_K = 20  # Neighbours stored per image; larger top_k falls back to a scan
+KNN_GRAPH_FILE = os.path.join(MODELS_DIR, 'knn_graph.npy')
+
+# In-memory cache of search results, dropped whenever the index changes
+RESULT_CACHE = True
+RESULT_CACHE_SIZE = 10000  # Results kept before the least recently used are evicted
+RESULT_CACHE_TTL_SECONDS = 300  # Age after which a cached result is recomputed; None keeps results until the index changes
+
+# Near-duplicate detection (python src/dedup.py)
+DEDUP_THRESHOLD = 0.95  # Cosine similarity at or above which images are duplicates
+DEDUP_PROBE_LISTS = 4  # Neighbouring IVF lists compared with each list
+DUPLICATES_REPORT_FILE = os.path.join(MODELS_DIR, 'duplicates.json')
+
+# Sharded search: row ranges of the index scanned by separate worker processes
+INDEX_SHARDS = 0  # Number of shards per server process; 0 or 1 searches in-process
+SHARD_THREADS = None  # BLAS threads per shard process (default: the process's cores split between shards)
+SHARD_DIR = os.path.join(MODELS_DIR, 'shards')
+SHARD_TIMEOUT_MS = 2000  # Shards slower than this are left out of an answer
+
+# Server startup
+BACKGROUND_WARMUP = True  # Load the index and model on a background thread; /api/health/ready reports when done
+WARMUP_BATCH_SIZES = (1, SEARCH_MAX_BATCH_SIZE)  # Dummy inference batch sizes run before the server reports ready
+
+# Thumbnails, written while indexing and served at /thumbnails/<size>/<path> (or: python src/thumbnails.py)
+THUMBNAILS = True  # Write thumbnails while indexing, link them in results and generate missing ones on demand
+THUMBNAIL_DIR = os.path.join(MODELS_DIR, 'thumbnails')  # Content-addressed: one file per image content and size
+THUMBNAIL_SIZES = (320, 128)  # Longest side in pixels; search results link the first size
+THUMBNAIL_FORMAT = 'webp'  # 'webp' or 'jpeg' (used when Pillow lacks WebP support)
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WORKERS = 2  # Thumbnails generated on demand at once per server process
+THUMBNAIL_WAIT_MS = 500  # Requests waiting longer for a generation slot are sent the original instead
+IMAGE_CACHE_MAX_AGE = 86400  # Cache-Control max-age in seconds of served images and thumbnails; ETags revalidate them after
+
+# Indexing jobs submitted to the server (POST /api/index/jobs)
+INDEX_JOBS_API = False  # Accept indexing jobs over HTTP; they may only read images under DATA_DIR
+INDEX_JOBS_TOKEN = None  # If set, job requests must send 'Authorization: Bearer <token>'
+INDEX_JOBS_DIR = os.path.join(MODELS_DIR, 'jobs')  # Job state, shared by all server processes
+INDEX_JOBS_KEPT = 100  # Records of finished jobs kept
+INDEX_JOB_NICE = 10  # Niceness added to the job thread and the decode threads it starts (not to TensorFlow's inference threads)
+INDEX_JOB_CPU_SHARE = 0.5  # Fraction of wall time a job spends extracting, inference included; it pauses between batches for the rest
+INDEX_LOCK_FILE = os.path.join(MODELS_DIR, 'index.lock')
+INDEX_VERSION_FILE = os.path.join(MODELS_DIR, 'index_version.json')  # Rewritten when a job replaces the index
+INDEX_RELOAD_INTERVAL_SECONDS = 5  # How often each server process checks whether a job elsewhere replaced the index
+
+# Metrics (GET /api/metrics, Prometheus text format) and request profiling
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Histogram bucket bounds in seconds
+REQUEST_PROFILING = False  # Allow ?profile=1 on API requests to return a sampled profile in the response
+PROFILE_INTERVAL_MS = 1  # Stack sampling interval of the request profiler
+PROFILE_MAX_STACKS = 30  # Most frequent stacks and functions returned per profile
+
+# Production server (gunicorn -c gunicorn.conf.py wsgi:app)
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 5000
+SERVER_WORKERS = None  # Worker processes (default: one per CPU core, or per INDEX_SHARDS cores when sharded)
+SERVER_THREADS = 4  # Request threads per worker
+
+# TensorFlow thread pools (None lets TensorFlow decide)
+TF_INTRA_OP_THREADS = None
+TF_INTER_OP_THREADS = None
 
 # Flask configuration
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+SAVE_UPLOADS = False  # Keep uploaded query images in static/uploads (after the search)
 
 # Create directories if they don't exist
 os.makedirs(DATA_DIR, exist_ok=True)
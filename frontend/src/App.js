@@ -28,7 +28,13 @@ function HomePage() {
       const data = response.data;
       
       if (data.status === 'ok') {
-        if (data.indexed) {
+        if (data.state === 'loading') {
+          setStatus({
+            message: '⏳ Server is starting up, loading the model...',
+            type: 'info'
+          });
+          setTimeout(checkServerStatus, 2000);
+        } else if (data.indexed) {
           setStatus({
             message: `✓ System ready! ${data.total_images} images indexed.`,
             type: 'success'
@@ -31,7 +31,7 @@ function BrowseImages() {
         {images.map((image, index) => (
           <div key={index} className="result-item">
             <img 
-              src={`/${image.path}`} 
+              src={`/${image.thumbnail || image.path}`} 
               alt={`Image ${index + 1}`}
               loading="lazy"
               onError={(e) => e.target.style.display = 'none'}
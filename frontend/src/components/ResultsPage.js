@@ -50,7 +50,7 @@ function ResultsPage() {
               {results.results.map((result, index) => (
                 <div key={index} className={`result-item ${result.is_exact_match ? 'exact-match' : ''}`}>
                   <img 
-                    src={`/${result.path}`} 
+                    src={`/${result.thumbnail || result.path}`} 
                     alt={`Similar ${index + 1}`}
                     loading="lazy"
                     onError={(e) => {
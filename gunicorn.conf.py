@@ -0,0 +1,48 @@
+"""
+Gunicorn settings for serving the app with one worker process per core.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+
+# Gunicorn treats every top-level name here as a setting, and 'config' is one
+import config as app_config
+
+bind = f"{app_config.SERVER_HOST}:{app_config.SERVER_PORT}"
+
+# Every worker starts its own INDEX_SHARDS shard processes, so when sharding
+# one worker per INDEX_SHARDS cores keeps about one shard process per core
+index_shards = app_config.INDEX_SHARDS if app_config.INDEX_SHARDS > 1 else 1
+workers = app_config.SERVER_WORKERS or max(1, (os.cpu_count() or 1) // index_shards)
+if index_shards > 1 and workers * index_shards > (os.cpu_count() or 1):
+    print(f"Warning: {workers} workers x {index_shards} index shards start "
+          f"{workers * index_shards} shard processes on {os.cpu_count()} cores")
+
+# Threads let concurrent requests inside a worker share micro-batches
+worker_class = 'gthread'
+threads = app_config.SERVER_THREADS
+
+# TensorFlow is not fork-safe, so each worker loads the model itself after
+# the fork instead of inheriting it from a preloaded master
+preload_app = False
+
+# Workers load ResNet50 on a background thread and boot at once, but a
+# request that arrives mid-load on a cold disk can still wait a while
+timeout = 120
+graceful_timeout = 30
+
+
+def post_fork(server, worker):
+    """Give each worker an equal share of the cores for its math thread pools"""
+    threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    # Read by BLAS when numpy is first imported in the worker
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ.setdefault(var, str(threads_per_worker))
+
+    if app_config.TF_INTRA_OP_THREADS is None:
+        app_config.TF_INTRA_OP_THREADS = threads_per_worker
+    if app_config.TF_INTER_OP_THREADS is None:
+        app_config.TF_INTER_OP_THREADS = 1
+    if app_config.SHARD_THREADS is None and index_shards > 1:
+        app_config.SHARD_THREADS = max(1, threads_per_worker // index_shards)
@@ -0,0 +1,259 @@
+import numpy as np
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from exact_search import normalize_query, select_top_k
+
+
+def _assign_to_centroids(data, centroids, chunk_size=65536):
+    """
+    Assign each vector to its most similar centroid
+
+    Args:
+        data: Array of L2-normalized vectors (N x D)
+        centroids: Array of L2-normalized centroids (K x D)
+        chunk_size: Number of rows scored at once, bounds temporary memory
+
+    Returns:
+        Array of centroid ids (N,)
+    """
+    assignments = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=np.float32)
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(data, n_clusters, n_iter=None, seed=0):
+    """
+    Cluster L2-normalized vectors with spherical k-means (cosine distance)
+
+    Args:
+        data: Array of L2-normalized vectors (N x D)
+        n_clusters: Number of centroids to learn
+        n_iter: Number of Lloyd iterations (default from config)
+        seed: Random seed for initialization and reseeding
+
+    Returns:
+        Array of L2-normalized centroids (n_clusters x D)
+    """
+    if n_iter is None:
+        n_iter = config.IVF_TRAIN_ITERATIONS
+
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = _assign_to_centroids(data, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        nonempty = counts > 0
+
+        # Sum members of each cluster in one pass over the sorted data
+        order = np.argsort(assignments, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        centroids[nonempty] = np.add.reduceat(data[order], starts[nonempty], axis=0)
+
+        # Reseed empty clusters with random points so every list is usable
+        n_empty = int((~nonempty).sum())
+        if n_empty:
+            centroids[~nonempty] = data[rng.choice(len(data), n_empty, replace=False)]
+
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.maximum(norms, 1e-12)
+
+    return centroids
+
+
+class IVFIndex:
+    """Approximate nearest-neighbour index using an inverted file over k-means centroids"""
+
+    def __init__(self, nlist=None, nprobe=None):
+        self.nlist = nlist if nlist is not None else config.IVF_NLIST
+        self.nprobe = nprobe if nprobe is not None else config.IVF_NPROBE
+        self.centroids = None
+        self.list_offsets = None
+        self.list_ids = None
+
+    @property
+    def ntotal(self):
+        """Number of vectors stored in the inverted lists"""
+        return 0 if self.list_ids is None else len(self.list_ids)
+
+    def train(self, features):
+        """
+        Learn the coarse centroids from (a sample of) the features
+
+        Args:
+            features: Array of L2-normalized feature vectors (N x D)
+        """
+        n = len(features)
+        if self.nlist is None:
+            self.nlist = int(4 * np.sqrt(n))
+        self.nlist = max(1, min(self.nlist, n))
+
+        # k-means only needs a few dozen points per centroid to converge
+        sample_size = min(n, self.nlist * config.IVF_TRAIN_POINTS_PER_LIST)
+        if sample_size < n:
+            sample_ids = np.sort(np.random.default_rng(0).choice(n, sample_size, replace=False))
+            sample = features[sample_ids]
+        else:
+            sample = features
+
+        print(f"Training IVF index with {self.nlist} lists on {sample_size} vectors...")
+        self.centroids = spherical_kmeans(sample, self.nlist)
+
+    def add(self, features, start_id=0):
+        """
+        Assign vectors to inverted lists
+
+        Args:
+            features: Array of L2-normalized feature vectors (N x D)
+            start_id: Row id of the first vector in the full feature matrix
+        """
+        if self.centroids is None:
+            raise ValueError("IVF index not trained. Call train() first.")
+
+        assignments = _assign_to_centroids(features, self.centroids)
+        new_ids = np.arange(start_id, start_id + len(features), dtype=np.int64)
+
+        if self.list_ids is not None:
+            # Recover list membership of existing ids and merge with the new ones
+            sizes = np.diff(self.list_offsets)
+            old_assignments = np.repeat(np.arange(self.nlist, dtype=np.int32), sizes)
+            assignments = np.concatenate([old_assignments, assignments])
+            new_ids = np.concatenate([self.list_ids, new_ids])
+
+        order = np.lexsort((new_ids, assignments))
+        self.list_ids = new_ids[order]
+        counts = np.bincount(assignments, minlength=self.nlist)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def build(self, features):
+        """Train centroids and add all features in one step"""
+        self.train(features)
+        self.list_ids = None
+        self.list_offsets = None
+        self.add(features)
+
+    def compact(self, keep):
+        """
+        Drop removed rows and renumber the rest after the feature matrix is compacted
+
+        Args:
+            keep: Boolean mask over the old row ids, True for rows that remain
+        """
+        new_ids = np.cumsum(keep) - 1
+        sizes = np.diff(self.list_offsets)
+        assignments = np.repeat(np.arange(self.nlist, dtype=np.int32), sizes)
+
+        kept = keep[self.list_ids]
+        self.list_ids = new_ids[self.list_ids[kept]].astype(np.int64)
+        counts = np.bincount(assignments[kept], minlength=self.nlist)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def search(self, query_features, features, top_k, nprobe=None, deleted=None, quantized=None):
+        """
+        Find approximate top K neighbours of a query
+
+        Args:
+            query_features: L2-normalized query vector (D,)
+            features: Full feature matrix the list ids refer to
+            top_k: Number of neighbours to return
+            nprobe: Number of inverted lists to scan (default: self.nprobe)
+            deleted: Optional boolean mask of rows to leave out
+            quantized: Optional QuantizedSearch to score candidates on compressed codes
+
+        Returns:
+            Tuple of (row ids, similarity scores), best match first
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        nprobe = max(1, min(nprobe, self.nlist))
+
+        query_features = normalize_query(query_features)
+        centroid_scores = self.centroids @ query_features
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        candidate_ids = np.concatenate([
+            self.list_ids[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probe
+        ])
+        if deleted is not None:
+            candidate_ids = candidate_ids[~deleted[candidate_ids]]
+        if candidate_ids.size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # Sorted ids keep reads from the feature matrix sequential
+        candidate_ids.sort()
+        if quantized is not None:
+            return quantized.search_rows(query_features, candidate_ids, top_k)
+        scores = features[candidate_ids] @ query_features
+
+        top = select_top_k(scores, top_k)
+        return candidate_ids[top], scores[top]
+
+    def save(self, path=None):
+        """Save the index structure (centroids and inverted lists) to disk"""
+        if path is None:
+            path = config.ANN_INDEX_FILE
+        # Written aside and renamed, so a server reloading meanwhile never reads half a file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     index_type=np.array('ivf'),
+                     centroids=self.centroids,
+                     list_offsets=self.list_offsets,
+                     list_ids=self.list_ids,
+                     nprobe=np.array(self.nprobe))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=None):
+        """Load an index saved with save()"""
+        if path is None:
+            path = config.ANN_INDEX_FILE
+        with np.load(path) as data:
+            index = cls(nlist=len(data['centroids']), nprobe=int(data['nprobe']))
+            index.centroids = data['centroids']
+            index.list_offsets = data['list_offsets']
+            index.list_ids = data['list_ids']
+        return index
+
+
+def build_ann_index(features, index_type=None):
+    """
+    Build the configured approximate index for a feature matrix
+
+    Args:
+        features: Array of L2-normalized feature vectors (N x D)
+        index_type: Index backend name (default from config)
+
+    Returns:
+        Built index, or None if the corpus is small enough for exact search
+    """
+    if index_type is None:
+        index_type = config.ANN_INDEX_TYPE
+
+    if not index_type or len(features) < config.ANN_MIN_IMAGES:
+        return None
+
+    if index_type == 'ivf':
+        index = IVFIndex()
+        index.build(features)
+        return index
+
+    raise ValueError(f"Unknown ANN index type: {index_type}")
+
+
+def load_ann_index(path=None):
+    """Load an approximate index from disk, dispatching on its stored type"""
+    if path is None:
+        path = config.ANN_INDEX_FILE
+    with np.load(path) as data:
+        index_type = str(data['index_type'])
+
+    if index_type == 'ivf':
+        return IVFIndex.load(path)
+
+    raise ValueError(f"Unknown ANN index type: {index_type}")
@@ -0,0 +1,99 @@
+"""
+Registry of the embedding backbones FeatureExtractor can run.
+
+Each entry knows how to build its Keras model (ImageNet weights, no
+classifier, global average pooling), how to preprocess decoded images for
+it, its default input size and the width of its embeddings. Keras is only
+imported when a model is built, so the registry is cheap to import for
+code that just needs a backbone's id or dimension.
+
+An index records the model_id of the backbone that produced it, and
+embeddings of different backbones are never mixed in one index.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+class Backbone:
+    """A pre-trained image model used as a feature extractor"""
+
+    def __init__(self, name, application, module, input_size, output_dim, build_kwargs=None):
+        """
+        Args:
+            name: Name used in config.MODEL_NAME
+            application: Name of the keras.applications model class
+            module: keras.applications submodule holding its preprocess_input
+            input_size: Default (height, width) of the model input
+            output_dim: Length of the pooled embedding
+            build_kwargs: Extra keyword arguments for the model class
+        """
+        self.name = name
+        self.application = application
+        self.module = module
+        self.input_size = tuple(input_size)
+        self.output_dim = output_dim
+        self.build_kwargs = build_kwargs or {}
+
+    def image_size(self):
+        """Input size in use: config.IMAGE_SIZE if set, else the backbone's default"""
+        return tuple(config.IMAGE_SIZE) if config.IMAGE_SIZE else self.input_size
+
+    @property
+    def model_id(self):
+        """Identifies embeddings of this backbone at the configured input size"""
+        height, width = self.image_size()
+        return f"{self.name.lower()}-{height}x{width}"
+
+    def build(self, weights='imagenet'):
+        """Build the Keras model, outputting one pooled embedding per image"""
+        import keras
+        model_class = getattr(keras.applications, self.application)
+        return model_class(weights=weights, include_top=False, pooling='avg',
+                           input_shape=(*self.image_size(), 3), **self.build_kwargs)
+
+    def preprocess(self, batch_array):
+        """Scale a batch of decoded RGB images (0-255 floats) the way the model was trained"""
+        import keras
+        return getattr(keras.applications, self.module).preprocess_input(batch_array)
+
+
+BACKBONES = {}
+
+# Indexes written before backbones were recorded could only come from ResNet50
+LEGACY_MODEL_ID = 'resnet50-224x224'
+
+
+def register_backbone(backbone):
+    """Make a backbone selectable by name (case-insensitive)"""
+    BACKBONES[backbone.name.lower()] = backbone
+    return backbone
+
+
+def get_backbone(name=None):
+    """
+    Look up a registered backbone
+
+    Args:
+        name: Backbone name (default: config.MODEL_NAME)
+
+    Raises:
+        ValueError: If no backbone of that name is registered
+    """
+    if name is None:
+        name = config.MODEL_NAME
+    try:
+        return BACKBONES[name.lower()]
+    except KeyError:
+        known = ', '.join(backbone.name for backbone in BACKBONES.values())
+        raise ValueError(f"Unknown backbone '{name}'. Available: {known}") from None
+
+
+register_backbone(Backbone('ResNet50', 'ResNet50', 'resnet50', (224, 224), 2048))
+# MobileNetV3 and EfficientNet rescale their input inside the model;
+# their preprocess_input passes images through unchanged
+register_backbone(Backbone('MobileNetV3Small', 'MobileNetV3Small', 'mobilenet_v3', (224, 224), 576))
+register_backbone(Backbone('MobileNetV3Large', 'MobileNetV3Large', 'mobilenet_v3', (224, 224), 960))
+register_backbone(Backbone('EfficientNetB0', 'EfficientNetB0', 'efficientnet', (224, 224), 1280))
+register_backbone(Backbone('EfficientNetV2B0', 'EfficientNetV2B0', 'efficientnet_v2', (224, 224), 1280))
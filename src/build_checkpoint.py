@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from backbones import LEGACY_MODEL_ID
+
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def _write_atomic(path, write):
+    """Write a file through a temporary name so a crash never leaves it half written"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class BuildCheckpoint:
+    """
+    On-disk progress of an index build, streamed out in fixed-size shards
+
+    Extracted features are buffered until SHARD_SIZE rows are collected,
+    then written as a shard (.npy matrix plus a JSON list of its paths) and
+    recorded in manifest.json. The manifest is the source of truth: a shard
+    only counts once it is listed there, so a crash at any point loses at
+    most one shard of work and a restarted build skips every recorded path.
+    """
+
+    def __init__(self, build_dir=None, shard_size=None):
+        self.build_dir = build_dir if build_dir is not None else config.BUILD_DIR
+        self.shard_size = shard_size if shard_size is not None else config.SHARD_SIZE
+        self.manifest = None
+        self._buffer_features = []
+        self._buffer_paths = []
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.build_dir, MANIFEST_FILE)
+
+    def load(self, image_directory, model=None):
+        """
+        Resume the checkpoint of a previous build of the same directory
+
+        Args:
+            image_directory: Directory being indexed
+            model: Id of the backbone extracting the features; a checkpoint
+                written by another backbone is not resumed
+
+        Returns:
+            True if a matching checkpoint was found, False otherwise
+        """
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return False
+
+        if manifest.get('image_directory') != os.path.abspath(image_directory):
+            return False
+        if manifest.get('model', LEGACY_MODEL_ID) != model:
+            return False
+
+        self.manifest = manifest
+        return True
+
+    def reset(self, image_directory, model=None):
+        """Discard any previous checkpoint and start a new build"""
+        if os.path.exists(self.build_dir):
+            shutil.rmtree(self.build_dir)
+        os.makedirs(self.build_dir)
+
+        self.manifest = {
+            'image_directory': os.path.abspath(image_directory),
+            'model': model,
+            'shards': [],
+            'failed': [],
+        }
+        self._save_manifest()
+
+    @property
+    def count(self):
+        """Number of feature vectors committed to shards"""
+        return sum(shard['count'] for shard in self.manifest['shards'])
+
+    def done_paths(self):
+        """Set of paths already extracted or known to fail"""
+        done = set(self.manifest['failed'])
+        for shard in self.manifest['shards']:
+            with open(os.path.join(self.build_dir, shard['paths']), 'r', encoding='utf-8') as f:
+                done.update(json.load(f))
+        return done
+
+    def pending(self, image_paths):
+        """Filter image_paths down to those not yet covered by the checkpoint"""
+        done = self.done_paths()
+        return [path for path in image_paths if path not in done]
+
+    def add(self, features, paths, failed=()):
+        """
+        Buffer a batch of extracted features, writing shards as they fill up
+
+        Args:
+            features: Array of feature vectors (N x D)
+            paths: List of N image paths
+            failed: Paths that could not be extracted and should not be retried
+        """
+        self._buffer_features.append(np.asarray(features, dtype=np.float32))
+        self._buffer_paths.extend(paths)
+        self.mark_failed(failed)
+
+        if len(self._buffer_paths) >= self.shard_size:
+            self.flush()
+
+    def mark_failed(self, paths):
+        """Record paths that could not be extracted, saved with the next flush"""
+        self.manifest['failed'].extend(paths)
+
+    def flush(self):
+        """Write buffered features as a new shard and record it in the manifest"""
+        if not self._buffer_paths:
+            # Failures alone still need recording so they are not retried
+            self._save_manifest()
+            return
+
+        shard_id = len(self.manifest['shards'])
+        features_name = f"shard_{shard_id:05d}.npy"
+        paths_name = f"shard_{shard_id:05d}.json"
+        features = np.concatenate(self._buffer_features)
+
+        _write_atomic(os.path.join(self.build_dir, features_name),
+                      lambda f: np.save(f, features))
+        _write_atomic(os.path.join(self.build_dir, paths_name),
+                      lambda f: f.write(json.dumps(self._buffer_paths).encode('utf-8')))
+
+        self.manifest['shards'].append({
+            'features': features_name,
+            'paths': paths_name,
+            'count': len(self._buffer_paths),
+        })
+        self._save_manifest()
+
+        self._buffer_features = []
+        self._buffer_paths = []
+
+    def iter_shards(self):
+        """
+        Yield the committed shards in build order
+
+        Yields:
+            Tuples of (memory-mapped features, list of paths)
+        """
+        for shard in self.manifest['shards']:
+            features = np.load(os.path.join(self.build_dir, shard['features']), mmap_mode='r')
+            with open(os.path.join(self.build_dir, shard['paths']), 'r', encoding='utf-8') as f:
+                paths = json.load(f)
+            yield features, paths
+
+    def remove(self):
+        """Delete the checkpoint once its shards have been merged into the index"""
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+        self.manifest = None
+
+    def _save_manifest(self):
+        _write_atomic(self.manifest_path,
+                      lambda f: f.write(json.dumps(self.manifest, indent=2).encode('utf-8')))
@@ -0,0 +1,275 @@
+import argparse
+import json
+import numpy as np
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from fingerprints import ExclusionList, FingerprintStore
+from index_jobs import IndexLock, mark_index_changed
+
+
+class UnionFind:
+    """Disjoint sets over row ids 0..n-1, stored as two flat arrays"""
+
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+        self.rank = np.zeros(n, dtype=np.int8)
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            # Path halving keeps the trees shallow without recursion
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.rank[a] < self.rank[b]:
+            a, b = b, a
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]:
+            self.rank[a] += 1
+
+    def union_pairs(self, left, right):
+        for a, b in zip(left.tolist(), right.tolist()):
+            self.union(a, b)
+
+    def roots(self):
+        """Root of every element, fully resolved"""
+        # Pointer jumping: each pass halves the remaining path lengths
+        roots = self.parent.copy()
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                return roots
+            roots = jumped
+
+
+def join_pairs(features, threshold, deleted=None, block_size=None, chunk_size=None):
+    """
+    Blocked self-join: yield every pair of rows with similarity >= threshold
+
+    Only the upper triangle of the similarity matrix is computed, one
+    (block x chunk) tile at a time, so memory stays bounded however large
+    the index is. Time is quadratic in the number of images.
+
+    Yields:
+        Tuples of (left row ids, right row ids) arrays, left < right
+    """
+    if block_size is None:
+        block_size = config.SEARCH_QUERY_BLOCK_SIZE
+    if chunk_size is None:
+        chunk_size = config.SEARCH_CHUNK_SIZE
+    n = len(features)
+
+    for start in range(0, n, block_size):
+        block = np.asarray(features[start:start + block_size])
+        rows_per_chunk = max(1, chunk_size * 16 // len(block))
+        for chunk_start in range(start, n, rows_per_chunk):
+            scores = block @ np.asarray(features[chunk_start:chunk_start + rows_per_chunk]).T
+            left, right = np.nonzero(scores >= threshold)
+            left += start
+            right += chunk_start
+            keep = left < right
+            if deleted is not None:
+                keep &= ~deleted[left] & ~deleted[right]
+            if keep.any():
+                yield left[keep], right[keep]
+
+
+def ivf_pairs(features, ann_index, threshold, deleted=None, probe_lists=None, block_size=None):
+    """
+    Candidate pairs from an IVF index: compare each inverted list only with
+    itself and its nearest lists, instead of with the whole index
+
+    Near-duplicates almost always land in the same or an adjacent cluster,
+    so this finds nearly all of them in roughly N * N / nlist * probe_lists
+    work. Raise probe_lists for completeness, lower it for speed.
+
+    Probing is not symmetric: list A may probe list B while B does not
+    probe A. A pair across two lists is yielded from the list of its lower
+    row id when both lists probe each other, and otherwise from whichever
+    list found it, so every pair is yielded exactly once.
+
+    Yields:
+        Tuples of (left row ids, right row ids) arrays, left != right
+    """
+    if probe_lists is None:
+        probe_lists = config.DEDUP_PROBE_LISTS
+    if block_size is None:
+        block_size = config.SEARCH_QUERY_BLOCK_SIZE
+    probe_lists = max(1, min(probe_lists, ann_index.nlist))
+    offsets, list_ids = ann_index.list_offsets, ann_index.list_ids
+
+    # List of each row, and which lists each list probes
+    row_lists = np.zeros(len(features), dtype=np.int64)
+    row_lists[list_ids] = np.repeat(np.arange(ann_index.nlist), np.diff(offsets))
+    centroid_scores = ann_index.centroids @ ann_index.centroids.T
+    probes = np.zeros((ann_index.nlist, ann_index.nlist), dtype=bool)
+    for l in range(ann_index.nlist):
+        probes[l, np.argpartition(-centroid_scores[l], probe_lists - 1)[:probe_lists]] = True
+    # A list always compares its own members with each other
+    np.fill_diagonal(probes, True)
+
+    for l in range(ann_index.nlist):
+        members = np.sort(list_ids[offsets[l]:offsets[l + 1]])
+        if deleted is not None:
+            members = members[~deleted[members]]
+        if not len(members):
+            continue
+
+        near = np.flatnonzero(probes[l])
+        candidates = np.sort(np.concatenate([list_ids[offsets[m]:offsets[m + 1]] for m in near]))
+        if deleted is not None:
+            candidates = candidates[~deleted[candidates]]
+
+        candidate_features = np.asarray(features[candidates])
+        for start in range(0, len(members), block_size):
+            block = members[start:start + block_size]
+            scores = np.asarray(features[block]) @ candidate_features.T
+            left, right = np.nonzero(scores >= threshold)
+            left, right = block[left], candidates[right]
+            keep = (left < right) | ((left != right) & ~probes[row_lists[right], l])
+            if keep.any():
+                yield left[keep], right[keep]
+
+
+def find_duplicate_groups(searcher, threshold=None, method='auto'):
+    """
+    Cluster near-duplicate images of a loaded index
+
+    Args:
+        searcher: SimilaritySearch with a loaded index
+        threshold: Cosine similarity at or above which two images are duplicates
+        method: 'join' (exact blocked self-join), 'ivf' (IVF candidate lists),
+            or 'auto' (ivf when an ANN index is loaded)
+
+    Returns:
+        List of groups, each a list of row ids (two or more), lowest id first
+    """
+    if threshold is None:
+        threshold = config.DEDUP_THRESHOLD
+    if method == 'auto':
+        method = 'ivf' if searcher.ann_index is not None else 'join'
+
+    if method == 'ivf':
+        if searcher.ann_index is None:
+            raise ValueError("The 'ivf' method needs an ANN index")
+        pairs = ivf_pairs(searcher.features, searcher.ann_index, threshold, searcher.deleted)
+    elif method == 'join':
+        pairs = join_pairs(searcher.features, threshold, searcher.deleted)
+    else:
+        raise ValueError(f"Unknown dedup method: {method}")
+
+    print(f"Finding duplicates with similarity >= {threshold} ({method})...")
+    clusters = UnionFind(len(searcher.image_paths))
+    n_pairs = 0
+    for left, right in pairs:
+        clusters.union_pairs(left, right)
+        n_pairs += len(left)
+    print(f"Found {n_pairs} duplicate pairs")
+
+    roots = clusters.roots()
+    order = np.argsort(roots, kind='stable')
+    boundaries = np.flatnonzero(np.diff(roots[order])) + 1
+    return [group for group in np.split(order, boundaries) if len(group) > 1]
+
+
+def write_report(searcher, groups, threshold, path=None):
+    """
+    Write the duplicate groups as JSON
+
+    The representative of each group is its first indexed image; every
+    other member is listed with its similarity to the representative.
+    """
+    if path is None:
+        path = config.DUPLICATES_REPORT_FILE
+
+    report_groups = []
+    for group in sorted(groups, key=len, reverse=True):
+        representative = int(group[0])
+        scores = np.asarray(searcher.features[group[1:]]) @ np.asarray(searcher.features[representative])
+        report_groups.append({
+            'representative': searcher.image_paths[representative],
+            'duplicates': [
+                {'path': searcher.image_paths[int(row)], 'similarity': round(float(score), 4)}
+                for row, score in zip(group[1:], scores)
+            ],
+        })
+
+    report = {
+        'threshold': threshold,
+        'groups': len(groups),
+        'duplicates': sum(len(group) - 1 for group in groups),
+        'duplicate_groups': report_groups,
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+    print(f"Wrote {len(groups)} duplicate groups to {path}")
+    return report
+
+
+def main():
+    from similarity_search import SimilaritySearch
+
+    parser = argparse.ArgumentParser(description='Find near-duplicate images in the index')
+    parser.add_argument('--threshold', type=float, default=config.DEDUP_THRESHOLD,
+                        help='Cosine similarity at or above which images are duplicates')
+    parser.add_argument('--method', choices=('auto', 'join', 'ivf'), default='auto',
+                        help='Exact blocked self-join, or IVF candidate lists (default: ivf if available)')
+    parser.add_argument('--report', default=config.DUPLICATES_REPORT_FILE,
+                        help='Where to write the duplicate groups report')
+    parser.add_argument('--prune', action='store_true',
+                        help='Remove all but one image of each group from the served index')
+    args = parser.parse_args()
+
+    # Pruning holds the index lock, so no indexing job rewrites the index in between
+    with IndexLock(shared=not args.prune):
+        searcher = SimilaritySearch()
+        if not searcher.load_index():
+            return
+
+        groups = find_duplicate_groups(searcher, args.threshold, args.method)
+        write_report(searcher, groups, args.threshold, args.report)
+
+        if args.prune and groups:
+            prune_duplicates(searcher, groups)
+
+
+def prune_duplicates(searcher, groups):
+    """
+    Remove all but the representative of each group from the index
+
+    The duplicates are tombstoned like deleted files, so a later compaction
+    removes them for good, and added to the exclusion list so that syncs
+    and rebuilds do not index them again. Running servers reload the index.
+    """
+    duplicates = np.concatenate([group[1:] for group in groups])
+    fingerprints = FingerprintStore()
+    fingerprints.load()
+    excluded = ExclusionList()
+    excluded.load()
+    for row in duplicates.tolist():
+        path = searcher.image_paths[row]
+        try:
+            excluded.add(path)
+        except OSError:
+            # Already gone from disk; the next sync forgets it anyway
+            pass
+        fingerprints.remove(path)
+
+    searcher.delete_from_index(duplicates)
+    excluded.save()
+    fingerprints.save()
+    mark_index_changed()
+    print(f"Removed {len(duplicates)} duplicates from the served index")
+
+
+if __name__ == "__main__":
+    main()
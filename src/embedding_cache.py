@@ -0,0 +1,206 @@
+from collections import OrderedDict
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from metrics import Counter
+
+
+CACHE_LOOKUPS = Counter('embedding_cache_lookups_total', 'Embedding cache lookups by outcome', ['result'])
+
+# Writes after which the disk tier is measured again, picking up what other processes wrote
+DISK_RESCAN_WRITES = 10000
+
+
+def bytes_hash(data):
+    """Return the 128-bit BLAKE2b hex digest of raw image bytes"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of image embeddings
+
+    Entries are keyed by the hash of the image file bytes, so the same
+    picture is embedded once no matter how many paths or uploads it arrives
+    under. Each model gets its own namespace, so switching models never
+    returns stale vectors.
+
+    Two tiers: an in-memory LRU bounded by EMBEDDING_CACHE_MEMORY_MB, in
+    front of a directory of .npy files that persists across restarts. The
+    disk tier is bounded by EMBEDDING_CACHE_DISK_MB: a hit refreshes the
+    file's mtime, and the files used longest ago are deleted once the
+    directory outgrows the bound.
+
+    The cache is best-effort: a file that cannot be written or read is a
+    miss, never an error.
+    """
+
+    def __init__(self, model_id, cache_dir=None, max_memory_bytes=None, max_disk_bytes=None):
+        if cache_dir is None:
+            cache_dir = config.EMBEDDING_CACHE_DIR
+        if max_memory_bytes is None:
+            max_memory_bytes = config.EMBEDDING_CACHE_MEMORY_MB * 1024 * 1024
+        if max_disk_bytes is None and config.EMBEDDING_CACHE_DISK_MB is not None:
+            max_disk_bytes = config.EMBEDDING_CACHE_DISK_MB * 1024 * 1024
+
+        self.model_id = model_id
+        self.cache_dir = os.path.join(cache_dir, model_id) if cache_dir else None
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        # Estimated size of the disk tier, measured on the first write
+        self._disk_bytes = None
+        self._disk_writes = 0
+        self._prune_lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def _remember(self, key, features):
+        """Insert into the memory tier, evicting least recently used entries"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = features
+            self._memory_bytes += features.nbytes
+            while self._memory_bytes > self.max_memory_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.nbytes
+
+    def get(self, key):
+        """
+        Look up the embedding for a content hash
+
+        Returns:
+            Feature vector, or None on a miss
+        """
+        with self._lock:
+            features = self._memory.get(key)
+            if features is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                CACHE_LOOKUPS.labels('memory_hit').inc()
+                return features
+
+        if self.cache_dir:
+            path = self._disk_path(key)
+            try:
+                features = np.load(path)
+                # Marks the entry as recently used for pruning
+                os.utime(path)
+            except (OSError, ValueError):
+                features = None
+            if features is not None:
+                self._remember(key, features)
+                with self._lock:
+                    self.disk_hits += 1
+                CACHE_LOOKUPS.labels('disk_hit').inc()
+                return features
+
+        with self._lock:
+            self.misses += 1
+        CACHE_LOOKUPS.labels('miss').inc()
+        return None
+
+    def put(self, key, features):
+        """Store the embedding for a content hash in both tiers"""
+        features = np.array(features, dtype=np.float32)
+        features.setflags(write=False)
+        self._remember(key, features)
+
+        if self.cache_dir:
+            path = self._disk_path(key)
+            tmp_path = None
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Unique across processes, which may cache the same image at once
+                fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, features)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Error writing embedding cache entry {key}: {str(e)}")
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return
+            self._after_disk_write(os.path.getsize(path))
+
+    def _after_disk_write(self, nbytes):
+        """Prune the disk tier once it may have outgrown its bound"""
+        if self.max_disk_bytes is None:
+            return
+        with self._lock:
+            self._disk_writes += 1
+            if self._disk_bytes is not None:
+                self._disk_bytes += nbytes
+            due = (self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+                   or self._disk_writes % DISK_RESCAN_WRITES == 0)
+        # One thread prunes at a time; the others carry on writing
+        if due and self._prune_lock.acquire(blocking=False):
+            try:
+                self.prune_disk()
+            finally:
+                self._prune_lock.release()
+
+    def prune_disk(self):
+        """
+        Delete the least recently used files until the disk tier is at 90% of its bound
+
+        Returns:
+            Number of files deleted
+        """
+        entries = []
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.npy'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        if self.max_disk_bytes is not None and total > self.max_disk_bytes:
+            entries.sort()
+            target = self.max_disk_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+        with self._lock:
+            self._disk_bytes = total
+        return removed
+
+    def stats(self):
+        """Hit/miss counters and memory-tier usage"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'model_id': self.model_id,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+            }
@@ -0,0 +1,193 @@
+import numpy as np
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+def select_top_k(scores, k):
+    """
+    Return the positions of the k highest scores, best first
+
+    Uses np.argpartition (linear time) and only sorts the k selected scores,
+    instead of sorting the whole array.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def select_top_k_rows(scores, k):
+    """
+    Row-wise select_top_k for a (queries x candidates) score matrix
+
+    Returns:
+        Array of column positions (queries x k), best first in each row
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+def normalize_query(query_features):
+    """Return the query as a contiguous, L2-normalized float32 vector"""
+    query_features = np.asarray(query_features, dtype=np.float32).ravel()
+    norm = np.linalg.norm(query_features)
+    if norm > 0:
+        query_features = query_features / norm
+    return query_features
+
+
+def normalize_queries(queries):
+    """Return queries as a contiguous (N x D) float32 array of unit rows"""
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if queries.ndim == 1:
+        queries = queries.reshape(1, -1)
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries / np.where(norms > 0, norms, 1)
+
+
+class ExactSearch:
+    """
+    Brute-force cosine search over pre-normalized float32 features
+
+    Since FeatureExtractor already L2-normalizes every vector, cosine
+    similarity is a plain dot product: each chunk of the index is scored
+    with a single BLAS matrix-vector product. Rows flagged in the optional
+    deleted mask score -inf. Given rows, only those row ids are scanned,
+    gathered one chunk at a time, so a search costs time proportional to
+    the subset (e.g. the images matching a filter).
+    """
+
+    def __init__(self, features, chunk_size=None, deleted=None, rows=None):
+        self.features = features
+        self.chunk_size = chunk_size if chunk_size is not None else config.SEARCH_CHUNK_SIZE
+        self.deleted = deleted
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.features) if self.rows is None else len(self.rows)
+
+    def _chunk(self, start, size):
+        """Features and row ids of scanned positions [start, start + size)"""
+        if self.rows is None:
+            end = min(start + size, len(self.features))
+            return self.features[start:end], np.arange(start, end)
+        row_ids = self.rows[start:start + size]
+        return self.features[row_ids], row_ids
+
+    def similarities(self, query_features):
+        """
+        Score the query against every indexed vector
+
+        Args:
+            query_features: Feature vector of query image
+
+        Returns:
+            Array of similarity scores, one per indexed image
+        """
+        query_features = normalize_query(query_features)
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), self.chunk_size):
+            chunk, row_ids = self._chunk(start, self.chunk_size)
+            np.dot(chunk, query_features, out=scores[start:start + len(chunk)])
+            if self.deleted is not None:
+                scores[start:start + len(chunk)][self.deleted[row_ids]] = -np.inf
+        return scores
+
+    def search(self, query_features, top_k):
+        """
+        Find the exact top K neighbours of a query
+
+        The index is scored one chunk at a time and only each chunk's top K
+        survive, so temporary memory is bounded by the chunk size.
+
+        Args:
+            query_features: Feature vector of query image
+            top_k: Number of neighbours to return
+
+        Returns:
+            Tuple of (row ids, similarity scores), best match first
+        """
+        query_features = normalize_query(query_features)
+        candidate_ids = []
+        candidate_scores = []
+
+        for start in range(0, len(self), self.chunk_size):
+            chunk, row_ids = self._chunk(start, self.chunk_size)
+            scores = chunk @ query_features
+            if self.deleted is not None:
+                scores[self.deleted[row_ids]] = -np.inf
+            top = select_top_k(scores, top_k)
+            candidate_ids.append(row_ids[top])
+            candidate_scores.append(scores[top])
+
+        if not candidate_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        ids = np.concatenate(candidate_ids)
+        scores = np.concatenate(candidate_scores)
+        top = select_top_k(scores, top_k)
+        return ids[top], scores[top]
+
+    def search_batch(self, queries, top_k, query_block_size=None):
+        """
+        Find the exact top K neighbours of many queries at once
+
+        Each block of queries is scored against each chunk of the index with
+        a single matrix-matrix product, so a block of queries costs about one
+        GEMM instead of one full scan per query.
+
+        Args:
+            queries: Array of query feature vectors (N x D)
+            top_k: Number of neighbours to return per query
+            query_block_size: Queries scored per GEMM (default from config)
+
+        Returns:
+            Tuple of (row ids, similarity scores) arrays of shape (N x k),
+            best match first in each row
+        """
+        if query_block_size is None:
+            query_block_size = config.SEARCH_QUERY_BLOCK_SIZE
+
+        queries = normalize_queries(queries)
+        k = min(top_k, len(self))
+        all_ids = np.empty((len(queries), k), dtype=np.int64)
+        all_scores = np.empty((len(queries), k), dtype=np.float32)
+        if k == 0:
+            return all_ids, all_scores
+
+        for q_start in range(0, len(queries), query_block_size):
+            block = queries[q_start:q_start + query_block_size]
+            candidate_ids = []
+            candidate_scores = []
+
+            # Keep the score matrix about as large as 16 single-query chunks
+            chunk_size = max(1, self.chunk_size * 16 // len(block))
+            for start in range(0, len(self), chunk_size):
+                chunk, row_ids = self._chunk(start, chunk_size)
+                scores = block @ chunk.T
+                if self.deleted is not None:
+                    scores[:, self.deleted[row_ids]] = -np.inf
+                top = select_top_k_rows(scores, top_k)
+                candidate_ids.append(row_ids[top])
+                candidate_scores.append(np.take_along_axis(scores, top, axis=1))
+
+            ids = np.concatenate(candidate_ids, axis=1)
+            scores = np.concatenate(candidate_scores, axis=1)
+            top = select_top_k_rows(scores, top_k)
+            all_ids[q_start:q_start + len(block)] = np.take_along_axis(ids, top, axis=1)
+            all_scores[q_start:q_start + len(block)] = np.take_along_axis(scores, top, axis=1)
+
+        return all_ids, all_scores
@@ -1,27 +1,163 @@
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Reduce TensorFlow logging
 import tensorflow as tf
 import keras
-from keras.applications import ResNet50
-from keras.applications.resnet50 import preprocess_input
-from keras.utils import load_img, img_to_array
-from keras.models import Model
+import warnings
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
+from backbones import get_backbone
+from image_pipeline import decode_image_bytes, iter_image_batches
+from embedding_cache import EmbeddingCache, bytes_hash
+from metrics import ERRORS, stage_timer
+
+
+def configure_threads():
+    """Apply the configured TensorFlow thread pool sizes, before the runtime starts"""
+    try:
+        if config.TF_INTRA_OP_THREADS:
+            tf.config.threading.set_intra_op_parallelism_threads(config.TF_INTRA_OP_THREADS)
+        if config.TF_INTER_OP_THREADS:
+            tf.config.threading.set_inter_op_parallelism_threads(config.TF_INTER_OP_THREADS)
+    except RuntimeError:
+        # The runtime is already initialized (e.g. a second extractor)
+        pass
+
+
+INFERENCE_MODES = ('function', 'call', 'predict')
+PRECISIONS = (None, 'float16', 'bfloat16', 'int8')
+
+
+def build_model(backbone, precision=None):
+    """
+    Build a pre-trained backbone, optionally at reduced precision
+    
+    'float16' and 'bfloat16' build every layer with that compute and weight
+    dtype. 'int8' quantizes the weights of the layers Keras can quantize
+    after loading; for convolutional backbones without their classifier
+    those are few or none.
+    
+    Args:
+        backbone: Backbone from the registry in backbones.py
+        precision: None (float32), 'float16', 'bfloat16' or 'int8'
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown inference precision: {precision}")
+    
+    if precision in ('float16', 'bfloat16'):
+        previous_policy = keras.config.dtype_policy()
+        keras.config.set_dtype_policy(precision)
+        try:
+            model = backbone.build()
+        finally:
+            keras.config.set_dtype_policy(previous_policy)
+    else:
+        model = backbone.build()
+    
+    if precision == 'int8':
+        with warnings.catch_warnings():
+            # Keras warns once per layer type without a quantized version
+            warnings.simplefilter('ignore')
+            model.quantize('int8')
+        quantized = sum(1 for layer in model.layers if layer.dtype_policy.name.startswith('int8'))
+        if not quantized:
+            print("Warning: no layers of this model support int8 quantization; running float32")
+    return model
+
+
+def _file_hash(img_path):
+    """Content hash of a file, or None if it cannot be read"""
+    try:
+        with open(img_path, 'rb') as f:
+            return bytes_hash(f.read())
+    except OSError:
+        return None
 
 
 class FeatureExtractor:
-    """Extract deep learning features from images using pre-trained ResNet50"""
+    """Extract deep learning features from images using a pre-trained backbone"""
+    
+    def __init__(self, use_cache=None, inference_mode=None, precision=None, backbone=None):
+        """
+        Args:
+            use_cache: Look up and store embeddings by image content hash (default from config)
+            inference_mode: 'function', 'call' or 'predict' (default from config)
+            precision: 'float32', 'float16', 'bfloat16' or 'int8' (default from config)
+            backbone: Backbone name from backbones.py (default: config.MODEL_NAME)
+        """
+        configure_threads()
+        
+        if inference_mode is None:
+            inference_mode = config.INFERENCE_MODE
+        if precision is None:
+            precision = config.INFERENCE_PRECISION
+        if precision == 'float32':
+            precision = None
+        if inference_mode not in INFERENCE_MODES:
+            raise ValueError(f"Unknown inference mode: {inference_mode}")
+        
+        # Load the pre-trained model without its top classification layer
+        self.backbone = get_backbone(backbone)
+        self.image_size = self.backbone.image_size()
+        self.model = build_model(self.backbone, precision)
+        self.inference_mode = inference_mode
+        self.precision = precision
+        self._infer = self._build_infer()
+        
+        # Reduced precision changes the embeddings slightly, so it gets its own cache entries
+        self.model_id = self.backbone.model_id
+        if precision is not None:
+            self.model_id += f"-{precision}"
+        
+        if use_cache is None:
+            use_cache = config.EMBEDDING_CACHE
+        self.cache = EmbeddingCache(self.model_id) if use_cache else None
+        
+        print(f"Feature extractor initialized with {self.backbone.name} "
+              f"({inference_mode}, {precision or 'float32'})")
+        print(f"Feature vector dimension: {self.feature_dim}")
+    
+    def _build_infer(self):
+        """Return the callable that runs the model on a preprocessed float32 batch"""
+        if self.inference_mode == 'predict':
+            # Wraps every call in a dataset and callbacks: fine for large batches only
+            return lambda batch: self.model.predict(batch, verbose=0)
+        
+        if self.inference_mode == 'call':
+            return lambda batch: self.model(batch, training=False)
+        
+        # One trace for every batch size: the batch dimension is left open
+        height, width = self.image_size
+        
+        @tf.function(input_signature=[tf.TensorSpec([None, height, width, 3], tf.float32)],
+                     autograph=False)
+        def infer(batch):
+            return tf.cast(self.model(batch, training=False), tf.float32)
+        
+        return infer
     
-    def __init__(self):
-        # Load pre-trained ResNet50 model without top classification layer
-        base_model = ResNet50(weights='imagenet', include_top=False, pooling='avg')
-        self.model = Model(inputs=base_model.input, outputs=base_model.output)
-        print(f"Feature extractor initialized with {config.MODEL_NAME}")
-        print(f"Feature vector dimension: {self.model.output_shape[1]}")
+    @property
+    def feature_dim(self):
+        """Length of the feature vectors produced by the model"""
+        return self.model.output_shape[1]
+    
+    def warm_up(self, batch_sizes=None):
+        """
+        Run dummy inferences so the first real requests do not pay for
+        graph tracing, kernel selection and memory allocation
+        
+        Args:
+            batch_sizes: Batch sizes to run once each (default from config)
+        """
+        if batch_sizes is None:
+            batch_sizes = config.WARMUP_BATCH_SIZES
+        rng = np.random.default_rng(0)
+        for batch_size in batch_sizes:
+            images = rng.uniform(0, 255, (batch_size, *self.image_size, 3)).astype(np.float32)
+            self._embed(images)
     
     def extract_features(self, img_path):
         """
@@ -34,72 +170,222 @@ class FeatureExtractor:
             Normalized feature vector (numpy array)
         """
         try:
-            # Load and preprocess image
-            img = load_img(img_path, target_size=config.IMAGE_SIZE)
-            img_array = img_to_array(img)
-            img_array = np.expand_dims(img_array, axis=0)
-            img_array = preprocess_input(img_array)
-            
-            # Extract features
-            features = self.model.predict(img_array, verbose=0)
-            
-            # Normalize features (L2 normalization)
-            features = features.flatten()
-            features = features / np.linalg.norm(features)
-            
-            return features
+            # Read once: the same bytes are hashed for the cache and decoded
+            with open(img_path, 'rb') as f:
+                data = f.read()
+            return self._features_from_bytes(data)
             
         except Exception as e:
             print(f"Error extracting features from {img_path}: {str(e)}")
             return None
     
-    def extract_features_batch(self, img_paths, batch_size=None):
+    def extract_features_from_bytes(self, data):
         """
-        Extract features from multiple images in batches
+        Extract features from an encoded image held in memory, e.g. an upload
+        
+        Args:
+            data: Encoded image file contents
+            
+        Returns:
+            Normalized feature vector, or None if the image cannot be decoded
+        """
+        try:
+            return self._features_from_bytes(data)
+        except Exception as e:
+            ERRORS.labels('extract').inc()
+            print(f"Error extracting features from uploaded image: {str(e)}")
+            return None
+    
+    def _features_from_bytes(self, data):
+        # Identical bytes were embedded before: skip the model
+        key = None
+        if self.cache is not None:
+            with stage_timer('cache_lookup'):
+                key = bytes_hash(data)
+                cached = self.cache.get(key)
+            if cached is not None:
+                return np.array(cached)
+        
+        with stage_timer('decode'):
+            image = decode_image_bytes(data, self.image_size)
+        features = self._embed(np.expand_dims(image, axis=0))[0]
+        
+        if key is not None:
+            self.cache.put(key, features)
+        return features
+    
+    def extract_features_from_bytes_batch(self, blobs):
+        """
+        Extract features from many in-memory images with one forward pass
+        
+        Args:
+            blobs: List of encoded image file contents
+            
+        Returns:
+            List with a normalized feature vector per image, None where the
+            image could not be decoded
+        """
+        results = [None] * len(blobs)
+        with stage_timer('cache_lookup'):
+            keys = [bytes_hash(data) for data in blobs] if self.cache is not None else [None] * len(blobs)
+            
+            misses = []
+            for i, key in enumerate(keys):
+                cached = self.cache.get(key) if key is not None else None
+                if cached is None:
+                    misses.append(i)
+                else:
+                    results[i] = np.array(cached)
+        if not misses:
+            return results
+        
+        def decode(i):
+            try:
+                return decode_image_bytes(blobs[i], self.image_size)
+            except Exception as e:
+                ERRORS.labels('decode').inc()
+                print(f"Error extracting features from uploaded image: {str(e)}")
+                return None
+        
+        num_workers = min(len(misses), config.DECODE_WORKERS or os.cpu_count() or 1)
+        with stage_timer('decode'), ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='image-decode') as pool:
+            decoded = [(i, array) for i, array in zip(misses, pool.map(decode, misses)) if array is not None]
+        if not decoded:
+            return results
+        
+        features = self._embed(np.array([array for _, array in decoded]))
+        for (i, _), vector in zip(decoded, features):
+            results[i] = vector
+            if keys[i] is not None:
+                self.cache.put(keys[i], vector)
+        return results
+    
+    def _embed(self, batch_array):
+        """Run the model on a batch of decoded images and L2-normalize the output"""
+        with stage_timer('inference'):
+            batch_array = self.backbone.preprocess(np.asarray(batch_array, dtype=np.float32))
+            batch_features = np.asarray(self._infer(batch_array)).astype(np.float32, copy=False)
+        batch_features = batch_features.reshape(len(batch_features), -1)
+        return batch_features / np.linalg.norm(batch_features, axis=1, keepdims=True)
+    
+    def _infer_batches(self, img_paths, batch_size, thumbnails=None, digests=None):
+        """Run the model over decoded batches, yielding (features, paths, failed paths)"""
+        for batch_array, batch_paths, failed_paths in iter_image_batches(img_paths, batch_size, target_size=self.image_size,
+                                                                         thumbnails=thumbnails, digests=digests):
+            if not batch_paths:
+                yield np.empty((0, self.feature_dim), dtype=np.float32), batch_paths, failed_paths
+                continue
+            
+            yield self._embed(batch_array), batch_paths, failed_paths
+    
+    def iter_features_batches(self, img_paths, batch_size=None, thumbnails=None, digests=None):
+        """
+        Stream features for many images, one batch at a time
+        
+        Images are decoded on a thread pool ahead of the model, so decoding
+        the next batches overlaps with inference on the current one. With
+        the embedding cache enabled, files are hashed first and only cache
+        misses are decoded and run through the model; cached batches are
+        yielded ahead of the computed ones, so the output order may differ
+        from the input order.
         
         Args:
             img_paths: List of image file paths
             batch_size: Batch size for processing (default from config)
+            thumbnails: Optional ThumbnailCache; decoded images get their
+                thumbnails written as a side product, and cache hits get
+                theirs written from the file if missing
+            digests: Optional dict, filled with the content hash of every
+                file read, from the same read as the cache lookup or decode
             
-        Returns:
-            Array of feature vectors
+        Yields:
+            Tuples of (normalized features (N x D), extracted paths,
+            paths that failed since the previous batch)
         """
         if batch_size is None:
             batch_size = config.BATCH_SIZE
         
-        features_list = []
-        total = len(img_paths)
+        if self.cache is None:
+            yield from self._infer_batches(img_paths, batch_size, thumbnails, digests)
+            return
+        if digests is None:
+            digests = {}
         
-        for i in range(0, total, batch_size):
-            batch_paths = img_paths[i:i + batch_size]
-            batch_images = []
-            
-            for img_path in batch_paths:
-                try:
-                    img = load_img(img_path, target_size=config.IMAGE_SIZE)
-                    img_array = img_to_array(img)
-                    batch_images.append(img_array)
-                except Exception as e:
-                    print(f"Error loading {img_path}: {str(e)}")
-                    continue
-            
-            if batch_images:
-                # Preprocess batch
-                batch_array = np.array(batch_images)
-                batch_array = preprocess_input(batch_array)
+        window = batch_size * config.CACHE_LOOKUP_BATCHES
+        num_workers = config.DECODE_WORKERS or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='image-hash') as pool:
+            for start in range(0, len(img_paths), window):
+                window_paths = img_paths[start:start + window]
+                hit_features, hit_paths, failed_paths = [], [], []
+                miss_keys = {}
                 
-                # Extract features
-                batch_features = self.model.predict(batch_array, verbose=0)
+                for img_path, key in zip(window_paths, pool.map(_file_hash, window_paths)):
+                    if key is None:
+                        print(f"Error loading {img_path}: cannot read file")
+                        failed_paths.append(img_path)
+                        continue
+                    digests[img_path] = key
+                    cached = self.cache.get(key)
+                    if cached is None:
+                        miss_keys[img_path] = key
+                    else:
+                        hit_features.append(cached)
+                        hit_paths.append(img_path)
+                        # Cache hits are never decoded, so their thumbnails come from the file
+                        if thumbnails is not None and thumbnails.missing_sizes(key):
+                            pool.submit(thumbnails.add_file, img_path, key)
                 
-                # Normalize each feature vector
-                for features in batch_features:
-                    features = features.flatten()
-                    features = features / np.linalg.norm(features)
-                    features_list.append(features)
+                if hit_paths or failed_paths:
+                    features = np.array(hit_features, dtype=np.float32).reshape(-1, self.feature_dim)
+                    yield features, hit_paths, failed_paths
+                
+                for features, batch_paths, failed in self._infer_batches(list(miss_keys), batch_size, thumbnails, digests):
+                    for img_path, vector in zip(batch_paths, features):
+                        self.cache.put(miss_keys[img_path], vector)
+                    yield features, batch_paths, failed
+    
+    def extract_features_batch(self, img_paths, batch_size=None, return_paths=False, verbose=True, progress=None,
+                               thumbnails=None, digests=None):
+        """
+        Extract features from multiple images in batches
+        
+        Args:
+            img_paths: List of image file paths
+            batch_size: Batch size for processing (default from config)
+            return_paths: Also return the paths that were extracted successfully
+            verbose: Print progress after each batch
+            progress: Optional callable(processed, total) run after each batch;
+                an exception it raises stops the extraction
+            thumbnails: Optional ThumbnailCache to write thumbnails to while decoding
+            digests: Optional dict, filled with the content hash of every file read
+            
+        Returns:
+            Array of feature vectors, or a tuple (features, extracted_paths)
+            if return_paths is set. Images that fail to load are skipped.
+        """
+        features_list = []
+        extracted_paths = []
+        total = len(img_paths)
+        processed = 0
+        
+        for batch_features, batch_paths, failed_paths in self.iter_features_batches(img_paths, batch_size, thumbnails, digests):
+            features_list.append(batch_features)
+            extracted_paths.extend(batch_paths)
+            processed += len(batch_paths) + len(failed_paths)
             
-            print(f"Processed {min(i + batch_size, total)}/{total} images")
+            if verbose:
+                print(f"Processed {processed}/{total} images")
+            if progress is not None:
+                progress(processed, total)
+        
+        if features_list:
+            features = np.concatenate(features_list)
+        else:
+            features = np.empty((0, self.feature_dim), dtype=np.float32)
         
-        return np.array(features_list)
+        if return_paths:
+            return features, extracted_paths
+        return features
 
 
 if __name__ == "__main__":
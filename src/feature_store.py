@@ -0,0 +1,299 @@
+"""
+Versioned binary feature store, opened with np.memmap.
+
+File layout (all integers little-endian):
+
+    [0, 4096)           header (see _HEADER), zero padded to one page
+                        version 2 adds the id of the backbone that produced
+                        the features; version 1 files are still read
+    [matrix_offset...)  float32 feature matrix, count x dim, row major
+    [paths_offset...)   uint64 path offsets table, count + 1 entries
+    [blob_offset...)    UTF-8 encoded paths, concatenated
+
+The matrix starts on a page boundary so the OS can map it directly: every
+process that opens the store shares one copy through the page cache and
+nothing is read from disk until a row is actually touched.
+"""
+import collections.abc
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import zlib
+
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from backbones import LEGACY_MODEL_ID
+
+
+MAGIC = b'ISSFEAT\x00'
+FORMAT_VERSION = 2
+HEADER_SIZE = 4096
+FEATURE_DTYPE = np.dtype('<f4')
+MODEL_ID_SIZE = 64
+
+# magic, format version, dim, count, dtype, matrix offset, paths offset,
+# blob offset, blob size, matrix crc32, paths crc32[, model id]
+_HEADERS = {
+    1: struct.Struct('<8sIIQ8sQQQQII'),
+    2: struct.Struct(f'<8sIIQ8sQQQQII{MODEL_ID_SIZE}s'),
+}
+_HEADER = _HEADERS[FORMAT_VERSION]
+_HEADER_PREFIX = struct.Struct('<8sI')
+_HEADER_CRC = struct.Struct('<I')
+
+
+class FeatureStoreError(Exception):
+    """Raised when a feature store file is missing, corrupt or unsupported"""
+
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class PathTable(collections.abc.Sequence):
+    """Read-only list of image paths decoded on demand from the store"""
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("path index out of range")
+
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return self._blob[start:end].tobytes().decode('utf-8')
+
+
+class FeatureStore:
+    """Memory-mapped, read-only view of a feature store file"""
+
+    def __init__(self, path=None, verify=None):
+        if path is None:
+            path = config.FEATURE_STORE_FILE
+        if verify is None:
+            verify = config.FEATURE_STORE_VERIFY
+
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+
+        if len(header) < _HEADER_PREFIX.size:
+            raise FeatureStoreError(f"{path}: truncated header")
+        magic, format_version = _HEADER_PREFIX.unpack_from(header)
+        if magic != MAGIC:
+            raise FeatureStoreError(f"{path}: not a feature store file")
+        if format_version not in _HEADERS:
+            raise FeatureStoreError(f"{path}: unsupported format version {format_version}")
+
+        header_struct = _HEADERS[format_version]
+        if len(header) < header_struct.size + _HEADER_CRC.size:
+            raise FeatureStoreError(f"{path}: truncated header")
+        (header_crc,) = _HEADER_CRC.unpack_from(header, header_struct.size)
+        if header_crc != zlib.crc32(header[:header_struct.size]):
+            raise FeatureStoreError(f"{path}: header checksum mismatch")
+
+        fields = header_struct.unpack_from(header)
+        (_, _, dim, count, dtype, matrix_offset, paths_offset,
+         blob_offset, blob_size, self.matrix_crc, self.paths_crc) = fields[:11]
+        # Backbone that produced the features; unknown for version 1 files
+        model = fields[11].rstrip(b'\x00').decode('utf-8') if len(fields) > 11 else ''
+        self.model = model or None
+        if np.dtype(dtype.rstrip(b'\x00').decode()) != FEATURE_DTYPE:
+            raise FeatureStoreError(f"{path}: unsupported feature dtype {dtype!r}")
+
+        expected_size = blob_offset + blob_size
+        if os.path.getsize(path) < expected_size:
+            raise FeatureStoreError(f"{path}: truncated file")
+
+        self.dim = dim
+        self.count = count
+
+        # np.memmap refuses zero-length mappings, so empty stores get empty arrays
+        if count:
+            self.features = np.memmap(path, dtype=FEATURE_DTYPE, mode='r',
+                                      offset=matrix_offset, shape=(count, dim))
+        else:
+            self.features = np.empty((0, dim), dtype=FEATURE_DTYPE)
+        offsets = np.memmap(path, dtype='<u8', mode='r',
+                            offset=paths_offset, shape=(count + 1,))
+        if blob_size:
+            blob = np.memmap(path, dtype=np.uint8, mode='r',
+                             offset=blob_offset, shape=(blob_size,))
+        else:
+            blob = np.empty(0, dtype=np.uint8)
+        self.paths = PathTable(offsets, blob)
+        self._offsets = offsets
+        self._blob = blob
+
+        if verify:
+            self.verify()
+
+    def verify(self, chunk_rows=65536):
+        """
+        Check the matrix and path table against their stored checksums
+
+        Reads the whole file, so this is opt-in rather than done on every load.
+        """
+        crc = 0
+        for start in range(0, self.count, chunk_rows):
+            crc = zlib.crc32(np.ascontiguousarray(self.features[start:start + chunk_rows]), crc)
+        if crc != self.matrix_crc:
+            raise FeatureStoreError(f"{self.path}: feature matrix checksum mismatch")
+
+        crc = zlib.crc32(np.ascontiguousarray(self._offsets))
+        crc = zlib.crc32(np.ascontiguousarray(self._blob), crc)
+        if crc != self.paths_crc:
+            raise FeatureStoreError(f"{self.path}: path table checksum mismatch")
+
+
+class FeatureStoreWriter:
+    """
+    Stream features and paths into a new store file
+
+    Rows are appended to a temporary file next to the target, which is only
+    moved into place by commit(). Readers of the previous file keep a valid
+    mapping until they reopen it.
+    """
+
+    def __init__(self, path, dim, model=None):
+        """
+        Args:
+            path: Store file to create or replace
+            dim: Feature vector dimension
+            model: Id of the backbone that produced the features, recorded in the header
+        """
+        self.path = path
+        self.dim = dim
+        self.model = model
+        if model is not None and len(model.encode('utf-8')) > MODEL_ID_SIZE:
+            raise ValueError(f"Model id too long: {model}")
+        self.count = 0
+        self._matrix_crc = 0
+        self._path_lengths = []
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self._file = os.fdopen(fd, 'w+b')
+        self._blob_file = tempfile.TemporaryFile(dir=directory)
+
+        self._file.write(b'\x00' * HEADER_SIZE)
+
+    def append(self, features, paths):
+        """
+        Append rows to the store
+
+        Args:
+            features: Array of feature vectors (N x dim)
+            paths: List of N image paths
+        """
+        features = np.ascontiguousarray(features, dtype=FEATURE_DTYPE)
+        if features.ndim != 2 or features.shape[1] != self.dim:
+            raise ValueError(f"Expected features of shape (N, {self.dim}), got {features.shape}")
+        if len(features) != len(paths):
+            raise ValueError("Number of features and paths must match")
+
+        self._file.write(features.tobytes())
+        self._matrix_crc = zlib.crc32(features, self._matrix_crc)
+        self.count += len(features)
+
+        for path in paths:
+            encoded = path.encode('utf-8')
+            self._blob_file.write(encoded)
+            self._path_lengths.append(len(encoded))
+
+    def commit(self):
+        """Write the path table and header, then atomically replace the target file"""
+        try:
+            paths_offset = _align(HEADER_SIZE + self.count * self.dim * FEATURE_DTYPE.itemsize, 8)
+            offsets = np.zeros(self.count + 1, dtype='<u8')
+            np.cumsum(self._path_lengths, out=offsets[1:])
+            blob_offset = paths_offset + offsets.nbytes
+            blob_size = int(offsets[-1])
+
+            self._file.write(b'\x00' * (paths_offset - self._file.tell()))
+            self._file.write(offsets.tobytes())
+            paths_crc = zlib.crc32(offsets)
+
+            self._blob_file.seek(0)
+            while True:
+                chunk = self._blob_file.read(1 << 20)
+                if not chunk:
+                    break
+                self._file.write(chunk)
+                paths_crc = zlib.crc32(chunk, paths_crc)
+
+            header = _HEADER.pack(MAGIC, FORMAT_VERSION, self.dim, self.count,
+                                  FEATURE_DTYPE.str.encode(), HEADER_SIZE, paths_offset,
+                                  blob_offset, blob_size, self._matrix_crc, paths_crc,
+                                  (self.model or '').encode('utf-8'))
+            header += _HEADER_CRC.pack(zlib.crc32(header))
+            self._file.seek(0)
+            self._file.write(header)
+
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._blob_file.close()
+            os.replace(self._tmp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Discard the partially written store"""
+        for f in (self._file, self._blob_file):
+            if not f.closed:
+                f.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def write_feature_store(features, image_paths, path=None, model=None):
+    """Write a complete feature matrix and its paths as a new store file"""
+    if path is None:
+        path = config.FEATURE_STORE_FILE
+    with FeatureStoreWriter(path, np.shape(features)[1], model) as writer:
+        writer.append(features, image_paths)
+
+
+def migrate_pickle_index():
+    """Convert a legacy pickle index (features + paths) into a feature store"""
+    with open(config.FEATURES_FILE, 'rb') as f:
+        features = pickle.load(f)
+    with open(config.IMAGE_PATHS_FILE, 'rb') as f:
+        image_paths = pickle.load(f)
+
+    # Pickle indexes predate the backbone registry and were always ResNet50
+    write_feature_store(features, image_paths, model=LEGACY_MODEL_ID)
+    print(f"Migrated {len(image_paths)} images to {config.FEATURE_STORE_FILE}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--migrate':
+        migrate_pickle_index()
+    else:
+        store = FeatureStore(verify=True)
+        print(f"Feature store OK: {store.count} images, {store.dim} dimensions, "
+              f"backbone {store.model or 'unknown'}")
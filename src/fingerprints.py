@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+
+
+def scan_image_files(directory):
+    """
+    Recursively list image files with their size and modification time
+
+    Only file metadata is read, never file contents.
+
+    Args:
+        directory: Root directory to search
+
+    Returns:
+        Dict mapping image path to (size in bytes, mtime in nanoseconds)
+    """
+    files = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def content_hash(path, chunk_size=1 << 20):
+    """Return a 128-bit BLAKE2b hex digest of a file's contents"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FingerprintStore:
+    """
+    Size, mtime and content hash of every indexed file
+
+    A file whose size and mtime are unchanged is assumed unchanged. When
+    they differ, the content hash decides whether the file really needs new
+    features (a copy or 'touch' keeps the hash). Entries without a hash
+    (e.g. from an index that predates fingerprints) are re-extracted as
+    soon as their metadata changes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else config.FINGERPRINTS_FILE
+        self.entries = {}
+
+    def load(self):
+        """Load fingerprints from disk, returning False if none were saved"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+            return True
+        except FileNotFoundError:
+            self.entries = {}
+            return False
+
+    def save(self):
+        """Write fingerprints to disk atomically"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def get(self, path):
+        """Return [size, mtime_ns, hash or None] for a path, or None"""
+        return self.entries.get(path)
+
+    def set(self, path, size, mtime_ns, digest=None):
+        self.entries[path] = [size, mtime_ns, digest]
+
+    def remove(self, path):
+        self.entries.pop(path, None)
+
+    def is_unchanged(self, path, size, mtime_ns):
+        """
+        Check whether a file still matches its fingerprint
+
+        Reads the file only when its metadata changed and a hash is known.
+        A matching hash refreshes the stored metadata.
+        """
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+
+        old_size, old_mtime_ns, old_digest = entry
+        if old_size == size and old_mtime_ns == mtime_ns:
+            return True
+        if old_digest is None or old_size != size:
+            return False
+
+        if content_hash(path) == old_digest:
+            self.set(path, size, mtime_ns, old_digest)
+            return True
+        return False
+
+
+class ExclusionList:
+    """
+    Files deliberately left out of the index, e.g. pruned near-duplicates
+
+    Each entry keeps the file's size and mtime from when it was excluded.
+    Builds and syncs skip an excluded file for as long as those match; one
+    that was modified since is indexed again like a new file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else config.EXCLUDED_FILE
+        self.entries = {}
+
+    def load(self):
+        """Load the list from disk, returning False if none was saved"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+            return True
+        except FileNotFoundError:
+            self.entries = {}
+            return False
+
+    def save(self):
+        """Write the list to disk atomically"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def add(self, path):
+        stat = os.stat(path)
+        self.entries[path] = [stat.st_size, stat.st_mtime_ns]
+
+    def remove(self, path):
+        self.entries.pop(path, None)
+
+    def is_excluded(self, path, size, mtime_ns):
+        """Check whether a file is excluded and unchanged since"""
+        return self.entries.get(path) == [size, mtime_ns]
@@ -0,0 +1,137 @@
+from collections import deque
+import io
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import sys
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Reduce TensorFlow logging
+from keras.utils import load_img, img_to_array
+from PIL import Image
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from backbones import get_backbone
+from embedding_cache import bytes_hash
+
+
+def load_image_array(img_path, target_size=None, thumbnails=None, digests=None):
+    """
+    Decode an image and resize it to the model input size
+
+    Args:
+        img_path: Path to the image file
+        target_size: (height, width) to resize to (default: the configured backbone's)
+        thumbnails: Optional ThumbnailCache to write the image's missing
+            thumbnails to, from the same full-size decode
+        digests: Optional dict of file content hashes. A hash it holds for
+            img_path is reused; otherwise the file is hashed from the bytes
+            read for decoding and the hash is added, so it is read only once.
+
+    Returns:
+        float32 array of shape (height, width, 3)
+    """
+    if target_size is None:
+        target_size = get_backbone().image_size()
+    if thumbnails is None and digests is None:
+        return img_to_array(load_img(img_path, target_size=target_size))
+
+    with open(img_path, 'rb') as f:
+        data = f.read()
+    digest = digests.get(img_path) if digests is not None else None
+    if digest is None:
+        digest = bytes_hash(data)
+        if digests is not None:
+            digests[img_path] = digest
+
+    img = load_img(io.BytesIO(data))
+    if thumbnails is not None:
+        thumbnails.add_decoded(img_path, img, digest)
+    # The same nearest-neighbour resize load_img(target_size=...) does
+    width_height = (target_size[1], target_size[0])
+    if img.size != width_height:
+        img = img.resize(width_height, Image.NEAREST)
+    return img_to_array(img)
+
+
+def decode_image_bytes(data, target_size=None):
+    """
+    Decode an in-memory image (e.g. an upload) without touching the disk
+
+    Args:
+        data: Encoded image file contents
+        target_size: (height, width) to resize to (default: the configured backbone's)
+
+    Returns:
+        float32 array of shape (height, width, 3)
+    """
+    return load_image_array(io.BytesIO(data), target_size)
+
+
+def iter_image_batches(img_paths, batch_size=None, num_workers=None, prefetch_batches=None,
+                       target_size=None, thumbnails=None, digests=None):
+    """
+    Decode images on a thread pool and yield them in batches, in input order
+
+    Decoding runs ahead of the consumer by up to prefetch_batches batches, so
+    while the caller runs the model on one batch the pool is already
+    decoding the next ones. PIL releases the GIL while decoding and
+    resizing, so throughput scales with the number of workers.
+
+    Args:
+        img_paths: List of image file paths
+        batch_size: Images per yielded batch (default from config)
+        num_workers: Decoder threads (default from config, or the CPU count)
+        prefetch_batches: Batches decoded ahead of the consumer (default from config)
+        target_size: (height, width) to resize to (default: the configured backbone's)
+        thumbnails: Optional ThumbnailCache to write thumbnails to while decoding
+        digests: Optional dict of content hashes, reused and filled while decoding
+
+    Yields:
+        Tuples of (image array (N x H x W x 3), decoded paths, paths that
+        failed to decode since the previous batch)
+    """
+    if batch_size is None:
+        batch_size = config.BATCH_SIZE
+    if num_workers is None:
+        num_workers = config.DECODE_WORKERS or os.cpu_count() or 1
+    if prefetch_batches is None:
+        prefetch_batches = config.PREFETCH_BATCHES
+    if target_size is None:
+        target_size = get_backbone().image_size()
+
+    max_pending = batch_size * (prefetch_batches + 1)
+    paths = iter(img_paths)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='image-decode') as pool:
+        def fill():
+            for img_path in paths:
+                pending.append((img_path, pool.submit(load_image_array, img_path, target_size, thumbnails, digests)))
+                if len(pending) >= max_pending:
+                    break
+
+        fill()
+        batch_images = []
+        batch_paths = []
+        failed_paths = []
+
+        while pending:
+            img_path, future = pending.popleft()
+            try:
+                batch_images.append(future.result())
+                batch_paths.append(img_path)
+            except Exception as e:
+                print(f"Error loading {img_path}: {str(e)}")
+                failed_paths.append(img_path)
+
+            # Keep the pool busy before handing a batch to the consumer
+            if len(pending) < max_pending - batch_size:
+                fill()
+
+            if len(batch_images) == batch_size:
+                yield np.array(batch_images), batch_paths, failed_paths
+                batch_images = []
+                batch_paths = []
+                failed_paths = []
+
+        if batch_images or failed_paths:
+            yield np.array(batch_images), batch_paths, failed_paths
@@ -0,0 +1,404 @@
+"""
+Indexing jobs run in the background of the search server.
+
+A job syncs a directory, rebuilds the index from one, or adds a list of
+files. Jobs wait in a priority queue and run one at a time on a worker
+thread: they all rewrite the same index files, so they are serialized
+within the process by the queue and across server processes by a file
+lock. Image decoding runs at a lower scheduling priority. Inference runs
+on TensorFlow's shared thread pool at normal priority, so the job pauses
+between batches to leave search requests most of the CPU.
+
+Each job's state is kept in a JSON file under INDEX_JOBS_DIR. That way
+any server process can report or cancel a job, whichever one runs it.
+When a job succeeds, the index version file is rewritten and every
+server process reloads the index.
+"""
+import heapq
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from metrics import Counter, Gauge
+
+try:
+    import fcntl
+except ImportError:
+    # Windows servers run a single process, so the in-process queue is enough
+    fcntl = None
+
+
+JOBS = Counter('index_jobs_total', 'Indexing jobs finished, by outcome', ['state'])
+QUEUED = Gauge('index_jobs_queued', 'Indexing jobs waiting to run in this process')
+
+# A job replaces index files that the served index keeps memory-mapped. POSIX
+# systems keep the old mappings valid; Windows refuses to replace a mapped file.
+JOBS_SUPPORTED = os.name != 'nt'
+
+JOB_KINDS = ('sync', 'build', 'add')
+FINISHED_STATES = ('succeeded', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """Raised from a job's progress callback once the job was cancelled"""
+
+
+def _job_path(job_id):
+    return os.path.join(config.INDEX_JOBS_DIR, f"{job_id}.json")
+
+
+def _cancel_path(job_id):
+    return os.path.join(config.INDEX_JOBS_DIR, f"{job_id}.cancel")
+
+
+def _valid_id(job_id):
+    """Job ids are uuid4 hex strings; anything else never names a file"""
+    return len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_job(job_id):
+    """
+    Read a job's last saved state
+
+    Returns:
+        Job dict, or None if there is no such job
+    """
+    if not _valid_id(job_id):
+        return None
+    try:
+        with open(_job_path(job_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def list_jobs(limit=None):
+    """Saved jobs of all server processes, newest first"""
+    if not os.path.isdir(config.INDEX_JOBS_DIR):
+        return []
+    jobs = []
+    for name in os.listdir(config.INDEX_JOBS_DIR):
+        if name.endswith('.json'):
+            job = load_job(name[:-len('.json')])
+            if job is not None:
+                jobs.append(job)
+    jobs.sort(key=lambda job: job['created'], reverse=True)
+    return jobs[:limit] if limit is not None else jobs
+
+
+def prune_jobs(keep=None):
+    """Delete the records of finished jobs beyond the newest keep"""
+    if keep is None:
+        keep = config.INDEX_JOBS_KEPT
+    finished = [job for job in list_jobs() if job['state'] in FINISHED_STATES]
+    for job in finished[keep:]:
+        for path in (_job_path(job['id']), _cancel_path(job['id'])):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def index_version():
+    """
+    Identify the last index written by a job
+
+    Returns:
+        Modification time (ns) of the index version file, or None if no job has finished
+    """
+    try:
+        return os.stat(config.INDEX_VERSION_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def mark_index_changed(job_id=None):
+    """Tell every server process the index files were replaced (by a job, or by a tool if job_id is None)"""
+    _write_json(config.INDEX_VERSION_FILE, {'job': job_id, 'time': time.time()})
+
+
+class IndexLock:
+    """
+    Lock on the index files, shared between processes
+
+    A job holds it exclusively while it runs; servers take it shared
+    while they reload, so they never read files a job is rewriting.
+    """
+
+    def __init__(self, shared=False):
+        self.shared = shared
+
+    def __enter__(self):
+        self._file = open(config.INDEX_LOCK_FILE, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        return False
+
+
+class IndexJob:
+    """One indexing request and its progress"""
+
+    def __init__(self, kind, directory=None, paths=None, priority=0):
+        """
+        Args:
+            kind: 'sync' (apply changes in directory), 'build' (rebuild from
+                directory) or 'add' (append paths)
+            directory: Image directory for 'sync' and 'build'
+            paths: Image files for 'add'
+            priority: Jobs with a higher priority run first
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.directory = directory
+        self.paths = list(paths) if paths is not None else None
+        self.priority = priority
+        self.state = 'queued'
+        self.processed = 0
+        self.total = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._saved = 0.0
+        self._resumed = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'directory': self.directory,
+            'paths': len(self.paths) if self.paths is not None else None,
+            'priority': self.priority,
+            'state': self.state,
+            'processed': self.processed,
+            'total': self.total,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'pid': os.getpid(),
+        }
+
+    def save(self):
+        _write_json(_job_path(self.id), self.to_dict())
+        self._saved = time.monotonic()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def cancelled(self):
+        """Whether this process or another one asked to cancel the job"""
+        return self._cancel.is_set() or os.path.exists(_cancel_path(self.id))
+
+    def start(self):
+        self.state = 'running'
+        self.started = time.time()
+        self._resumed = time.monotonic()
+        self.save()
+
+    def finish(self, state, error=None):
+        self.state = state
+        self.error = error
+        self.finished = time.time()
+        self.save()
+        if os.path.exists(_cancel_path(self.id)):
+            os.remove(_cancel_path(self.id))
+        JOBS.labels(state).inc()
+
+    def progress(self, processed, total):
+        """
+        Progress callback for ImageIndexer, run after each extracted batch
+
+        Records the progress (saved at most once per second), stops the
+        job if it was cancelled, and pauses long enough to keep the job's
+        share of wall time at INDEX_JOB_CPU_SHARE.
+
+        Raises:
+            JobCancelled: If the job was cancelled
+        """
+        self.processed, self.total = processed, total
+        now = time.monotonic()
+        if now - self._saved >= 1.0:
+            self.save()
+        if self.cancelled():
+            raise JobCancelled()
+
+        share = config.INDEX_JOB_CPU_SHARE
+        if 0 < share < 1:
+            pause = (now - self._resumed) * (1 - share) / share
+            if self._cancel.wait(pause):
+                raise JobCancelled()
+        self._resumed = time.monotonic()
+
+
+class IndexJobQueue:
+    """Priority queue of indexing jobs with a background worker"""
+
+    def __init__(self, run, on_success=None):
+        """
+        Args:
+            run: Callable(job) that does the work, calling job.progress() as it
+                goes; returns a result, or a false value if the job failed
+            on_success: Optional callable(job, result), run after the index
+                version file was updated
+        """
+        self.run = run
+        self.on_success = on_success
+        self._heap = []
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        os.makedirs(config.INDEX_JOBS_DIR, exist_ok=True)
+        QUEUED.set_function(lambda: len(self._heap))
+
+    def submit(self, kind, directory=None, paths=None, priority=0):
+        """
+        Queue a job
+
+        Returns:
+            The IndexJob
+        """
+        job = IndexJob(kind, directory, paths, priority)
+        job.save()
+        prune_jobs()
+        with self._cond:
+            heapq.heappush(self._heap, (-priority, next(self._seq), job))
+            self._jobs[job.id] = job
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name='index-jobs', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return job
+
+    def get(self, job_id):
+        """State of a job run by any server process, or None"""
+        job = self._jobs.get(job_id)
+        return job.to_dict() if job is not None else load_job(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job
+
+        A running job stops after its current batch, before it writes the
+        index; one that is already writing the index finishes.
+
+        Returns:
+            The job's state, or None if there is no such job
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.cancel()
+                if job.state == 'queued':
+                    job.finish('cancelled')
+                return job.to_dict()
+
+        job = load_job(job_id)
+        if job is not None and job['state'] not in FINISHED_STATES:
+            # Owned by another process, which checks for this file between batches
+            open(_cancel_path(job_id), 'w').close()
+        return job
+
+    def _worker(self):
+        self._lower_priority()
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, job = heapq.heappop(self._heap)
+            try:
+                if job.state != 'queued':
+                    continue
+                if job.cancelled():
+                    job.finish('cancelled')
+                else:
+                    with IndexLock():
+                        self._run(job)
+            finally:
+                with self._cond:
+                    self._jobs.pop(job.id, None)
+
+    def _lower_priority(self):
+        """
+        Raise this thread's niceness; threads it starts (image decoding) inherit it on Linux
+
+        Inference is not affected: it runs on TensorFlow's intra-op pool, which
+        already exists and is shared with searches. Only the pauses in
+        IndexJob.progress() bound the job's share of that.
+        """
+        if not config.INDEX_JOB_NICE:
+            return
+        try:
+            tid = threading.get_native_id()
+            os.setpriority(os.PRIO_PROCESS, tid, os.getpriority(os.PRIO_PROCESS, tid) + config.INDEX_JOB_NICE)
+        except (AttributeError, OSError):
+            # Per-thread priorities are Linux only
+            pass
+
+    def _run(self, job):
+        job.start()
+        print(f"Index job {job.id} ({job.kind}) started")
+        try:
+            result = self.run(job)
+        except JobCancelled:
+            job.finish('cancelled')
+            print(f"Index job {job.id} cancelled")
+            return
+        except Exception as e:
+            job.finish('failed', str(e))
+            print(f"Index job {job.id} failed: {str(e)}")
+            return
+
+        if not result:
+            job.finish('failed', 'Indexing failed, see the server log')
+            return
+
+        mark_index_changed(job.id)
+        if self.on_success is not None:
+            self.on_success(job, result)
+        job.finish('succeeded')
+        print(f"Index job {job.id} finished")
+
+
+def run_index_job(job, feature_extractor=None):
+    """
+    Do the work of a job with an ImageIndexer
+
+    Args:
+        job: IndexJob
+        feature_extractor: Extractor to share, e.g. the server's loaded model
+
+    Returns:
+        The SimilaritySearch holding the new index, or None if indexing failed
+    """
+    # Imported here so the server does not load TensorFlow before it needs to
+    from indexer import ImageIndexer
+
+    indexer = ImageIndexer(feature_extractor, progress=job.progress)
+    if job.kind == 'build':
+        ok = indexer.build_index(job.directory)
+    elif job.kind == 'sync':
+        ok = indexer.sync_index(job.directory)
+    else:
+        ok = indexer.add_images_to_index(job.paths)
+    return indexer.similarity_search if ok else None
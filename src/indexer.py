@@ -1,19 +1,31 @@
 import os
 import sys
-import glob
 from pathlib import Path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
 from feature_extractor import FeatureExtractor
 from similarity_search import SimilaritySearch
+from build_checkpoint import BuildCheckpoint
+from fingerprints import ExclusionList, FingerprintStore, scan_image_files
+from thumbnails import ThumbnailCache
 
 
 class ImageIndexer:
     """Index images by extracting and storing their features"""
     
-    def __init__(self):
-        self.feature_extractor = FeatureExtractor()
+    def __init__(self, feature_extractor=None, progress=None):
+        """
+        Args:
+            feature_extractor: Extractor to reuse, e.g. the one a running server
+                already loaded (default: a new one)
+            progress: Optional callable(processed, total) run after each extracted
+                batch; an exception it raises aborts the indexing run before the
+                index is written
+        """
+        self.feature_extractor = feature_extractor if feature_extractor is not None else FeatureExtractor()
         self.similarity_search = SimilaritySearch()
+        self.progress = progress
+        self.thumbnails = ThumbnailCache() if config.THUMBNAILS else None
     
     def get_image_files(self, directory):
         """
@@ -25,51 +37,98 @@ class ImageIndexer:
         Returns:
             List of image file paths
         """
-        extensions = ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.bmp']
-        image_files = []
-        
-        for ext in extensions:
-            pattern = os.path.join(directory, '**', ext)
-            image_files.extend(glob.glob(pattern, recursive=True))
-        
-        # Also check uppercase extensions
-        for ext in extensions:
-            pattern = os.path.join(directory, '**', ext.upper())
-            image_files.extend(glob.glob(pattern, recursive=True))
-        
-        return sorted(list(set(image_files)))
+        return sorted(scan_image_files(directory))
     
-    def build_index(self, image_directory):
+    def build_index(self, image_directory, resume=True):
         """
         Build feature index for all images in directory
         
+        Features are streamed to checkpoint shards as they are extracted, so
+        memory use does not grow with the number of images and an interrupted
+        build can continue where it stopped.
+        
         Args:
             image_directory: Directory containing images to index
+            resume: Continue from the checkpoint of an interrupted build
             
         Returns:
             True if successful, False otherwise
         """
         print(f"Scanning for images in: {image_directory}")
-        image_paths = self.get_image_files(image_directory)
+        on_disk = scan_image_files(image_directory)
+        excluded = ExclusionList()
+        excluded.load()
+        image_paths = sorted(path for path, (size, mtime_ns) in on_disk.items()
+                             if not excluded.is_excluded(path, size, mtime_ns))
         
         if not image_paths:
             print(f"No images found in {image_directory}")
             return False
         
         print(f"Found {len(image_paths)} images")
+        if len(image_paths) < len(on_disk):
+            print(f"Skipping {len(on_disk) - len(image_paths)} excluded images")
+        
+        model = self.feature_extractor.backbone.model_id
+        checkpoint = BuildCheckpoint()
+        if resume and checkpoint.load(image_directory, model):
+            image_paths = checkpoint.pending(image_paths)
+            print(f"Resuming build: {checkpoint.count} images already extracted, {len(image_paths)} remaining")
+        else:
+            checkpoint.reset(image_directory, model)
+        
         print("Extracting features...")
         
-        # Extract features for all images
-        features = self.feature_extractor.extract_features_batch(image_paths)
+        # Extract features, checkpointing every SHARD_SIZE images
+        total = len(image_paths)
+        processed = 0
+        # Content hashes for the fingerprints, from the reads extraction does anyway
+        digests = {}
+        for features, batch_paths, failed_paths in self.feature_extractor.iter_features_batches(
+                image_paths, thumbnails=self.thumbnails, digests=digests):
+            checkpoint.add(features, batch_paths, failed_paths)
+            processed += len(batch_paths) + len(failed_paths)
+            print(f"Processed {processed}/{total} images")
+            if self.progress is not None:
+                self.progress(processed, total)
         
-        if len(features) == 0:
+        checkpoint.flush()
+        
+        if checkpoint.count == 0:
             print("Failed to extract features from any images")
+            checkpoint.remove()
             return False
         
-        print(f"Successfully extracted features from {len(features)} images")
+        print(f"Successfully extracted features from {checkpoint.count} images")
+        
+        # Merge the shards into the index, reduced by PCA if configured
+        dim = next(checkpoint.iter_shards())[0].shape[1]
+        if config.PCA_DIM:
+            try:
+                self.similarity_search.fit_projection(checkpoint.iter_shards(), checkpoint.count)
+            except ValueError as e:
+                # e.g. fewer images than PCA_DIM
+                print(f"Warning: {str(e)}, storing full-width features instead")
+                self.similarity_search.clear_projection()
+        else:
+            self.similarity_search.clear_projection()
+        if not self.similarity_search.save_index_batches(checkpoint.iter_shards(), dim, model=model):
+            return False
+        self.similarity_search.build_ann_index()
+        if config.QUANTIZATION:
+            self.similarity_search.build_quantized_index()
+        if config.KNN_GRAPH:
+            self.similarity_search.build_knn_graph()
+        self.similarity_search.build_metadata(on_disk)
+        checkpoint.remove()
         
-        # Save index
-        self.similarity_search.save_index(features, image_paths)
+        # Fingerprint the indexed files so sync_index() can skip them later.
+        # Files extracted before a resume have no hash and are re-checked by size/mtime only.
+        fingerprints = FingerprintStore()
+        for path in self.similarity_search.image_paths:
+            size, mtime_ns = on_disk.get(path, (None, None))
+            fingerprints.set(path, size, mtime_ns, digests.get(path))
+        fingerprints.save()
         
         print("Index building complete!")
         return True
@@ -78,42 +137,155 @@ class ImageIndexer:
         """
         Add new images to existing index
         
+        Paths that are already indexed are extracted again and replace
+        their old rows, as a sync does for changed files.
+        
         Args:
             new_image_paths: List of new image paths to add
             
         Returns:
             True if successful, False otherwise
         """
-        # Load existing index
-        if not self.similarity_search.load_index():
+        # Load existing index, which must come from the same backbone
+        if not self.similarity_search.load_index(self.feature_extractor.backbone.model_id):
             print("No existing index found. Use build_index() instead.")
             return False
         
         # Extract features for new images
+        new_image_paths = list(dict.fromkeys(new_image_paths))
         print(f"Adding {len(new_image_paths)} new images to index...")
-        new_features = self.feature_extractor.extract_features_batch(new_image_paths)
+        digests = {}
+        new_features, new_image_paths = self.feature_extractor.extract_features_batch(
+            new_image_paths, return_paths=True, progress=self.progress, thumbnails=self.thumbnails, digests=digests
+        )
         
         if len(new_features) == 0:
             print("Failed to extract features from new images")
             return False
         
-        # Combine with existing features
-        import numpy as np
-        combined_features = np.vstack([
-            self.similarity_search.features,
-            new_features
-        ])
-        combined_paths = self.similarity_search.image_paths + new_image_paths
+        # Append to the stored features, keeping existing row ids
+        live_rows = self.similarity_search.live_rows()
+        delete_ids = [live_rows[path] for path in new_image_paths if path in live_rows]
+        if not self.similarity_search.append_to_index(new_features, new_image_paths, delete_ids):
+            return False
         
-        # Save updated index
-        self.similarity_search.save_index(combined_features, combined_paths)
+        # Record fingerprints so the next sync treats these files as indexed
+        fingerprints = FingerprintStore()
+        fingerprints.load()
+        excluded = ExclusionList()
+        has_exclusions = excluded.load()
+        for path in new_image_paths:
+            stat = os.stat(path)
+            fingerprints.set(path, stat.st_size, stat.st_mtime_ns, digests[path])
+            # Adding an excluded file by name takes it back into the index
+            excluded.remove(path)
+        fingerprints.save()
+        if has_exclusions:
+            excluded.save()
         
-        print(f"Added {len(new_features)} images. Total images: {len(combined_paths)}")
+        print(f"Added {len(new_features)} images. Total images: {self.similarity_search.num_images}")
+        return True
+    
+    def sync_index(self, image_directory=None):
+        """
+        Bring the index in line with the image directory without a full rebuild
+        
+        The directory is rescanned using file metadata only. New files and
+        files whose contents changed are re-extracted; changed and deleted
+        files are tombstoned, and the index is compacted once the deleted
+        fraction exceeds COMPACTION_THRESHOLD. Syncing a subdirectory of
+        the indexed images only touches the images inside it.
+        
+        Args:
+            image_directory: Directory containing images (default from config)
+            
+        Returns:
+            True if successful, False otherwise
+        """
+        if image_directory is None:
+            image_directory = config.DATA_DIR
+        
+        if not self.similarity_search.load_index(self.feature_extractor.backbone.model_id):
+            print("No usable index found, building a new one.")
+            return self.build_index(image_directory)
+        
+        print(f"Scanning for changes in: {image_directory}")
+        on_disk = scan_image_files(image_directory)
+        fingerprints = FingerprintStore()
+        has_fingerprints = fingerprints.load()
+        excluded = ExclusionList()
+        has_exclusions = excluded.load()
+        live_rows = self.similarity_search.live_rows()
+        
+        to_extract = []
+        for path, (size, mtime_ns) in on_disk.items():
+            if path not in live_rows and excluded.is_excluded(path, size, mtime_ns):
+                continue
+            if path not in live_rows:
+                to_extract.append(path)
+            elif not has_fingerprints and fingerprints.get(path) is None:
+                # Index predates fingerprints: adopt the file as it is now
+                fingerprints.set(path, size, mtime_ns)
+            elif not fingerprints.is_unchanged(path, size, mtime_ns):
+                to_extract.append(path)
+        
+        # Images indexed from outside the scanned directory are left alone
+        prefix = os.path.join(os.path.normpath(image_directory), '')
+        removed = [path for path in live_rows if path not in on_disk and os.path.normpath(path).startswith(prefix)]
+        changed = [path for path in to_extract if path in live_rows]
+        delete_ids = [live_rows[path] for path in removed + changed]
+        for path in removed:
+            fingerprints.remove(path)
+        for path in list(excluded.entries):
+            if path not in on_disk and os.path.normpath(path).startswith(prefix):
+                excluded.remove(path)
+        
+        print(f"{len(to_extract) - len(changed)} new, {len(changed)} changed, {len(removed)} deleted")
+        
+        if to_extract:
+            digests = {}
+            new_features, new_paths = self.feature_extractor.extract_features_batch(
+                sorted(to_extract), return_paths=True, progress=self.progress, thumbnails=self.thumbnails,
+                digests=digests
+            )
+            for path in new_paths:
+                size, mtime_ns = on_disk[path]
+                fingerprints.set(path, size, mtime_ns, digests[path])
+                # Modified since it was excluded, so it is indexed again
+                excluded.remove(path)
+            
+            # Changed files that no longer decode lose their old entry too
+            extracted = set(new_paths)
+            for path in to_extract:
+                if path not in extracted:
+                    fingerprints.remove(path)
+            
+            if len(new_features):
+                if not self.similarity_search.append_to_index(new_features, new_paths, delete_ids):
+                    return False
+            elif delete_ids:
+                self.similarity_search.delete_from_index(delete_ids)
+        elif delete_ids:
+            self.similarity_search.delete_from_index(delete_ids)
+        
+        if self.similarity_search.deleted_fraction() > config.COMPACTION_THRESHOLD:
+            if not self.similarity_search.compact_index():
+                return False
+        
+        fingerprints.save()
+        if has_exclusions:
+            excluded.save()
+        print(f"Sync complete! Total images: {self.similarity_search.num_images}")
         return True
 
 
 def main():
     """Main function to build index from data directory"""
+    # An interrupted build is resumed unless --restart is given;
+    # --sync only processes files added, changed or deleted since the last run
+    resume = '--restart' not in sys.argv[1:]
+    sync = '--sync' in sys.argv[1:]
+    
     indexer = ImageIndexer()
     
     # Build index from data directory
@@ -124,7 +296,10 @@ def main():
         print("Please create the directory and add images to it.")
         return
     
-    indexer.build_index(data_dir)
+    if sync:
+        indexer.sync_index(data_dir)
+    else:
+        indexer.build_index(data_dir, resume=resume)
 
 
 if __name__ == "__main__":
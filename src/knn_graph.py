@@ -0,0 +1,203 @@
+import numpy as np
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from exact_search import ExactSearch, select_top_k_rows
+
+
+def graph_dtype(k):
+    """One record per image: neighbour ids (int32, -1 = empty) and scores (float16), best first"""
+    return np.dtype([('ids', '<i4', (k,)), ('scores', '<f2', (k,))])
+
+
+def _drop_self(row_ids, ids, scores, k):
+    """Remove each row's own id from its k + 1 neighbours, keeping k"""
+    is_self = ids == row_ids[:, None]
+    # A stable sort moves the self match (if any) to the end and keeps the rest in order
+    order = np.argsort(is_self, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def _to_records(ids, scores, k):
+    """Pack (N x k) neighbour arrays into graph records, padding missing entries"""
+    records = np.empty(len(ids), dtype=graph_dtype(k))
+    records['ids'] = -1
+    records['scores'] = -np.inf
+    valid = np.isfinite(scores)
+    n = ids.shape[1]
+    records['ids'][:, :n] = np.where(valid, ids, -1)
+    records['scores'][:, :n] = np.where(valid, scores, -np.inf)
+    return records
+
+
+def _neighbor_records(features, rows, k, deleted=None, block_size=None):
+    """Neighbour records of sorted rows, against the whole index"""
+    if block_size is None:
+        block_size = config.SEARCH_QUERY_BLOCK_SIZE
+
+    search = ExactSearch(features, deleted=deleted)
+    records = np.empty(len(rows), dtype=graph_dtype(k))
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        # Contiguous rows are read as one slice of the memory-mapped store
+        if block[-1] - block[0] == len(block) - 1:
+            queries = np.asarray(features[block[0]:block[-1] + 1])
+        else:
+            queries = np.asarray(features[block])
+        ids, scores = search.search_batch(queries, k + 1)
+        ids, scores = _drop_self(block, ids, scores, k)
+        records[start:start + len(block)] = _to_records(ids, scores, k)
+        print(f"k-NN graph: {start + len(block)}/{len(rows)} images")
+    return records
+
+
+class KNNGraph:
+    """
+    Precomputed k nearest neighbours of every indexed image
+
+    Stored as a .npy array of fixed-size records next to the feature store
+    and memory-mapped, so looking up an image's neighbours reads a single
+    record instead of scanning the index.
+    """
+
+    def __init__(self, records):
+        self.records = records
+
+    @property
+    def k(self):
+        return self.records.dtype['ids'].shape[0]
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def build(cls, features, k=None, deleted=None, block_size=None):
+        """
+        Compute the graph with blocked matrix products over the whole index
+
+        Args:
+            features: Array of L2-normalized feature vectors (N x D)
+            k: Neighbours kept per image (default from config)
+            deleted: Optional boolean mask of rows that are not neighbours
+            block_size: Images whose neighbours are computed per pass (default from config)
+        """
+        if k is None:
+            k = config.KNN_GRAPH_K
+        return cls(_neighbor_records(features, np.arange(len(features)), k, deleted, block_size))
+
+    def neighbors(self, row, top_k, deleted=None):
+        """
+        Look up the stored neighbours of one image
+
+        Args:
+            row: Row id of the image
+            top_k: Number of neighbours wanted (at most k)
+            deleted: Optional boolean mask of rows deleted since the build
+
+        Returns:
+            Tuple of (row ids, similarity scores), best match first
+        """
+        record = self.records[row]
+        ids = record['ids'].astype(np.int64)
+        scores = record['scores'].astype(np.float32)
+        keep = ids >= 0
+        if deleted is not None:
+            keep[keep] = ~deleted[ids[keep]]
+        return ids[keep][:top_k], scores[keep][:top_k]
+
+    def add(self, features, start_id, deleted=None, chunk_size=None, block_size=None):
+        """
+        Add rows start_id.. of features, which must already contain them
+
+        New images get their neighbours from the whole index, and every
+        existing image's list is merged with its matches among the new
+        ones, so the result equals a full rebuild.
+        """
+        if chunk_size is None:
+            chunk_size = config.SEARCH_CHUNK_SIZE
+        if block_size is None:
+            block_size = config.SEARCH_QUERY_BLOCK_SIZE
+        k = self.k
+        new_ids = np.arange(start_id, len(features))
+        records = np.concatenate([np.asarray(self.records),
+                                  np.empty(len(new_ids), dtype=self.records.dtype)])
+
+        # Existing rows: merge the current lists with their best matches among
+        # each block of new rows, holding one (chunk x block) score matrix at a time
+        for block_start in range(start_id, len(features), block_size):
+            block_ids = new_ids[block_start - start_id:block_start - start_id + block_size]
+            block = np.asarray(features[block_ids[0]:block_ids[-1] + 1])
+            alive = None if deleted is None else ~deleted[block_ids]
+            rows_per_chunk = max(1, chunk_size * 16 // len(block))
+
+            for start in range(0, start_id, rows_per_chunk):
+                end = min(start + rows_per_chunk, start_id)
+                scores = np.asarray(features[start:end]) @ block.T
+                if alive is not None:
+                    scores[:, ~alive] = -np.inf
+                top = select_top_k_rows(scores, k)
+                merged_ids = np.concatenate([records['ids'][start:end].astype(np.int64), block_ids[top]], axis=1)
+                merged_scores = np.concatenate([records['scores'][start:end].astype(np.float32),
+                                                np.take_along_axis(scores, top, axis=1)], axis=1)
+                top = select_top_k_rows(merged_scores, k)
+                records[start:end] = _to_records(np.take_along_axis(merged_ids, top, axis=1),
+                                                 np.take_along_axis(merged_scores, top, axis=1), k)
+
+        # New rows: search the whole index, which already includes them
+        records[start_id:] = _neighbor_records(features, new_ids, k, deleted)
+        self.records = records
+
+    def compact(self, keep, features=None, block_size=None):
+        """
+        Drop removed rows and renumber the remaining ids after compaction
+
+        Args:
+            keep: Boolean mask of the rows that remain
+            features: The compacted features; if given, images that lost
+                neighbours get their lists recomputed, so they stay full
+            block_size: Images whose neighbours are computed per pass (default from config)
+        """
+        new_ids = np.cumsum(keep) - 1
+        records = np.asarray(self.records)[keep]
+        ids = records['ids'].astype(np.int64)
+        scores = records['scores'].astype(np.float32)
+
+        valid = ids >= 0
+        valid[valid] = keep[ids[valid]]
+        ids = np.where(valid, new_ids[np.maximum(ids, 0)], -1)
+        scores = np.where(valid, scores, -np.inf)
+
+        # Removed neighbours leave gaps; move the remaining ones to the front
+        order = np.argsort(~valid, axis=1, kind='stable')
+        self.records = _to_records(np.take_along_axis(ids, order, axis=1),
+                                   np.take_along_axis(scores, order, axis=1), self.k)
+
+        if features is not None:
+            stale = np.flatnonzero((valid != (records['ids'] >= 0)).any(axis=1))
+            if len(stale):
+                self.records[stale] = _neighbor_records(features, stale, self.k, block_size=block_size)
+
+    def save(self, path=None):
+        """Save the graph atomically"""
+        if path is None:
+            path = config.KNN_GRAPH_FILE
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.records)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=None):
+        """Memory-map a graph saved with save()"""
+        if path is None:
+            path = config.KNN_GRAPH_FILE
+        return cls(np.load(path, mmap_mode='r'))
+
+
+if __name__ == "__main__":
+    from similarity_search import SimilaritySearch
+
+    searcher = SimilaritySearch()
+    if searcher.load_index():
+        searcher.build_knn_graph()
@@ -0,0 +1,375 @@
+"""
+Per-image metadata and the attribute indexes used to filter searches.
+
+One row per feature store row, stored column-wise in models/metadata.npz:
+
+    directory   folder relative to DATA_DIR ('' for the top level), as a
+                code into a sorted vocabulary
+    extension   lower-case file extension, as a code into a vocabulary
+    mtime       modification time, Unix seconds
+    size        file size in bytes
+    width       image width in pixels (0 if the header could not be read)
+    height      image height in pixels
+
+Every column is saved with its stable argsort, so each one doubles as a
+sorted-array index: a range of values, or each value of a set, maps to
+one contiguous slice of row ids after a binary search. A filter is answered by taking the rows
+of its most selective condition from its index and checking the other
+conditions on just those rows, so the cost follows the size of the
+matching subset rather than of the corpus.
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+CATEGORICAL_COLUMNS = ('directory', 'extension')
+NUMERIC_COLUMNS = ('mtime', 'size', 'width', 'height')
+
+# Filter keys accepted by parse_filters(): key -> (column, bound)
+RANGE_FILTERS = {
+    'modified_after': ('mtime', 'min'),
+    'modified_before': ('mtime', 'max'),
+    'min_size': ('size', 'min'),
+    'max_size': ('size', 'max'),
+    'min_width': ('width', 'min'),
+    'max_width': ('width', 'max'),
+    'min_height': ('height', 'min'),
+    'max_height': ('height', 'max'),
+}
+FILTER_KEYS = ('folder', 'extension') + tuple(RANGE_FILTERS)
+
+
+def _relative_directory(path, data_dir):
+    directory = os.path.relpath(os.path.dirname(path), data_dir).replace(os.sep, '/')
+    return '' if directory == '.' else directory
+
+
+def read_image_metadata(path, stat=None, data_dir=None):
+    """
+    Metadata of one image file
+
+    Only the image header is read to get the dimensions, not the pixels.
+
+    Args:
+        path: Image file path
+        stat: Optional (size in bytes, mtime in nanoseconds), as returned by
+            scan_image_files(), to skip the stat call
+        data_dir: Root that directories are made relative to (default from config)
+
+    Returns:
+        Dict with the directory, extension, mtime, size, width and height
+    """
+    from PIL import Image
+
+    if data_dir is None:
+        data_dir = config.DATA_DIR
+    record = {
+        'directory': _relative_directory(path, data_dir),
+        'extension': os.path.splitext(path)[1].lstrip('.').lower(),
+        'mtime': 0, 'size': 0, 'width': 0, 'height': 0,
+    }
+    try:
+        if stat is None:
+            file_stat = os.stat(path)
+            stat = (file_stat.st_size, file_stat.st_mtime_ns)
+        record['size'], record['mtime'] = stat[0], stat[1] // 1_000_000_000
+        with Image.open(path) as img:
+            record['width'], record['height'] = img.size
+    except Exception:
+        # A vanished or unreadable file still gets a row so ids stay aligned
+        pass
+    return record
+
+
+def _parse_time(value):
+    """Unix seconds from a number or an ISO 8601 date / datetime (UTC unless it says otherwise)"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip()
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}") from None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value]
+    return [item for item in str(value).split(',') if item != '']
+
+
+def parse_filters(values):
+    """
+    Validate search filters taken from request parameters or a JSON object
+
+    Args:
+        values: Mapping that may hold any of:
+            folder            folder (relative to DATA_DIR) or list of folders;
+                              images in subfolders match too
+            extension         extension or list of extensions, e.g. 'jpg,png'
+            modified_after    Unix seconds or ISO date, inclusive
+            modified_before   Unix seconds or ISO date, exclusive
+            min_size, max_size, min_width, max_width, min_height, max_height
+
+    Returns:
+        Dict of the filters given, with normalized values, or None if there are none
+
+    Raises:
+        ValueError: If a value cannot be parsed
+    """
+    filters = {}
+    for key in FILTER_KEYS:
+        value = values.get(key)
+        if value is None or value == '':
+            continue
+        if key == 'folder':
+            filters[key] = tuple(folder.strip('/') for folder in _as_list(value))
+        elif key == 'extension':
+            filters[key] = tuple(ext.lstrip('.').lower() for ext in _as_list(value))
+        elif key.startswith('modified_'):
+            filters[key] = _parse_time(value)
+        else:
+            try:
+                filters[key] = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"'{key}' must be an integer") from None
+    return filters or None
+
+
+class MetadataIndex:
+    """Column store of per-image metadata with a sorted-array index per column"""
+
+    def __init__(self, columns, vocabularies, orders=None):
+        """
+        Args:
+            columns: Dict of column name -> array, one entry per row
+                (categorical columns hold vocabulary codes)
+            vocabularies: Dict of categorical column name -> sorted array of values
+            orders: Dict of column name -> stable argsort of the column
+                (computed if not given)
+        """
+        self.columns = columns
+        self.vocabularies = vocabularies
+        if orders is None:
+            # int32 row ids halve the index size below 2**31 rows
+            dtype = np.int32 if len(columns['size']) < 2 ** 31 else np.int64
+            orders = {name: np.argsort(values, kind='stable').astype(dtype) for name, values in columns.items()}
+        self.orders = orders
+        self._sorted = {name: columns[name][order] for name, order in self.orders.items()}
+
+    def __len__(self):
+        return len(self.columns['size'])
+
+    @classmethod
+    def from_records(cls, records):
+        """Build the columns, vocabularies and indexes from read_image_metadata() dicts"""
+        columns, vocabularies = {}, {}
+        for name in CATEGORICAL_COLUMNS:
+            vocabulary, codes = np.unique(np.array([record[name] for record in records], dtype=str),
+                                          return_inverse=True)
+            vocabularies[name] = vocabulary
+            columns[name] = codes.astype(np.int32).reshape(-1)
+        for name in NUMERIC_COLUMNS:
+            columns[name] = np.array([record[name] for record in records], dtype=np.int64)
+        return cls(columns, vocabularies)
+
+    @classmethod
+    def build(cls, paths, stats=None, data_dir=None):
+        """
+        Read the metadata of every image, on DECODE_WORKERS threads
+
+        Args:
+            paths: Image paths in row order
+            stats: Optional dict of path -> (size, mtime_ns) to skip stat calls
+            data_dir: Root that directories are made relative to (default from config)
+        """
+        stats = stats or {}
+        num_workers = config.DECODE_WORKERS or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='image-metadata') as pool:
+            records = list(pool.map(lambda path: read_image_metadata(path, stats.get(path), data_dir),
+                                    paths, chunksize=256))
+        return cls.from_records(records)
+
+    def append(self, records):
+        """Return an index with rows for new images (read_image_metadata() dicts) added at the end"""
+        new = MetadataIndex.from_records(list(records))
+        columns, vocabularies = {}, {}
+        for name in CATEGORICAL_COLUMNS:
+            vocabulary = np.union1d(self.vocabularies[name], new.vocabularies[name])
+            # Re-code both parts against the merged vocabulary
+            old_codes = np.searchsorted(vocabulary, self.vocabularies[name])[self.columns[name]]
+            new_codes = np.searchsorted(vocabulary, new.vocabularies[name])[new.columns[name]]
+            vocabularies[name] = vocabulary
+            columns[name] = np.concatenate([old_codes, new_codes]).astype(np.int32)
+        for name in NUMERIC_COLUMNS:
+            columns[name] = np.concatenate([self.columns[name], new.columns[name]])
+        return MetadataIndex(columns, vocabularies)
+
+    def compact(self, keep):
+        """Return an index without the rows where keep is False, renumbered like the store"""
+        columns = {name: values[keep] for name, values in self.columns.items()}
+        return MetadataIndex(columns, self.vocabularies)
+
+    # Filtering
+
+    def _conditions(self, filters):
+        """
+        Turn parsed filters into per-column conditions
+
+        Returns:
+            List of (column, kind, argument): 'codes' with a boolean mask
+            over the vocabulary, or 'range' with inclusive (low, high) bounds
+        """
+        conditions = []
+        if 'folder' in filters:
+            vocabulary = self.vocabularies['directory']
+            match = np.zeros(len(vocabulary), dtype=bool)
+            for folder in filters['folder']:
+                if not folder:
+                    match[:] = True
+                    continue
+                match |= (vocabulary == folder) | np.char.startswith(vocabulary, folder + '/')
+            conditions.append(('directory', 'codes', match))
+        if 'extension' in filters:
+            conditions.append(('extension', 'codes', np.isin(self.vocabularies['extension'], filters['extension'])))
+
+        bounds = {}
+        for key, (column, bound) in RANGE_FILTERS.items():
+            if key in filters:
+                low, high = bounds.get(column, (None, None))
+                if bound == 'min':
+                    low = filters[key] if low is None else max(low, filters[key])
+                else:
+                    # modified_before is exclusive, the max_* bounds inclusive
+                    value = filters[key] - 1 if key == 'modified_before' else filters[key]
+                    high = value if high is None else min(high, value)
+                bounds[column] = (low, high)
+        for column, (low, high) in bounds.items():
+            conditions.append((column, 'range', (low, high)))
+        return conditions
+
+    def _slices(self, column, kind, argument):
+        """Positions in the column's sort order that satisfy a condition, as (start, end) pairs"""
+        sorted_values = self._sorted[column]
+        if kind == 'range':
+            low, high = argument
+            start = 0 if low is None else np.searchsorted(sorted_values, low, side='left')
+            end = len(sorted_values) if high is None else np.searchsorted(sorted_values, high, side='right')
+            return [(start, max(start, end))]
+        codes = np.flatnonzero(argument)
+        starts = np.searchsorted(sorted_values, codes, side='left')
+        ends = np.searchsorted(sorted_values, codes, side='right')
+        return list(zip(starts, ends))
+
+    def _check(self, rows, column, kind, argument):
+        values = self.columns[column][rows]
+        if kind == 'codes':
+            return argument[values]
+        low, high = argument
+        keep = np.ones(len(rows), dtype=bool)
+        if low is not None:
+            keep &= values >= low
+        if high is not None:
+            keep &= values <= high
+        return keep
+
+    def select(self, filters, deleted=None):
+        """
+        Row ids of the images matching every filter
+
+        The condition matching the fewest rows is looked up in its index;
+        the others are checked against those rows only.
+
+        Args:
+            filters: Filters from parse_filters()
+            deleted: Optional boolean mask of rows to leave out
+
+        Returns:
+            Sorted array of row ids
+        """
+        conditions = self._conditions(filters)
+        if not conditions:
+            rows = np.arange(len(self))
+        else:
+            slices = [self._slices(*condition) for condition in conditions]
+            counts = [sum(end - start for start, end in pairs) for pairs in slices]
+            best = int(np.argmin(counts))
+            column = conditions[best][0]
+            order = self.orders[column]
+            rows = np.sort(np.concatenate([order[start:end] for start, end in slices[best]]
+                                          or [np.empty(0, dtype=np.int64)]))
+            for i, condition in enumerate(conditions):
+                if i != best and len(rows):
+                    rows = rows[self._check(rows, *condition)]
+        if deleted is not None and len(rows):
+            rows = rows[~deleted[rows]]
+        return rows.astype(np.int64, copy=False)
+
+    def facets(self, deleted=None, limit=None):
+        """
+        Values available for filtering, with image counts
+
+        Returns:
+            Dict with folder and extension counts (most common first, at
+            most limit each) and the min/max of the numeric columns
+        """
+        live = None if deleted is None else ~deleted
+        result = {}
+        for name, key in (('directory', 'folders'), ('extension', 'extensions')):
+            codes = self.columns[name] if live is None else self.columns[name][live]
+            counts = np.bincount(codes, minlength=len(self.vocabularies[name]))
+            top = np.argsort(-counts, kind='stable')[:limit]
+            result[key] = [{'value': str(self.vocabularies[name][code]), 'count': int(counts[code])}
+                           for code in top if counts[code]]
+        for name in NUMERIC_COLUMNS:
+            values = self.columns[name] if live is None else self.columns[name][live]
+            result[name] = {'min': int(values.min()), 'max': int(values.max())} if len(values) else None
+        return result
+
+    def save(self, path=None):
+        """Save columns, vocabularies and sort orders atomically"""
+        if path is None:
+            path = config.METADATA_FILE
+        arrays = {}
+        for name, values in self.columns.items():
+            arrays[f'column_{name}'] = values
+            arrays[f'order_{name}'] = self.orders[name]
+        for name, vocabulary in self.vocabularies.items():
+            arrays[f'vocabulary_{name}'] = vocabulary
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=None):
+        """Load an index saved with save(); the sort orders are read, not recomputed"""
+        if path is None:
+            path = config.METADATA_FILE
+        with np.load(path) as data:
+            columns = {name: data[f'column_{name}'] for name in CATEGORICAL_COLUMNS + NUMERIC_COLUMNS}
+            orders = {name: data[f'order_{name}'] for name in columns}
+            vocabularies = {name: data[f'vocabulary_{name}'] for name in CATEGORICAL_COLUMNS}
+        return cls(columns, vocabularies, orders)
+
+
+if __name__ == "__main__":
+    from similarity_search import SimilaritySearch
+
+    # Add the metadata index to an index built before it existed
+    searcher = SimilaritySearch()
+    if searcher.load_index():
+        searcher.build_metadata()
@@ -0,0 +1,397 @@
+"""
+In-process metrics for the search server, exposed at /api/metrics in the
+Prometheus text format.
+
+    Counter     monotonically increasing count of events
+    Gauge       a current value, set directly or read from a callback at scrape time
+    Histogram   distribution of durations (or sizes) over fixed buckets
+
+Metrics are module-level objects, optionally split by labels:
+
+    STAGE_SECONDS.labels(stage='decode').observe(0.004)
+    with stage_timer('inference'):
+        ...
+
+An observation is a dictionary lookup, a bisect and a few additions under a
+lock (one to two microseconds), so instrumentation stays on in production.
+Values are per process: behind gunicorn every worker keeps its own, and a
+scrape reports the worker that answered it.
+
+SamplingProfiler is the opt-in, per-request counterpart: it records the
+stacks of chosen threads at a fixed interval while one request runs.
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """The set of metrics rendered by /api/metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class _Metric:
+    """A metric family: one child per combination of label values"""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        """
+        Args:
+            name: Metric name, e.g. 'search_stage_seconds'
+            help: One-line description shown in the exposition
+            labelnames: Names of the labels that split the metric
+            registry: Registry to expose the metric in (None for none)
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        # Children by the label values as passed, skipping the str() conversion
+        self._lookup = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._lookup[()] = self._new_child()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        """Child metric for one combination of label values"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        child = self._lookup.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            key = tuple(str(value) for value in values)
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+                self._lookup[values] = child
+        return child
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """Count of events since the process started"""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+                for key, child in self._items()]
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() at scrape time instead"""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. index size or memory use"""
+
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def samples(self):
+        lines = []
+        for key, child in self._items():
+            try:
+                value = child.get()
+            except Exception:
+                # A callback must never break the scrape
+                continue
+            if value is not None:
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds spent inside it"""
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=None, registry=REGISTRY):
+        """
+        Args:
+            buckets: Increasing bucket upper bounds (default: config.LATENCY_BUCKETS)
+        """
+        self.buckets = tuple(sorted(buckets if buckets is not None else config.LATENCY_BUCKETS))
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        lines = []
+        for key, child in self._items():
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# Metrics shared across modules. Module-specific ones live next to their code.
+STAGE_SECONDS = Histogram(
+    'search_stage_seconds',
+    'Time spent in each stage of answering a query; batched stages are observed once per batch',
+    ['stage'])
+REQUEST_SECONDS = Histogram('http_request_seconds', 'API request latency', ['endpoint'])
+REQUESTS = Counter('http_requests_total', 'API requests answered', ['endpoint', 'status'])
+ERRORS = Counter('errors_total', 'Failures by where they happened', ['stage'])
+
+
+def stage_timer(stage):
+    """Context manager timing one stage into search_stage_seconds"""
+    return STAGE_SECONDS.labels(stage).time()
+
+
+def process_memory():
+    """
+    Resident and peak resident memory of this process in bytes
+
+    Returns:
+        Tuple of (rss, peak rss); either is None where the platform does not report it
+    """
+    rss = peak = None
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Bytes on macOS, kilobytes elsewhere
+            peak = peak if sys.platform == 'darwin' else peak * 1024
+        except ImportError:
+            pass
+    return rss, peak
+
+
+PROCESS_START = Gauge('process_start_time_seconds', 'Unix time the process started')
+PROCESS_START.set(time.time())
+Gauge('process_resident_memory_bytes', 'Resident set size').set_function(lambda: process_memory()[0])
+Gauge('process_peak_resident_memory_bytes', 'Peak resident set size').set_function(lambda: process_memory()[1])
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the threads serving one request
+
+    A background thread records the Python stack of each watched thread
+    every interval_ms. Nothing is traced, so the profiled code runs at
+    nearly full speed; functions show up in proportion to the time spent
+    in them. Stacks are reported in the collapsed format flame graph
+    tools read ('outer;inner;leaf count').
+    """
+
+    def __init__(self, thread_ids, interval_ms=None):
+        """
+        Args:
+            thread_ids: Idents of the threads to sample
+            interval_ms: Sampling interval (default from config)
+        """
+        self.thread_ids = [ident for ident in thread_ids if ident is not None]
+        self.interval = (interval_ms if interval_ms is not None else config.PROFILE_INTERVAL_MS) / 1000.0
+        self.stacks = _Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._names = {}
+        self._started = None
+        self._elapsed = 0.0
+
+    def start(self):
+        self._names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._elapsed = time.perf_counter() - self._started
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in self.thread_ids:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[self._collapse(ident, frame)] += 1
+            self.samples += 1
+
+    def _collapse(self, ident, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        names.append(self._names.get(ident, str(ident)))
+        return ';'.join(reversed(names))
+
+    def report(self, max_stacks=None):
+        """
+        Summary of the samples
+
+        Returns:
+            Dict with the sample count, the most frequent collapsed stacks,
+            and the functions most often on top of a stack (self time)
+        """
+        if max_stacks is None:
+            max_stacks = config.PROFILE_MAX_STACKS
+        leaves = _Tally()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return {
+            'samples': self.samples,
+            'interval_ms': self.interval * 1000,
+            'duration_ms': self._elapsed * 1000,
+            'self': [{'function': name, 'samples': count} for name, count in leaves.most_common(max_stacks)],
+            'stacks': [{'stack': stack, 'samples': count} for stack, count in self.stacks.most_common(max_stacks)],
+        }
@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from metrics import Counter, Histogram
+
+
+BATCH_SIZES = Histogram('microbatch_size', 'Requests per micro-batch', ['batcher'],
+                        buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+QUEUE_SECONDS = Histogram('microbatch_queue_seconds', 'Time a request waited for its batch to start', ['batcher'])
+BATCH_FAILURES = Counter('microbatch_failures_total', 'Micro-batches whose processing raised', ['batcher'])
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent requests into batches processed by one worker thread
+
+    Callers submit single items and block on a Future. The worker waits for
+    the first item, then keeps collecting until either max_batch_size items
+    are queued or max_delay_ms has passed since that first item, and hands
+    the whole batch to process_batch. The delay bounds the extra latency a
+    request can pick up from waiting for company.
+    """
+
+    def __init__(self, process_batch, max_batch_size=None, max_delay_ms=None, name='micro-batcher'):
+        """
+        Args:
+            process_batch: Callable taking a list of items and returning a
+                list of results in the same order. An Exception instance in
+                place of a result is raised to that item's caller only.
+            max_batch_size: Flush once this many items are queued (default from config)
+            max_delay_ms: Flush once the oldest item has waited this long (default from config)
+            name: Name of the worker thread
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size if max_batch_size is not None else config.SEARCH_MAX_BATCH_SIZE
+        self.max_delay = (max_delay_ms if max_delay_ms is not None else config.SEARCH_MAX_BATCH_DELAY_MS) / 1000.0
+        self._queue = queue.Queue()
+        self._batch_sizes = BATCH_SIZES.labels(name)
+        self._queue_seconds = QUEUE_SECONDS.labels(name)
+        self._failures = BATCH_FAILURES.labels(name)
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    @property
+    def thread_id(self):
+        """Ident of the worker thread that runs process_batch"""
+        return self._worker.ident
+
+    def submit(self, item):
+        """Queue an item and return a Future for its result"""
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def __call__(self, item, timeout=None):
+        """Queue an item and wait for its result"""
+        return self.submit(item).result(timeout)
+
+    def _collect_batch(self):
+        """Block for the first item, then gather more until the size or deadline limit"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            # Skip requests whose callers gave up while queued
+            batch = [(item, future, queued) for item, future, queued in self._collect_batch()
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            now = time.perf_counter()
+            self._batch_sizes.observe(len(batch))
+            for _, _, queued in batch:
+                self._queue_seconds.observe(now - queued)
+
+            try:
+                results = self.process_batch([item for item, _, _ in batch])
+            except Exception as e:
+                self._failures.inc()
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
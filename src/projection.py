@@ -0,0 +1,116 @@
+import numpy as np
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+class PCAProjection:
+    """
+    Linear projection of extractor features onto their top principal components
+
+    Projected vectors are re-normalized to unit length, so cosine similarity
+    keeps working unchanged on the reduced features. With whitening each
+    component is also scaled to unit variance, which stops a few dominant
+    directions from drowning out the rest of the ranking.
+    """
+
+    def __init__(self, output_dim=None, whiten=None):
+        self.output_dim = output_dim if output_dim is not None else config.PCA_DIM
+        self.whiten = whiten if whiten is not None else config.PCA_WHITEN
+        self.mean = None
+        self.components = None
+
+    @property
+    def input_dim(self):
+        return self.components.shape[1]
+
+    def fit(self, features):
+        """
+        Learn the projection from a sample of feature vectors
+
+        Args:
+            features: Array of feature vectors (N x D), N >= output_dim
+        """
+        features = np.asarray(features, dtype=np.float64)
+        if self.output_dim > min(features.shape):
+            raise ValueError(f"Cannot project {features.shape[1]}-d features from {len(features)} "
+                             f"samples onto {self.output_dim} components")
+
+        self.mean = features.mean(axis=0)
+        centered = features - self.mean
+        covariance = centered.T @ centered / max(len(features) - 1, 1)
+
+        # eigh returns ascending eigenvalues; keep the largest output_dim
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:self.output_dim]
+        components = eigenvectors[:, order].T
+        if self.whiten:
+            components /= np.sqrt(np.maximum(eigenvalues[order], 1e-12))[:, None]
+
+        retained = eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12)
+        print(f"PCA: {features.shape[1]} -> {self.output_dim} dimensions, "
+              f"{retained:.1%} of variance retained")
+
+        self.mean = self.mean.astype(np.float32)
+        self.components = components.astype(np.float32)
+
+    def transform(self, features):
+        """
+        Project and L2-normalize feature vectors
+
+        Args:
+            features: A feature vector (D,) or array of them (N x D)
+
+        Returns:
+            Projected vector(s) of output_dim dimensions
+        """
+        projected = (np.asarray(features, dtype=np.float32) - self.mean) @ self.components.T
+        norms = np.linalg.norm(projected, axis=-1, keepdims=True)
+        return projected / np.maximum(norms, 1e-12)
+
+    def save(self, path=None):
+        """Save the fitted projection to disk"""
+        if path is None:
+            path = config.PROJECTION_FILE
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, mean=self.mean, components=self.components, whiten=np.array(self.whiten))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=None):
+        """Load a projection saved with save()"""
+        if path is None:
+            path = config.PROJECTION_FILE
+        with np.load(path) as data:
+            projection = cls(output_dim=len(data['components']), whiten=bool(data['whiten']))
+            projection.mean = data['mean']
+            projection.components = data['components']
+        return projection
+
+
+def sample_batches(batches, total, sample_size=None):
+    """
+    Take an evenly strided sample of rows from streamed feature batches
+
+    Args:
+        batches: Iterable of (features, paths) tuples
+        total: Total number of rows across all batches
+        sample_size: Maximum rows to keep (default from config)
+
+    Returns:
+        Array of sampled feature vectors
+    """
+    if sample_size is None:
+        sample_size = config.PCA_TRAIN_SIZE
+
+    stride = max(1, -(-total // sample_size))
+    sample = []
+    offset = 0
+    for features, _ in batches:
+        # Continue the stride across batch boundaries
+        first = (-offset) % stride
+        sample.append(np.asarray(features[first::stride], dtype=np.float32))
+        offset += len(features)
+    return np.concatenate(sample)
@@ -0,0 +1,345 @@
+import numpy as np
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from exact_search import normalize_query, select_top_k
+
+
+def _train_sample(features, sample_size, seed=0):
+    """Return up to sample_size rows of features as an in-memory float32 array"""
+    n = len(features)
+    if n > sample_size:
+        ids = np.sort(np.random.default_rng(seed).choice(n, sample_size, replace=False))
+        return np.asarray(features[ids], dtype=np.float32)
+    return np.asarray(features, dtype=np.float32)
+
+
+def kmeans(data, n_clusters, n_iter=None, seed=0):
+    """
+    Plain (Euclidean) k-means, used to learn product quantizer codebooks
+
+    Args:
+        data: Array of vectors (N x D)
+        n_clusters: Number of centroids
+        n_iter: Number of Lloyd iterations (default from config)
+        seed: Random seed for initialization
+
+    Returns:
+        Array of centroids (n_clusters x D)
+    """
+    if n_iter is None:
+        n_iter = config.PQ_TRAIN_ITERATIONS
+
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(data))
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = _nearest_centroids(data, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        nonempty = counts > 0
+
+        # Sum members of each cluster in one pass over the sorted data
+        order = np.argsort(assignments, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.add.reduceat(data[order], starts[nonempty], axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+
+    return centroids
+
+
+def _nearest_centroids(data, centroids):
+    """Index of the nearest centroid (squared L2) for each row"""
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, and |x|^2 does not change the argmin
+    distances = (centroids ** 2).sum(axis=1) - 2 * data @ centroids.T
+    return np.argmin(distances, axis=1)
+
+
+class ScalarQuantizer:
+    """
+    Symmetric int8 quantization with one scale per dimension (4x smaller)
+
+    x[d] is stored as round(x[d] / scale[d]) in [-127, 127]. A query is
+    scored directly on the codes: q . x ~= (q * scale) . codes.
+    """
+
+    kind = 'int8'
+
+    def __init__(self):
+        self.scale = None
+
+    def train(self, features):
+        sample = _train_sample(features, config.QUANTIZER_TRAIN_SIZE)
+        self.scale = np.maximum(np.abs(sample).max(axis=0), 1e-12) / 127.0
+        self.scale = self.scale.astype(np.float32)
+
+    def encode(self, features):
+        codes = np.rint(np.asarray(features, dtype=np.float32) / self.scale)
+        return np.clip(codes, -127, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return codes.astype(np.float32) * self.scale
+
+    def prepare_query(self, query_features):
+        """Fold the per-dimension scales into the query once per search"""
+        return query_features * self.scale
+
+    def score(self, codes, prepared_query):
+        return codes.astype(np.float32) @ prepared_query
+
+    def bytes_per_vector(self):
+        return len(self.scale)
+
+    def state(self):
+        return {'scale': self.scale}
+
+    def load_state(self, state):
+        self.scale = state['scale']
+
+
+class ProductQuantizer:
+    """
+    Product quantization: one byte per subspace of the feature vector
+
+    The vector is split into m equal subvectors, each replaced by the id of
+    its nearest of k learned centroids: 256, or one per training vector
+    when fewer are available. A query is scored with asymmetric distance
+    computation: a (m x k) table of query-subvector dot products is built
+    once, then each vector's score is m table lookups.
+    """
+
+    kind = 'pq'
+
+    def __init__(self, n_subquantizers=None):
+        self.n_subquantizers = n_subquantizers if n_subquantizers is not None else config.PQ_SUBQUANTIZERS
+        self.codebooks = None
+
+    def train(self, features):
+        dim = features.shape[1]
+        if dim % self.n_subquantizers:
+            raise ValueError(f"Feature dimension {dim} is not divisible by {self.n_subquantizers} subquantizers")
+
+        sample = _train_sample(features, config.QUANTIZER_TRAIN_SIZE)
+        sub_dim = dim // self.n_subquantizers
+        print(f"Training product quantizer: {self.n_subquantizers} x {sub_dim}-d subspaces...")
+
+        self.codebooks = np.stack([
+            kmeans(sample[:, m * sub_dim:(m + 1) * sub_dim], 256, seed=m)
+            for m in range(self.n_subquantizers)
+        ]).astype(np.float32)
+
+    def encode(self, features, chunk_size=16384):
+        features = np.asarray(features, dtype=np.float32)
+        sub_dim = self.codebooks.shape[2]
+        codes = np.empty((len(features), self.n_subquantizers), dtype=np.uint8)
+
+        for start in range(0, len(features), chunk_size):
+            chunk = features[start:start + chunk_size]
+            for m in range(self.n_subquantizers):
+                sub = chunk[:, m * sub_dim:(m + 1) * sub_dim]
+                codes[start:start + len(chunk), m] = _nearest_centroids(sub, self.codebooks[m])
+        return codes
+
+    def decode(self, codes):
+        parts = [self.codebooks[m][codes[:, m]] for m in range(self.n_subquantizers)]
+        return np.concatenate(parts, axis=1)
+
+    def prepare_query(self, query_features):
+        """Build the flattened (m * k) lookup table for one query"""
+        sub_queries = query_features.reshape(self.n_subquantizers, -1)
+        table = np.einsum('mkd,md->mk', self.codebooks, sub_queries)
+        return table.ravel()
+
+    def score(self, codes, prepared_query):
+        # Offset each subspace's code into its row of the flattened table
+        offsets = np.arange(self.n_subquantizers, dtype=np.int32) * self.codebooks.shape[1]
+        return prepared_query[codes.astype(np.int32) + offsets].sum(axis=1)
+
+    def bytes_per_vector(self):
+        return self.n_subquantizers
+
+    def state(self):
+        return {'codebooks': self.codebooks}
+
+    def load_state(self, state):
+        self.codebooks = state['codebooks']
+        self.n_subquantizers = len(self.codebooks)
+
+
+QUANTIZERS = {
+    ScalarQuantizer.kind: ScalarQuantizer,
+    ProductQuantizer.kind: ProductQuantizer,
+}
+
+
+def build_quantizer(features, kind=None, chunk_size=None):
+    """
+    Train the configured quantizer and encode a feature matrix
+
+    Args:
+        features: Array of L2-normalized feature vectors (N x D), may be memory-mapped
+        kind: 'int8' or 'pq' (default from config)
+        chunk_size: Rows encoded at once, bounds temporary memory
+
+    Returns:
+        Tuple of (trained quantizer, codes array)
+    """
+    if kind is None:
+        kind = config.QUANTIZATION
+    if kind not in QUANTIZERS:
+        raise ValueError(f"Unknown quantization type: {kind}")
+    if chunk_size is None:
+        chunk_size = config.SEARCH_CHUNK_SIZE
+
+    quantizer = QUANTIZERS[kind]()
+    quantizer.train(features)
+    codes = np.concatenate([
+        quantizer.encode(features[start:start + chunk_size])
+        for start in range(0, max(len(features), 1), chunk_size)
+    ])
+    return quantizer, codes
+
+
+def save_quantizer(quantizer, codes, stats=None, path=None, codes_path=None):
+    """Save quantizer parameters and codes; codes are stored as .npy so they can be memory-mapped"""
+    if path is None:
+        path = config.QUANTIZER_FILE
+    if codes_path is None:
+        codes_path = config.QUANTIZED_CODES_FILE
+
+    tmp_path = codes_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, codes)
+    os.replace(tmp_path, codes_path)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, kind=np.array(quantizer.kind), stats=np.array(stats or {}, dtype=object),
+                 **quantizer.state())
+    os.replace(tmp_path, path)
+
+
+def load_quantizer(path=None, codes_path=None):
+    """
+    Load a quantizer saved with save_quantizer()
+
+    Returns:
+        Tuple of (quantizer, memory-mapped codes, stats dict)
+    """
+    if path is None:
+        path = config.QUANTIZER_FILE
+    if codes_path is None:
+        codes_path = config.QUANTIZED_CODES_FILE
+
+    with np.load(path, allow_pickle=True) as data:
+        quantizer = QUANTIZERS[str(data['kind'])]()
+        quantizer.load_state({key: data[key] for key in data.files if key not in ('kind', 'stats')})
+        stats = data['stats'].item()
+    codes = np.load(codes_path, mmap_mode='r')
+    return quantizer, codes, stats
+
+
+class QuantizedSearch:
+    """
+    Search scored on quantized codes, with optional exact re-ranking
+
+    The codes produce a shortlist of top_k * rerank_factor candidates,
+    which are then re-scored against the full float32 vectors (read from
+    the memory-mapped store, so only the shortlist rows are touched).
+    """
+
+    def __init__(self, quantizer, codes, features=None, deleted=None, rerank_factor=None, chunk_size=None):
+        self.quantizer = quantizer
+        self.codes = codes
+        self.features = features
+        self.deleted = deleted
+        self.rerank_factor = rerank_factor if rerank_factor is not None else config.RERANK_FACTOR
+        self.chunk_size = chunk_size if chunk_size is not None else config.QUANTIZED_CHUNK_SIZE
+
+    def _rerank(self, query_features, ids, scores, top_k):
+        """Re-score a shortlist on full vectors and keep the top K"""
+        if self.features is not None and self.rerank_factor > 0 and len(ids):
+            order = np.argsort(ids)
+            ids = ids[order]
+            scores = np.asarray(self.features[ids]) @ query_features
+        top = select_top_k(scores, top_k)
+        return ids[top], scores[top]
+
+    def _shortlist_size(self, top_k):
+        return top_k * max(1, self.rerank_factor)
+
+    def search_rows(self, query_features, row_ids, top_k):
+        """
+        Search only the given rows (e.g. the candidates of an IVF probe)
+
+        Returns:
+            Tuple of (row ids, similarity scores), best match first
+        """
+        query_features = normalize_query(query_features)
+        prepared = self.quantizer.prepare_query(query_features)
+        scores = self.quantizer.score(np.asarray(self.codes[row_ids]), prepared)
+        top = select_top_k(scores, self._shortlist_size(top_k))
+        return self._rerank(query_features, row_ids[top], scores[top], top_k)
+
+    def search(self, query_features, top_k):
+        """
+        Find the top K neighbours of a query by scanning all codes
+
+        Returns:
+            Tuple of (row ids, similarity scores), best match first
+        """
+        query_features = normalize_query(query_features)
+        prepared = self.quantizer.prepare_query(query_features)
+        shortlist = self._shortlist_size(top_k)
+        candidate_ids = []
+        candidate_scores = []
+
+        for start in range(0, len(self.codes), self.chunk_size):
+            scores = self.quantizer.score(np.asarray(self.codes[start:start + self.chunk_size]), prepared)
+            if self.deleted is not None:
+                scores[self.deleted[start:start + len(scores)]] = -np.inf
+            top = select_top_k(scores, shortlist)
+            candidate_ids.append(top + start)
+            candidate_scores.append(scores[top])
+
+        if not candidate_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        ids = np.concatenate(candidate_ids)
+        scores = np.concatenate(candidate_scores)
+        top = select_top_k(scores, shortlist)
+        ids, scores = ids[top], scores[top]
+        ids = ids[np.isfinite(scores)]
+        scores = scores[np.isfinite(scores)]
+        return self._rerank(query_features, ids, scores, top_k)
+
+
+def measure_recall(search_fn, features, deleted=None, top_k=10, n_queries=100, seed=0):
+    """
+    Recall@K of a search function against exact search, using indexed vectors as queries
+
+    Args:
+        search_fn: Callable (query, top_k) -> (ids, scores)
+        features: Full feature matrix
+        deleted: Optional boolean mask of deleted rows
+        top_k: Number of neighbours compared per query
+        n_queries: Number of sampled queries
+
+    Returns:
+        Mean fraction of the exact top K found by search_fn
+    """
+    from exact_search import ExactSearch
+
+    rng = np.random.default_rng(seed)
+    query_ids = np.sort(rng.choice(len(features), min(n_queries, len(features)), replace=False))
+    queries = np.asarray(features[query_ids])
+
+    # One blocked pass over the full vectors scores every query exactly
+    expected, _ = ExactSearch(features, deleted=deleted).search_batch(queries, top_k)
+
+    found = 0
+    for query, expected_ids in zip(queries, expected):
+        actual, _ = search_fn(query, top_k)
+        found += len(np.intersect1d(expected_ids, actual))
+    return found / (len(query_ids) * top_k)
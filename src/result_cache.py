@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import hashlib
+import os
+import sys
+import threading
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from metrics import Counter, Gauge
+
+
+LOOKUPS = Counter('result_cache_lookups_total', 'Search result cache lookups by outcome', ['result'])
+ENTRIES = Gauge('result_cache_entries', 'Search results held in the result cache')
+
+# Query vectors are rounded to this many steps per unit before hashing
+FINGERPRINT_SCALE = 127
+
+
+def query_fingerprint(query_features):
+    """
+    Hash a query vector after rounding it to 8-bit steps
+
+    Re-encoding the same image, or a copy that decodes a hair differently,
+    gives the same fingerprint, while distinct images practically never do.
+
+    Returns:
+        16-byte BLAKE2b digest
+    """
+    query = np.asarray(query_features, dtype=np.float32).ravel()
+    norm = np.sqrt(np.dot(query, query))
+    if norm > 0:
+        query = query / norm
+    steps = np.rint(query * FINGERPRINT_SCALE).astype(np.int8)
+    return hashlib.blake2b(steps.tobytes(), digest_size=16).digest()
+
+
+class ResultCache:
+    """
+    LRU cache of search results with a time-to-live
+
+    Entries belong to one version of the index. The searcher passes its
+    current version (an increasing number) with every call; when it
+    changes, every entry is dropped at once, and results computed against
+    an older version are not stored.
+    """
+
+    def __init__(self, max_entries=None, ttl_seconds=None):
+        """
+        Args:
+            max_entries: Results kept before the least recently used are evicted (default from config)
+            ttl_seconds: Age after which an entry is recomputed; None keeps entries until evicted (default from config)
+        """
+        self.max_entries = max_entries if max_entries is not None else config.RESULT_CACHE_SIZE
+        self.ttl = ttl_seconds if ttl_seconds is not None else config.RESULT_CACHE_TTL_SECONDS
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        ENTRIES.set_function(lambda: len(self._entries))
+
+    def _check_version(self, version):
+        """
+        Move to a newer index version, dropping every entry; call with the lock held
+
+        Returns:
+            False if version is older than the cache's, True otherwise
+        """
+        if self.version is not None and version < self.version:
+            return False
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.version = version
+        return True
+
+    def get(self, key, version):
+        """
+        Look up a result
+
+        Returns:
+            The cached value, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key) if self._check_version(version) else None
+            if entry is None:
+                self.misses += 1
+                LOOKUPS.labels('miss').inc()
+                return None
+            value, stored = entry
+            if self.ttl is not None and time.monotonic() - stored > self.ttl:
+                del self._entries[key]
+                self.expired += 1
+                LOOKUPS.labels('expired').inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        LOOKUPS.labels('hit').inc()
+        return value
+
+    def put(self, key, value, version):
+        """Store a result computed against the given index version"""
+        with self._lock:
+            if not self._check_version(version):
+                return
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit/miss counters and size"""
+        with self._lock:
+            lookups = self.hits + self.misses + self.expired
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
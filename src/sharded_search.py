@@ -0,0 +1,311 @@
+"""
+Sharded exact search: the index is split into contiguous row ranges, each
+stored as its own feature store and scanned by its own worker process.
+
+    models/shards/manifest.json     total count and the row range of each shard
+    models/shards/shard_000.idx     feature store holding rows [start, start + count)
+
+Every server process runs its own coordinator and shard processes, so
+gunicorn with N workers starts N x INDEX_SHARDS of them. The shard stores
+are memory-mapped, so their pages are shared between all of those.
+
+A ShardCoordinator sends every query batch to all shards at once, waits up
+to SHARD_TIMEOUT_MS for their top-k lists and merges them with a heap.
+Shards that are slow or dead are left out of that answer (and restarted if
+their process died), so one bad shard degrades recall instead of failing
+the request.
+"""
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import Future, wait
+
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from exact_search import ExactSearch, normalize_queries
+from feature_store import FeatureStore, FeatureStoreWriter
+from metrics import Counter
+
+
+MANIFEST_FILE = 'manifest.json'
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+SHARD_MISSES = Counter('index_shard_misses_total', 'Shard answers left out of a search', ['reason'])
+SHARD_RESTARTS = Counter('index_shard_restarts_total', 'Shard worker processes restarted after dying')
+
+
+def _shard_file(shard_id):
+    return f"shard_{shard_id:03d}.idx"
+
+
+def write_shards(features, image_paths, source=None, n_shards=None, shard_dir=None, chunk_size=None):
+    """
+    Partition a feature matrix into contiguous shard stores
+
+    Args:
+        features: Array of feature vectors (N x D), may be memory-mapped
+        image_paths: Sequence of N image paths
+        source: Identifier of the index the shards were cut from, kept in the manifest
+        n_shards: Number of shards (default from config)
+        shard_dir: Directory for the shard stores (default from config)
+        chunk_size: Rows copied at once, bounds temporary memory
+    """
+    if n_shards is None:
+        n_shards = config.INDEX_SHARDS
+    if shard_dir is None:
+        shard_dir = config.SHARD_DIR
+    if chunk_size is None:
+        chunk_size = config.SEARCH_CHUNK_SIZE
+    os.makedirs(shard_dir, exist_ok=True)
+
+    total = len(image_paths)
+    rows_per_shard = max(1, -(-total // n_shards))
+    shards = []
+    for shard_id, start in enumerate(range(0, max(total, 1), rows_per_shard)):
+        end = min(start + rows_per_shard, total)
+        with FeatureStoreWriter(os.path.join(shard_dir, _shard_file(shard_id)), features.shape[1]) as writer:
+            for chunk_start in range(start, end, chunk_size):
+                chunk_end = min(chunk_start + chunk_size, end)
+                writer.append(np.asarray(features[chunk_start:chunk_end]), image_paths[chunk_start:chunk_end])
+        shards.append({'file': _shard_file(shard_id), 'start': start, 'count': end - start})
+
+    manifest_path = os.path.join(shard_dir, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'source': source, 'n_shards': n_shards, 'count': total, 'shards': shards}, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    # Drop shards left over from a build with more of them
+    for shard_id in itertools.count(len(shards)):
+        path = os.path.join(shard_dir, _shard_file(shard_id))
+        if not os.path.exists(path):
+            break
+        os.remove(path)
+
+    print(f"Wrote {len(shards)} index shards of up to {rows_per_shard} images")
+
+
+def load_manifest(shard_dir=None):
+    """Return the shard manifest, or None if no shards were written"""
+    if shard_dir is None:
+        shard_dir = config.SHARD_DIR
+    try:
+        with open(os.path.join(shard_dir, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _shard_worker(shard_path, start, requests, responses):
+    """Worker process: serve top-k searches over one shard until told to stop"""
+    store = FeatureStore(shard_path)
+    search = ExactSearch(store.features)
+
+    for message in iter(requests.get, None):
+        kind, request_id, payload = message
+        if kind == 'deleted':
+            deleted = np.zeros(store.count, dtype=bool)
+            deleted[payload] = True
+            search = ExactSearch(store.features, deleted=deleted if deleted.any() else None)
+            continue
+
+        try:
+            queries, top_k = payload
+            ids, scores = search.search_batch(queries, top_k)
+            responses.put((request_id, ids + start, scores))
+        except Exception as e:
+            responses.put((request_id, e, None))
+
+
+class ShardProcess:
+    """One shard served by a worker process, answering through Futures"""
+
+    def __init__(self, shard_id, shard_path, start, count, context, threads):
+        self.shard_id = shard_id
+        self.shard_path = shard_path
+        self.start = start
+        self.count = count
+        self._context = context
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._request_ids = itertools.count()
+        self._deleted_ids = np.empty(0, dtype=np.int64)
+        self.process = None
+        self._spawn()
+
+    def _spawn(self):
+        self.requests = self._context.Queue()
+        self.responses = self._context.Queue()
+        self.process = self._context.Process(
+            target=_shard_worker,
+            args=(self.shard_path, self.start, self.requests, self.responses),
+            name=f'index-shard-{self.shard_id}',
+            daemon=True)
+
+        # Split the cores between shards; the child reads these when it imports numpy
+        saved = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+        os.environ.update({var: str(self.threads) for var in BLAS_THREAD_VARS})
+        try:
+            self.process.start()
+        finally:
+            for var, value in saved.items():
+                if value is None:
+                    del os.environ[var]
+                else:
+                    os.environ[var] = value
+        if len(self._deleted_ids):
+            self.requests.put(('deleted', None, self._deleted_ids))
+
+        reader = threading.Thread(target=self._read_responses, args=(self.responses,),
+                                  name=f'index-shard-{self.shard_id}-reader', daemon=True)
+        reader.start()
+
+    def _read_responses(self, responses):
+        for request_id, ids, scores in iter(responses.get, None):
+            with self._lock:
+                future = self._futures.pop(request_id, None)
+            if future is None or future.cancelled():
+                continue
+            if isinstance(ids, Exception):
+                future.set_exception(ids)
+            else:
+                future.set_result((ids, scores))
+
+    def ensure_alive(self):
+        """Restart the worker if its process has died"""
+        if self.process.is_alive():
+            return
+        print(f"Index shard {self.shard_id} died, restarting it")
+        SHARD_RESTARTS.inc()
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self.responses.put(None)
+        self._spawn()
+
+    def submit(self, queries, top_k):
+        """Queue a search and return a Future for (global ids, scores)"""
+        future = Future()
+        request_id = next(self._request_ids)
+        with self._lock:
+            self._futures[request_id] = future
+        self.requests.put(('search', request_id, (queries, top_k)))
+        return future
+
+    def forget(self, future):
+        """Drop a Future whose answer is no longer wanted (e.g. after a timeout)"""
+        with self._lock:
+            for request_id, pending in list(self._futures.items()):
+                if pending is future:
+                    del self._futures[request_id]
+        future.cancel()
+
+    def set_deleted(self, deleted_ids):
+        """Send the shard-local ids of deleted rows"""
+        self._deleted_ids = np.asarray(deleted_ids, dtype=np.int64)
+        self.requests.put(('deleted', None, self._deleted_ids))
+
+    def close(self):
+        self.requests.put(None)
+        self.responses.put(None)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ShardCoordinator:
+    """
+    Scatter queries to every shard and gather their merged top-k
+
+    Each shard returns its own top-k, sorted best first; a heap merge of
+    those lists gives the global top-k exactly, provided every shard
+    answers within the timeout.
+    """
+
+    def __init__(self, manifest, shard_dir=None, timeout_ms=None, deleted=None):
+        """
+        Args:
+            manifest: Shard manifest as returned by load_manifest()
+            shard_dir: Directory holding the shard stores (default from config)
+            timeout_ms: How long a search waits for slow shards (default from config)
+            deleted: Optional boolean mask of deleted rows, over global row ids
+        """
+        if shard_dir is None:
+            shard_dir = config.SHARD_DIR
+        self.timeout = (timeout_ms if timeout_ms is not None else config.SHARD_TIMEOUT_MS) / 1000.0
+        self.count = manifest['count']
+        self.missed = 0
+
+        # Spawned rather than forked: the parent may hold TensorFlow and BLAS threads
+        context = multiprocessing.get_context('spawn')
+        threads = config.SHARD_THREADS or max(1, (os.cpu_count() or 1) // len(manifest['shards']))
+        self.shards = [
+            ShardProcess(shard_id, os.path.join(shard_dir, shard['file']), shard['start'], shard['count'],
+                         context, threads)
+            for shard_id, shard in enumerate(manifest['shards'])
+        ]
+        if deleted is not None:
+            self.set_deleted(deleted)
+
+    def set_deleted(self, deleted):
+        """Forward a global deleted-row mask to the shards it touches"""
+        for shard in self.shards:
+            shard.set_deleted(np.flatnonzero(deleted[shard.start:shard.start + shard.count]))
+
+    def search_batch(self, queries, top_k):
+        """
+        Find the top K matches for many queries across all shards
+
+        Args:
+            queries: Array of query feature vectors (N x D)
+            top_k: Number of matches per query
+
+        Returns:
+            List of (row ids, similarity scores) tuples, one per query
+        """
+        queries = normalize_queries(queries)
+        for shard in self.shards:
+            shard.ensure_alive()
+        futures = [(shard, shard.submit(queries, top_k)) for shard in self.shards]
+        wait([future for _, future in futures], timeout=self.timeout)
+
+        answers = []
+        for shard, future in futures:
+            if not future.done():
+                print(f"Index shard {shard.shard_id} timed out, answering without it")
+                shard.forget(future)
+                self.missed += 1
+                SHARD_MISSES.labels('timeout').inc()
+                continue
+            try:
+                answers.append(future.result())
+            except Exception as e:
+                print(f"Index shard {shard.shard_id} failed: {str(e)}")
+                self.missed += 1
+                SHARD_MISSES.labels('error').inc()
+
+        results = []
+        for q in range(len(queries)):
+            # Each shard list is sorted best first, so a k-way heap merge suffices
+            merged = heapq.merge(
+                *[zip(scores[q], ids[q]) for ids, scores in answers],
+                key=lambda item: -item[0])
+            top = [(score, idx) for score, idx in itertools.islice(merged, top_k) if np.isfinite(score)]
+            results.append((np.array([idx for _, idx in top], dtype=np.int64),
+                            np.array([score for score, _ in top], dtype=np.float32)))
+        return results
+
+    def search(self, query_features, top_k):
+        """Find the top K matches for one query across all shards"""
+        return self.search_batch(np.asarray(query_features).reshape(1, -1), top_k)[0]
+
+    def close(self):
+        """Stop every shard worker"""
+        for shard in self.shards:
+            shard.close()
@@ -1,10 +1,24 @@
+import itertools
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 import pickle
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
+from backbones import LEGACY_MODEL_ID, get_backbone
+from ann_index import build_ann_index, load_ann_index
+from feature_store import FeatureStore, FeatureStoreWriter
+from exact_search import ExactSearch
+from knn_graph import KNNGraph
+from metadata import MetadataIndex, read_image_metadata
+from metrics import Counter, stage_timer
+from projection import PCAProjection, sample_batches
+from quantization import QuantizedSearch, build_quantizer, load_quantizer, measure_recall, save_quantizer
+from result_cache import ResultCache, query_fingerprint
+from sharded_search import ShardCoordinator, load_manifest, write_shards
+
+
+SEARCH_QUERIES = Counter('search_queries_total', 'Queries answered, by the index that answered them', ['index'])
 
 
 class SimilaritySearch:
@@ -13,19 +27,70 @@ class SimilaritySearch:
     def __init__(self):
         self.features = None
         self.image_paths = None
+        self.model = None
+        self.ann_index = None
+        self.projection = None
+        self.quantizer = None
+        self.codes = None
+        self.quantization_stats = None
+        self.knn_graph = None
+        self.metadata = None
+        self.shards = None
+        self.deleted = None
         self.is_indexed = False
+        self._path_rows = None
+        # Bumped whenever anything that changes search results is replaced
+        self.version = 0
+        self.result_cache = ResultCache() if config.RESULT_CACHE else None
     
-    def load_index(self):
-        """Load pre-computed feature index from disk"""
+    def load_index(self, model=None):
+        """
+        Load pre-computed feature index from disk
+        
+        The feature store is memory-mapped, so loading is near-instant and
+        processes serving the same index share its pages. Indexes saved as
+        pickles by older versions are still loaded, fully into memory.
+        
+        Args:
+            model: Id of the backbone queries will be embedded with (default:
+                the configured backbone's). An index built by any other
+                backbone is refused, since its embeddings are not comparable.
+        """
         try:
-            with open(config.FEATURES_FILE, 'rb') as f:
-                self.features = pickle.load(f)
+            if model is None:
+                model = get_backbone().model_id
+            
+            if os.path.exists(config.FEATURE_STORE_FILE):
+                store = FeatureStore()
+                index_model = store.model or LEGACY_MODEL_ID
+                features, image_paths = store.features, store.paths
+            else:
+                with open(config.FEATURES_FILE, 'rb') as f:
+                    features = np.asarray(pickle.load(f), dtype=np.float32)
+                
+                with open(config.IMAGE_PATHS_FILE, 'rb') as f:
+                    image_paths = pickle.load(f)
+                index_model = LEGACY_MODEL_ID
+                print("Loaded legacy pickle index. Run 'python src/feature_store.py --migrate' to convert it.")
             
-            with open(config.IMAGE_PATHS_FILE, 'rb') as f:
-                self.image_paths = pickle.load(f)
+            if index_model != model:
+                print(f"The index was built with {index_model}, but the configured backbone is {model}. "
+                      f"Rebuild it with: python src/indexer.py --restart")
+                return False
             
+            self.features = features
+            self.image_paths = image_paths
+            self.model = index_model
             self.is_indexed = True
-            print(f"Loaded index with {len(self.image_paths)} images")
+            self.load_projection()
+            self.load_tombstones()
+            self.load_ann_index()
+            self.load_quantized_index()
+            self.load_knn_graph()
+            self.load_metadata()
+            self.open_shards()
+            self._index_changed()
+            print(f"Loaded index with {self.num_images} images")
             return True
             
         except FileNotFoundError:
@@ -37,23 +102,640 @@ class SimilaritySearch:
     
     def save_index(self, features, image_paths):
         """Save feature index to disk"""
+        return self.save_index_batches([(features, image_paths)], np.shape(features)[1])
+    
+    def save_index_batches(self, batches, dim, deleted_ids=None, model=None):
+        """
+        Save a feature index streamed in batches, without holding it all in memory
+        
+        Args:
+            batches: Iterable of (features, image_paths) tuples
+            dim: Feature vector dimension
+            deleted_ids: Row ids of the new index to keep tombstoned (default: none)
+            model: Id of the backbone that produced the features (default:
+                the loaded index's, or the configured backbone's)
+        
+        Batches of extractor features are projected first if a PCA
+        projection is set, so the store holds the reduced vectors.
+        """
         try:
-            with open(config.FEATURES_FILE, 'wb') as f:
-                pickle.dump(features, f)
+            if model is None:
+                model = self.model or get_backbone().model_id
+            if self.projection is not None and dim == self.projection.input_dim:
+                dim = self.projection.output_dim
+            writer = FeatureStoreWriter(config.FEATURE_STORE_FILE, dim, model)
+            try:
+                for features, image_paths in batches:
+                    writer.append(self.project(features), image_paths)
+            except BaseException:
+                writer.abort()
+                raise
             
-            with open(config.IMAGE_PATHS_FILE, 'wb') as f:
-                pickle.dump(image_paths, f)
+            # Drop our mapping of the old file before it is replaced
+            self.features = None
+            self.image_paths = None
+            self._path_rows = None
+            self.close_shards()
+            writer.commit()
+            self._index_changed()
             
-            self.features = features
-            self.image_paths = image_paths
+            store = FeatureStore()
+            self.features = store.features
+            self.image_paths = store.paths
+            self.model = store.model
             self.is_indexed = True
-            print(f"Saved index with {len(image_paths)} images")
+            
+            self.deleted = None
+            if os.path.exists(config.TOMBSTONES_FILE):
+                os.remove(config.TOMBSTONES_FILE)
+            if deleted_ids is not None and len(deleted_ids):
+                self.delete_from_index(deleted_ids)
+            
+            # An ANN index built for the previous features no longer matches
+            self.ann_index = None
+            if os.path.exists(config.ANN_INDEX_FILE):
+                os.remove(config.ANN_INDEX_FILE)
+            self._drop_quantized_index()
+            self.knn_graph = None
+            if os.path.exists(config.KNN_GRAPH_FILE):
+                os.remove(config.KNN_GRAPH_FILE)
+            self.metadata = None
+            if os.path.exists(config.METADATA_FILE):
+                os.remove(config.METADATA_FILE)
+            
+            if config.INDEX_SHARDS > 1:
+                write_shards(self.features, self.image_paths, self._store_id())
+                self.open_shards()
+            
+            print(f"Saved index with {self.num_images} images")
             return True
             
         except Exception as e:
             print(f"Error saving index: {str(e)}")
             return False
     
+    def _index_changed(self):
+        """Start a new index version, so results cached for the previous one are not served"""
+        self.version += 1
+    
+    @property
+    def num_images(self):
+        """Number of searchable (not deleted) images"""
+        if not self.is_indexed:
+            return 0
+        if self.deleted is None:
+            return len(self.image_paths)
+        return len(self.image_paths) - int(self.deleted.sum())
+    
+    def live_rows(self):
+        """Map each searchable image path to its row id"""
+        return {
+            path: row for row, path in enumerate(self.image_paths)
+            if self.deleted is None or not self.deleted[row]
+        }
+    
+    def sample_paths(self, count):
+        """Return up to count random paths of searchable images"""
+        return [self.image_paths[row] for row in self.sample_rows(count)]
+    
+    def sample_rows(self, count, filters=None):
+        """Return up to count random row ids of searchable images, optionally only those matching filters"""
+        if filters:
+            live = self.filter_rows(filters)
+        else:
+            live = np.arange(len(self.image_paths))
+            if self.deleted is not None:
+                live = live[~self.deleted]
+        return np.random.choice(live, min(count, len(live)), replace=False)
+    
+    def row_for_path(self, path):
+        """
+        Look up the row id of an indexed image by its path
+        
+        The path-to-row map is built on first use and kept until the index
+        is saved again.
+        
+        Returns:
+            Row id, or None if the path is not indexed or was deleted
+        """
+        if self._path_rows is None:
+            self._path_rows = {p: row for row, p in enumerate(self.image_paths)}
+        row = self._path_rows.get(path)
+        if row is None or not self.is_live(row):
+            return None
+        return row
+    
+    def is_live(self, row):
+        """Whether a row id refers to a searchable (stored, not deleted) image"""
+        if not 0 <= row < len(self.image_paths):
+            return False
+        return self.deleted is None or not self.deleted[row]
+    
+    def load_tombstones(self):
+        """Load the ids of rows deleted since the index was last compacted"""
+        self.deleted = None
+        if not os.path.exists(config.TOMBSTONES_FILE):
+            return False
+        
+        deleted_ids = np.load(config.TOMBSTONES_FILE)
+        if len(deleted_ids) and deleted_ids.max() >= len(self.image_paths):
+            print("Tombstones do not match the index, ignoring them")
+            return False
+        
+        self.deleted = np.zeros(len(self.image_paths), dtype=bool)
+        self.deleted[deleted_ids] = True
+        return True
+    
+    def delete_from_index(self, row_ids):
+        """
+        Mark rows as deleted without rewriting the feature store
+        
+        Deleted rows are skipped by every search until compact_index()
+        physically removes them.
+        
+        Args:
+            row_ids: Row ids of the images to delete
+        """
+        if self.deleted is None:
+            self.deleted = np.zeros(len(self.image_paths), dtype=bool)
+        self.deleted[np.asarray(row_ids, dtype=np.int64)] = True
+        if self.shards is not None:
+            self.shards.set_deleted(self.deleted)
+        self._index_changed()
+        
+        tmp_path = config.TOMBSTONES_FILE + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.flatnonzero(self.deleted))
+        os.replace(tmp_path, config.TOMBSTONES_FILE)
+    
+    def deleted_fraction(self):
+        """Fraction of stored rows that are tombstoned"""
+        if self.deleted is None or not len(self.deleted):
+            return 0.0
+        return float(self.deleted.mean())
+    
+    def _iter_rows(self, keep=None, chunk_size=None):
+        """Stream the stored features and paths in chunks, optionally filtered by a row mask"""
+        if chunk_size is None:
+            chunk_size = config.SEARCH_CHUNK_SIZE
+        for start in range(0, len(self.image_paths), chunk_size):
+            end = min(start + chunk_size, len(self.image_paths))
+            features = np.asarray(self.features[start:end])
+            paths = self.image_paths[start:end]
+            if keep is not None:
+                mask = keep[start:end]
+                features = features[mask]
+                paths = [path for path, kept in zip(paths, mask) if kept]
+            yield features, paths
+    
+    def append_to_index(self, new_features, new_paths, delete_ids=()):
+        """
+        Append images to the index, keeping existing row ids stable
+        
+        Existing rows are copied into the new store as they are, so the
+        tombstones and the ANN index stay valid and only the new rows need
+        to be assigned to ANN lists.
+        
+        Args:
+            new_features: Array of feature vectors to append (N x D)
+            new_paths: List of N image paths
+            delete_ids: Existing row ids to tombstone at the same time
+        """
+        if not self.is_indexed:
+            raise ValueError("Index not loaded. Call load_index() first.")
+        
+        start_id = len(self.image_paths)
+        deleted_ids = np.flatnonzero(self.deleted) if self.deleted is not None else np.empty(0, dtype=np.int64)
+        deleted_ids = np.union1d(deleted_ids, np.asarray(delete_ids, dtype=np.int64))
+        ann_index = self.ann_index
+        # Codes are small; copy them so the mapped file can be replaced
+        quantizer, stats = self.quantizer, self.quantization_stats
+        codes = np.array(self.codes) if self.codes is not None else None
+        knn_graph = self._detach_knn_graph()
+        metadata = self.metadata
+        
+        # The ANN lists and codes hold stored-width vectors, like the store
+        new_features = self.project(new_features)
+        batches = itertools.chain(self._iter_rows(), [(new_features, new_paths)])
+        if not self.save_index_batches(batches, self.features.shape[1], deleted_ids):
+            return False
+        
+        # Reuse the trained centroids instead of re-clustering everything
+        if ann_index is not None:
+            self.ann_index = ann_index
+            self.add_to_ann_index(new_features, start_id)
+        else:
+            self.build_ann_index()
+        
+        # Likewise only the new rows need encoding with the trained quantizer
+        if quantizer is not None:
+            codes = np.concatenate([codes, quantizer.encode(new_features)])
+            self._set_quantized_index(quantizer, codes, stats)
+        elif config.QUANTIZATION:
+            self.build_quantized_index()
+        
+        if knn_graph is not None:
+            knn_graph.add(self.features, start_id, self.deleted)
+            self.knn_graph = knn_graph
+            self.knn_graph.save()
+        elif config.KNN_GRAPH:
+            self.build_knn_graph()
+        
+        # Only the new rows are read; an index without metadata stays without it
+        if metadata is not None:
+            self.metadata = metadata.append(read_image_metadata(path) for path in new_paths)
+            self.metadata.save()
+        self._index_changed()
+        return True
+    
+    def compact_index(self):
+        """Rewrite the feature store without deleted rows"""
+        if self.deleted is None or not self.deleted.any():
+            return True
+        
+        keep = ~self.deleted
+        ann_index = self.ann_index
+        # Codes are small; copy them so the mapped file can be replaced
+        quantizer, stats = self.quantizer, self.quantization_stats
+        codes = np.array(self.codes) if self.codes is not None else None
+        knn_graph = self._detach_knn_graph()
+        metadata = self.metadata
+        print(f"Compacting index: removing {int(self.deleted.sum())} deleted images")
+        
+        if not self.save_index_batches(self._iter_rows(keep), self.features.shape[1]):
+            return False
+        
+        # Row ids shift down, so renumber the ANN lists rather than rebuild them
+        if ann_index is not None:
+            ann_index.compact(keep)
+            self.ann_index = ann_index
+            self.ann_index.save()
+        else:
+            self.build_ann_index()
+        
+        if quantizer is not None:
+            self._set_quantized_index(quantizer, codes[keep], stats)
+        elif config.QUANTIZATION:
+            self.build_quantized_index()
+        
+        if knn_graph is not None:
+            knn_graph.compact(keep, self.features)
+            self.knn_graph = knn_graph
+            self.knn_graph.save()
+        elif config.KNN_GRAPH:
+            self.build_knn_graph()
+        
+        if metadata is not None:
+            self.metadata = metadata.compact(keep)
+            self.metadata.save()
+        self._index_changed()
+        return True
+    
+    def load_projection(self):
+        """Load the PCA projection the stored features were reduced with, if any"""
+        self.projection = None
+        if not os.path.exists(config.PROJECTION_FILE):
+            return False
+        
+        projection = PCAProjection.load()
+        if projection.output_dim != self.features.shape[1]:
+            print("PCA projection does not match the index, ignoring it")
+            return False
+        
+        self.projection = projection
+        print(f"Loaded PCA projection ({projection.input_dim} -> {projection.output_dim} dimensions)")
+        return True
+    
+    def fit_projection(self, batches, count):
+        """
+        Fit and save a PCA projection from streamed extractor features
+        
+        Call before save_index_batches() so the index is stored reduced.
+        
+        Args:
+            batches: Iterable of (features, image_paths) tuples
+            count: Total number of rows in batches
+        """
+        projection = PCAProjection()
+        projection.fit(sample_batches(batches, count))
+        projection.save()
+        self.projection = projection
+    
+    def clear_projection(self):
+        """Store and search full-width features from the next save on"""
+        self.projection = None
+        if os.path.exists(config.PROJECTION_FILE):
+            os.remove(config.PROJECTION_FILE)
+    
+    def project(self, features):
+        """
+        Map extractor features into the space of the stored features
+        
+        Vectors that already have the stored width (e.g. rows of the index
+        itself) are returned unchanged.
+        """
+        features = np.asarray(features)
+        if self.projection is None or features.shape[-1] != self.projection.input_dim:
+            return features
+        return self.projection.transform(features)
+    
+    def query_dims(self):
+        """Widths accepted as query vectors: stored features, or raw extractor output"""
+        dims = {self.features.shape[1]}
+        if self.projection is not None:
+            dims.add(self.projection.input_dim)
+        return dims
+    
+    def open_shards(self):
+        """
+        Start the shard workers if sharded search is configured
+        
+        Shards are rewritten from the feature store first if they are
+        missing or were written for a different index.
+        """
+        self.close_shards()
+        if config.INDEX_SHARDS <= 1:
+            return False
+        
+        manifest = load_manifest()
+        if (manifest is None or manifest.get('source') != self._store_id()
+                or manifest.get('n_shards') != config.INDEX_SHARDS):
+            print("Index shards are out of date, rewriting them")
+            write_shards(self.features, self.image_paths, self._store_id())
+            manifest = load_manifest()
+        
+        self.shards = ShardCoordinator(manifest, deleted=self.deleted)
+        print(f"Started {len(self.shards.shards)} index shard workers")
+        return True
+    
+    def _store_id(self):
+        """Size and mtime of the index file, identifying the index shards were cut from"""
+        path = config.FEATURE_STORE_FILE if os.path.exists(config.FEATURE_STORE_FILE) else config.FEATURES_FILE
+        stat = os.stat(path)
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+    
+    def close_shards(self):
+        """Stop the shard workers, e.g. before their files are rewritten"""
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+    
+    def load_ann_index(self):
+        """Load the approximate index if one matching the loaded features exists"""
+        self.ann_index = None
+        if not os.path.exists(config.ANN_INDEX_FILE):
+            return False
+        
+        try:
+            ann_index = load_ann_index()
+        except Exception as e:
+            print(f"Error loading ANN index: {str(e)}")
+            return False
+        
+        if ann_index.ntotal != len(self.image_paths):
+            print("ANN index is out of date, falling back to exact search")
+            return False
+        
+        self.ann_index = ann_index
+        print(f"Loaded ANN index with {ann_index.nlist} lists")
+        return True
+    
+    def build_ann_index(self):
+        """
+        Build and save the approximate index for the loaded features
+        
+        Returns:
+            True if an ANN index was built, False if exact search will be used
+        """
+        if not self.is_indexed:
+            raise ValueError("Index not loaded. Call load_index() first.")
+        
+        self.ann_index = build_ann_index(self.features)
+        if self.ann_index is None:
+            print("Index is small, using exact search")
+            return False
+        
+        self.ann_index.save()
+        self._index_changed()
+        print(f"Saved ANN index with {self.ann_index.nlist} lists")
+        return True
+    
+    def add_to_ann_index(self, new_features, start_id):
+        """Assign newly appended features to the existing ANN index lists"""
+        if self.ann_index is None:
+            return self.build_ann_index()
+        
+        self.ann_index.add(new_features, start_id)
+        self.ann_index.save()
+        self._index_changed()
+        return True
+    
+    def load_quantized_index(self):
+        """Load the compressed feature codes if ones matching the loaded features exist"""
+        self.quantizer = None
+        self.codes = None
+        self.quantization_stats = None
+        if not os.path.exists(config.QUANTIZER_FILE) or not os.path.exists(config.QUANTIZED_CODES_FILE):
+            return False
+        
+        try:
+            quantizer, codes, stats = load_quantizer()
+        except Exception as e:
+            print(f"Error loading quantized index: {str(e)}")
+            return False
+        
+        if len(codes) != len(self.image_paths):
+            print("Quantized index is out of date, searching full vectors")
+            return False
+        
+        self.quantizer = quantizer
+        self.codes = codes
+        self.quantization_stats = stats
+        print(f"Loaded {quantizer.kind} quantized index ({quantizer.bytes_per_vector()} bytes per image)")
+        return True
+    
+    def build_quantized_index(self, kind=None):
+        """
+        Train a quantizer on the loaded features, encode them and save the codes
+        
+        Recall@K of the compressed search, with and without re-ranking,
+        is measured against exact search and saved with the codes.
+        
+        Args:
+            kind: 'int8' or 'pq' (default from config)
+            
+        Returns:
+            Dict of compression and recall statistics
+        """
+        if not self.is_indexed:
+            raise ValueError("Index not loaded. Call load_index() first.")
+        
+        quantizer, codes = build_quantizer(self.features, kind)
+        top_k = config.TOP_K
+        stats = {
+            'kind': quantizer.kind,
+            'bytes_per_vector': quantizer.bytes_per_vector(),
+            'compression': self.features.shape[1] * 4 / quantizer.bytes_per_vector(),
+        }
+        if len(codes) > top_k:
+            for label, factor in (('recall', 0), ('recall_reranked', config.RERANK_FACTOR)):
+                search = QuantizedSearch(quantizer, codes, self.features, self.deleted, rerank_factor=factor)
+                stats[label] = measure_recall(search.search, self.features, self.deleted, top_k)
+        
+        self._set_quantized_index(quantizer, codes, stats)
+        if 'recall' in stats:
+            print(f"Recall@{top_k}: {stats['recall']:.3f} on codes, "
+                  f"{stats['recall_reranked']:.3f} re-ranked (factor {config.RERANK_FACTOR})")
+        return stats
+    
+    def _set_quantized_index(self, quantizer, codes, stats):
+        """Save codes for the current features and start searching them"""
+        codes = np.asarray(codes)
+        save_quantizer(quantizer, codes, stats)
+        self.quantizer = quantizer
+        self.codes = codes
+        self.quantization_stats = stats
+        self._index_changed()
+        
+        print(f"Saved {quantizer.kind} quantized index: {stats['bytes_per_vector']} bytes per image "
+              f"({stats['compression']:.0f}x smaller)")
+    
+    def _drop_quantized_index(self):
+        """Forget codes that no longer match the stored features"""
+        self.quantizer = None
+        self.codes = None
+        self.quantization_stats = None
+        self._index_changed()
+        for path in (config.QUANTIZER_FILE, config.QUANTIZED_CODES_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def _quantized_search(self, excluded=None):
+        """Searcher over the compressed codes, or None if no quantized index is loaded"""
+        if self.quantizer is None:
+            return None
+        return QuantizedSearch(self.quantizer, self.codes, self.features,
+                               self.deleted if excluded is None else excluded)
+    
+    def load_knn_graph(self):
+        """Load the precomputed neighbour graph if one matching the loaded features exists"""
+        self.knn_graph = None
+        if not os.path.exists(config.KNN_GRAPH_FILE):
+            return False
+        
+        knn_graph = KNNGraph.load()
+        if len(knn_graph) != len(self.image_paths):
+            print("k-NN graph is out of date, ignoring it")
+            return False
+        
+        self.knn_graph = knn_graph
+        print(f"Loaded k-NN graph with {knn_graph.k} neighbours per image")
+        return True
+    
+    def build_knn_graph(self, k=None):
+        """
+        Precompute and save the k nearest neighbours of every indexed image
+        
+        Costs one blocked exact scan of the index per SEARCH_QUERY_BLOCK_SIZE
+        images, so it is meant to run offline after indexing.
+        """
+        if not self.is_indexed:
+            raise ValueError("Index not loaded. Call load_index() first.")
+        
+        self.knn_graph = KNNGraph.build(self.features, k, self.deleted)
+        self.knn_graph.save()
+        self._index_changed()
+        print(f"Saved k-NN graph with {self.knn_graph.k} neighbours per image")
+        return True
+    
+    def _detach_knn_graph(self):
+        """Take the graph into memory so its mapped file can be replaced"""
+        if self.knn_graph is None:
+            return None
+        knn_graph = KNNGraph(np.array(self.knn_graph.records))
+        self.knn_graph = None
+        return knn_graph
+    
+    def load_metadata(self):
+        """Load the per-image metadata index if one matching the loaded features exists"""
+        self.metadata = None
+        if not os.path.exists(config.METADATA_FILE):
+            return False
+        
+        try:
+            metadata = MetadataIndex.load()
+        except Exception as e:
+            print(f"Error loading metadata index: {str(e)}")
+            return False
+        
+        if len(metadata) != len(self.image_paths):
+            print("Metadata index is out of date, filtered search is unavailable")
+            return False
+        
+        self.metadata = metadata
+        return True
+    
+    def build_metadata(self, stats=None):
+        """
+        Read and save the metadata (folder, extension, mtime, size, dimensions) of every indexed image
+        
+        Args:
+            stats: Optional dict of path -> (size, mtime_ns) from scan_image_files(),
+                so files need not be stat'ed again
+        """
+        if not self.is_indexed:
+            raise ValueError("Index not loaded. Call load_index() first.")
+        
+        self.metadata = MetadataIndex.build(self.image_paths, stats)
+        self.metadata.save()
+        self._index_changed()
+        print(f"Saved metadata index for {len(self.metadata)} images")
+        return True
+    
+    def filter_rows(self, filters):
+        """
+        Row ids of the searchable images matching filters (see metadata.parse_filters)
+        
+        Raises:
+            ValueError: If no metadata index is loaded
+        """
+        if self.metadata is None:
+            raise ValueError("Filtering needs the metadata index. Build it with: python src/metadata.py")
+        return self.metadata.select(filters, self.deleted)
+    
+    def _search_rows(self, query_features, rows, top_k, nprobe=None, exact=False):
+        """
+        Search only the given rows, e.g. the images matching a filter
+        
+        Narrow subsets are scanned directly: just their codes, or their full
+        vectors, are gathered, so the cost follows the subset size. Broad
+        subsets run the usual index with the other rows masked out, falling
+        back to a direct scan if the probed ANN lists held too few matches.
+        """
+        if not len(rows):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        
+        quantized = None if exact else self._quantized_search()
+        if self.shards is not None or len(rows) <= config.FILTER_SCAN_FRACTION * len(self.image_paths):
+            if quantized is not None:
+                return quantized.search_rows(query_features, rows, top_k)
+            return ExactSearch(self.features, rows=rows).search(query_features, top_k)
+        
+        excluded = np.ones(len(self.image_paths), dtype=bool)
+        excluded[rows] = False
+        if exact or (self.ann_index is None and quantized is None):
+            ids, scores = ExactSearch(self.features, deleted=excluded).search(query_features, top_k)
+            live = np.isfinite(scores)
+            return ids[live], scores[live]
+        
+        quantized = self._quantized_search(excluded)
+        if self.ann_index is None:
+            return quantized.search(query_features, top_k)
+        ids, scores = self.ann_index.search(query_features, self.features, top_k, nprobe, excluded, quantized)
+        if len(ids) < min(top_k, len(rows)):
+            return ExactSearch(self.features, rows=rows).search(query_features, top_k)
+        return ids, scores
+    
     def compute_similarity(self, query_features):
         """
         Compute cosine similarity between query and all indexed images
@@ -67,51 +749,226 @@ class SimilaritySearch:
         if not self.is_indexed:
             raise ValueError("Index not loaded. Call load_index() first.")
         
-        # Reshape for sklearn
-        query_features = query_features.reshape(1, -1)
+        return ExactSearch(self.features, deleted=self.deleted).similarities(query_features)
+    
+    def search(self, query_features, top_k=None, nprobe=None, exact=False, filters=None, rows=None):
+        """
+        Find the row ids and scores of the top K most similar images
+        
+        Args:
+            query_features: Feature vector of query image
+            top_k: Number of similar images to return (default from config)
+            nprobe: ANN lists to scan, trades latency for recall (default from config)
+            exact: Force a brute-force scan of the full vectors, ignoring the
+                ANN and quantized indexes
+            filters: Only return images matching these metadata filters
+                (see metadata.parse_filters)
+            rows: Only return these row ids, e.g. filter_rows() computed once
+                for many queries (takes the place of filters)
+            
+        Returns:
+            Tuple of (row ids, similarity scores), best match first
+        """
+        if not self.is_indexed:
+            raise ValueError("Index not loaded. Call load_index() first.")
+        if top_k is None:
+            top_k = config.TOP_K
+        query_features = self.project(query_features)
+        
+        if rows is None and filters:
+            rows = self.filter_rows(filters)
+        if rows is not None:
+            return self._search_rows(query_features, rows, top_k, nprobe, exact)
+        
+        # Shards scan their rows exactly, in parallel, in place of the in-process indexes
+        if self.shards is not None:
+            return self.shards.search(query_features, top_k)
         
-        # Compute cosine similarity
-        similarities = cosine_similarity(query_features, self.features)[0]
+        if not exact:
+            quantized = self._quantized_search()
+            if self.ann_index is not None:
+                return self.ann_index.search(query_features, self.features, top_k, nprobe, self.deleted, quantized)
+            if quantized is not None:
+                return quantized.search(query_features, top_k)
         
-        return similarities
+        ids, scores = ExactSearch(self.features, deleted=self.deleted).search(query_features, top_k)
+        
+        # Deleted rows only surface when top_k exceeds the live images
+        live = np.isfinite(scores)
+        return ids[live], scores[live]
+    
+    def index_kind(self, exact=False, filters=None):
+        """Which index answers a search: 'filtered', 'sharded', 'ivf', 'quantized' or 'exact'"""
+        if filters:
+            return 'filtered'
+        if self.shards is not None:
+            return 'sharded'
+        if exact:
+            return 'exact'
+        if self.ann_index is not None:
+            return 'ivf'
+        return 'quantized' if self.quantizer is not None else 'exact'
+    
+    def build_results(self, ids, scores):
+        """Turn row ids and scores into the result dicts returned by the API"""
+        return [
+            {'id': idx, 'path': self.image_paths[idx], 'similarity': score}
+            for idx, score in zip(np.asarray(ids).tolist(), np.asarray(scores).tolist())
+        ]
+    
+    def _result_key(self, kind, query, top_k, nprobe, exact=False, filters=None):
+        """Result cache key: kind is 'vector' (query is a fingerprint) or 'id' (a row id)"""
+        return (kind, query, top_k, nprobe, exact, tuple(sorted(filters.items())) if filters else None)
+    
+    def _cache_results(self, key, results, version):
+        """Store copies of built results under the index version they were computed against"""
+        self.result_cache.put(key, tuple(dict(result) for result in results), version)
+    
+    def _cached_results(self, key, version):
+        """
+        Results cached for key, or None
+        
+        Callers get their own copies of the result dicts, so they may
+        modify them; the stored paths need not be read from the index again.
+        """
+        with stage_timer('result_cache'):
+            cached = self.result_cache.get(key, version)
+        if cached is None:
+            return None
+        SEARCH_QUERIES.labels('result_cache').inc()
+        return [dict(result) for result in cached]
     
-    def find_similar_images(self, query_features, top_k=None):
+    def find_similar_images(self, query_features, top_k=None, nprobe=None, exact=False, filters=None):
         """
         Find top K most similar images to the query
         
+        Repeated queries (the same vector, up to 8-bit rounding, with the same
+        options) are answered from the result cache until the index changes.
+        
         Args:
             query_features: Feature vector of query image
             top_k: Number of similar images to return (default from config)
+            nprobe: ANN lists to scan, trades latency for recall (default from config)
+            exact: Force a brute-force scan even if an ANN index is loaded
+            filters: Only return images matching these metadata filters
             
         Returns:
-            List of tuples: (image_path, similarity_score)
+            List of dicts with 'path' and 'similarity', best match first
         """
         if top_k is None:
             top_k = config.TOP_K
+        key = None
+        if self.result_cache is not None:
+            version = self.version
+            key = self._result_key('vector', query_fingerprint(query_features), top_k, nprobe, exact, filters)
+            cached = self._cached_results(key, version)
+            if cached is not None:
+                return cached
+        
+        with stage_timer('search'):
+            ids, scores = self.search(query_features, top_k, nprobe, exact, filters)
+        SEARCH_QUERIES.labels(self.index_kind(exact, filters)).inc()
+        with stage_timer('results'):
+            results = self.build_results(ids, scores)
+        if key is not None:
+            self._cache_results(key, results, version)
+        return results
+    
+    def search_batch(self, queries, top_k=None, nprobe=None, exact=False, filters=None):
+        """
+        Find the row ids and scores of the top K matches for many queries
+        
+        Args:
+            queries: Array of query feature vectors (N x D)
+            top_k: Number of similar images to return per query (default from config)
+            nprobe: ANN lists to scan, trades latency for recall (default from config)
+            exact: Force a brute-force scan even if an ANN index is loaded
+            filters: Only return images matching these metadata filters
+            
+        Returns:
+            List of (row ids, similarity scores) tuples, one per query
+        """
+        if not self.is_indexed:
+            raise ValueError("Index not loaded. Call load_index() first.")
+        if top_k is None:
+            top_k = config.TOP_K
+        queries = self.project(queries)
+        
+        if filters:
+            # The filter is resolved once for the whole batch
+            rows = self.filter_rows(filters)
+            narrow = len(rows) <= config.FILTER_SCAN_FRACTION * len(self.image_paths)
+            if len(rows) and (exact or narrow and self.quantizer is None):
+                ids, scores = ExactSearch(self.features, rows=rows).search_batch(queries, top_k)
+                return list(zip(ids, scores))
+            return [self.search(query, top_k, nprobe, exact, rows=rows) for query in queries]
         
-        # Compute similarities
-        similarities = self.compute_similarity(query_features)
+        if self.shards is not None:
+            return self.shards.search_batch(queries, top_k)
         
-        # Get top K indices
-        top_indices = np.argsort(similarities)[::-1][:top_k]
+        # Each query probes different inverted lists (or builds its own lookup
+        # table over the codes), so these searches stay per query
+        if not exact and (self.ann_index is not None or self.quantizer is not None):
+            return [self.search(query, top_k, nprobe) for query in queries]
         
-        # Build results
-        results = []
-        for idx in top_indices:
-            results.append({
-                'path': self.image_paths[idx],
-                'similarity': float(similarities[idx])
-            })
+        ids, scores = ExactSearch(self.features, deleted=self.deleted).search_batch(queries, top_k)
+        return [(row_ids[np.isfinite(row_scores)], row_scores[np.isfinite(row_scores)])
+                for row_ids, row_scores in zip(ids, scores)]
+    
+    def find_similar_images_batch(self, queries, top_k=None, nprobe=None, exact=False, filters=None):
+        """
+        Find top K most similar images for each of many queries
         
+        Queries found in the result cache are answered from it; the rest
+        are searched together.
+        
+        Args:
+            queries: Array of query feature vectors (N x D)
+            top_k: Number of similar images to return per query (default from config)
+            nprobe: ANN lists to scan, trades latency for recall (default from config)
+            exact: Force a brute-force scan even if an ANN index is loaded
+            filters: Only return images matching these metadata filters
+            
+        Returns:
+            List with one result list per query, in query order
+        """
+        if top_k is None:
+            top_k = config.TOP_K
+        if self.result_cache is None:
+            with stage_timer('search'):
+                batch = self.search_batch(queries, top_k, nprobe, exact, filters)
+            SEARCH_QUERIES.labels(self.index_kind(exact, filters)).inc(len(batch))
+            with stage_timer('results'):
+                return [self.build_results(ids, scores) for ids, scores in batch]
+        
+        queries = np.asarray(queries)
+        version = self.version
+        keys = [self._result_key('vector', query_fingerprint(query), top_k, nprobe, exact, filters)
+                for query in queries]
+        results = [self._cached_results(key, version) for key in keys]
+        misses = [i for i, cached in enumerate(results) if cached is None]
+        if misses:
+            with stage_timer('search'):
+                batch = self.search_batch(queries[misses], top_k, nprobe, exact, filters)
+            SEARCH_QUERIES.labels(self.index_kind(exact, filters)).inc(len(misses))
+            with stage_timer('results'):
+                for i, (ids, scores) in zip(misses, batch):
+                    results[i] = self.build_results(ids, scores)
+                    self._cache_results(keys[i], results[i], version)
         return results
     
-    def find_similar_by_index(self, query_index, top_k=None):
+    def find_similar_by_index(self, query_index, top_k=None, nprobe=None, filters=None):
         """
         Find similar images given the index of an image in the database
         
+        The stored vector is used as the query, so neither the image file
+        nor the model is touched.
+        
         Args:
             query_index: Index of the query image
             top_k: Number of similar images to return
+            nprobe: ANN lists to scan, trades latency for recall (default from config)
+            filters: Only return images matching these metadata filters
             
         Returns:
             List of similar images (excluding the query itself)
@@ -119,13 +976,34 @@ class SimilaritySearch:
         if top_k is None:
             top_k = config.TOP_K
         
-        query_features = self.features[query_index]
-        results = self.find_similar_images(query_features, top_k + 1)
+        # Precomputed neighbours answer in O(1), unless too many were deleted since.
+        # The graph holds neighbours from the whole index, so filtered queries scan.
+        if self.knn_graph is not None and top_k <= self.knn_graph.k and not filters:
+            with stage_timer('search'):
+                ids, scores = self.knn_graph.neighbors(query_index, top_k, self.deleted)
+            if len(ids) >= min(top_k, self.num_images - 1):
+                SEARCH_QUERIES.labels('knn_graph').inc()
+                return self.build_results(ids, scores)
         
-        # Remove the query image itself
-        results = [r for r in results if r['path'] != self.image_paths[query_index]]
+        key = None
+        if self.result_cache is not None:
+            version = self.version
+            key = self._result_key('id', int(query_index), top_k, nprobe, filters=filters)
+            cached = self._cached_results(key, version)
+            if cached is not None:
+                return cached
         
-        return results[:top_k]
+        with stage_timer('search'):
+            query_features = np.asarray(self.features[query_index])
+            ids, scores = self.search(query_features, top_k + 1, nprobe, filters=filters)
+        SEARCH_QUERIES.labels(self.index_kind(filters=filters)).inc()
+        
+        # Remove the query image itself
+        keep = ids != query_index
+        results = self.build_results(ids[keep][:top_k], scores[keep][:top_k])
+        if key is not None:
+            self._cache_results(key, results, version)
+        return results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,288 @@
+"""
+Thumbnails of the indexed images, written while indexing and served in
+place of the full-size originals.
+
+Thumbnails are stored by the content hash of the original and their size:
+
+    THUMBNAIL_DIR/ab/ab12...ef-320.webp
+
+This is the same hash the embedding cache keys on. Copies of a file share
+their thumbnails, an edited file gets new ones, and the hash is a strong
+ETag. Each configured size bounds the longer side of the image.
+
+    python src/thumbnails.py            write missing thumbnails of every indexed image
+    python src/thumbnails.py --prune    also delete thumbnails of images no longer indexed
+"""
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import ExifTags, Image, ImageOps, features
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from fingerprints import content_hash
+from metrics import Counter
+
+
+THUMBNAILS_WRITTEN = Counter('thumbnails_written_total', 'Thumbnails written, by when', ['when'])
+THUMBNAIL_REQUESTS = Counter('thumbnail_requests_total', 'Thumbnail lookups, by how they were answered', ['result'])
+
+# PIL format name, file extension and MIME type per THUMBNAIL_FORMAT
+FORMATS = {
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+}
+
+# Content hashes remembered per path, checked against the file's size and mtime
+DIGEST_CACHE_SIZE = 100000
+
+
+class ThumbnailCache:
+    """Content-addressed store of downscaled copies of the indexed images"""
+
+    def __init__(self, directory=None, sizes=None, image_format=None, quality=None, workers=None):
+        """
+        Args:
+            directory: Root of the store (default from config)
+            sizes: Longest side of each thumbnail size in pixels (default from config)
+            image_format: 'webp' or 'jpeg'; WebP falls back to JPEG if Pillow
+                was built without it (default from config)
+            quality: Encoder quality, 1-100 (default from config)
+            workers: Thumbnails generated on demand at once (default from config)
+        """
+        self.directory = directory if directory is not None else config.THUMBNAIL_DIR
+        self.sizes = tuple(sizes if sizes is not None else config.THUMBNAIL_SIZES)
+        image_format = (image_format or config.THUMBNAIL_FORMAT).lower()
+        if image_format not in FORMATS:
+            raise ValueError(f"Unknown thumbnail format: {image_format}")
+        if image_format == 'webp' and not features.check('webp'):
+            print("Pillow has no WebP support, writing JPEG thumbnails")
+            image_format = 'jpeg'
+        self.format = image_format
+        self.pil_format, self.extension, self.mimetype = FORMATS[image_format]
+        self.quality = quality if quality is not None else config.THUMBNAIL_QUALITY
+
+        self._slots = threading.BoundedSemaphore(workers if workers is not None else config.THUMBNAIL_WORKERS)
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, digest, size):
+        """Where the thumbnail of the content with this hash is stored"""
+        return os.path.join(self.directory, digest[:2], f"{digest}-{size}.{self.extension}")
+
+    def missing_sizes(self, digest):
+        return [size for size in self.sizes if not os.path.exists(self.path(digest, size))]
+
+    def digest_for(self, img_path):
+        """
+        Content hash of an image file
+
+        Hashes are remembered with the file's size and mtime, so a file is
+        only read again after it changed.
+
+        Raises:
+            OSError: If the file cannot be read
+        """
+        stat = os.stat(img_path)
+        with self._lock:
+            entry = self._digests.get(img_path)
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                self._digests.move_to_end(img_path)
+                return entry[2]
+
+        digest = content_hash(img_path)
+        with self._lock:
+            self._digests[img_path] = (stat.st_size, stat.st_mtime_ns, digest)
+            while len(self._digests) > DIGEST_CACHE_SIZE:
+                self._digests.popitem(last=False)
+        return digest
+
+    def add(self, image, digest, sizes=None, when='index'):
+        """
+        Write thumbnails of a decoded image
+
+        Args:
+            image: PIL image of the original, left unchanged
+            digest: Content hash of the original file
+            sizes: Sizes to write (default: the configured sizes not stored yet)
+            when: Label for the thumbnails_written_total metric
+
+        Returns:
+            Number of thumbnails written
+        """
+        if sizes is None:
+            sizes = self.missing_sizes(digest)
+        if not sizes:
+            return 0
+
+        # Browsers apply the EXIF orientation of originals; thumbnails carry no EXIF
+        if image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+            image = ImageOps.exif_transpose(image)
+        image = self._convert(image)
+
+        # Each size is scaled down from the next larger one, not from the original
+        for size in sorted(sizes, reverse=True):
+            scale = size / max(image.size)
+            if scale < 1:
+                width, height = image.size
+                image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))),
+                                     Image.LANCZOS, reducing_gap=3.0)
+            self._write(image, self.path(digest, size))
+        THUMBNAILS_WRITTEN.labels(when).inc(len(sizes))
+        return len(sizes)
+
+    def add_decoded(self, img_path, image, digest=None):
+        """
+        Write the missing thumbnails of an image file that was already decoded
+
+        Errors are printed rather than raised, so they never fail the decode.
+
+        Args:
+            img_path: Path of the original
+            image: PIL image decoded from it
+            digest: Content hash of the file, if already known (default: hash it)
+
+        Returns:
+            Number of thumbnails written
+        """
+        try:
+            if digest is None:
+                digest = self.digest_for(img_path)
+            return self.add(image, digest)
+        except Exception as e:
+            print(f"Error writing thumbnails of {img_path}: {str(e)}")
+            return 0
+
+    def add_file(self, img_path, digest=None, when='index'):
+        """
+        Write the missing thumbnails of an image file
+
+        JPEGs are decoded at a reduced scale close to the largest size
+        needed, which is several times faster than a full decode.
+
+        Returns:
+            Number of thumbnails written (0 if the file cannot be read)
+        """
+        try:
+            if digest is None:
+                digest = self.digest_for(img_path)
+            sizes = self.missing_sizes(digest)
+            if not sizes:
+                return 0
+            with Image.open(img_path) as image:
+                image.draft('RGB', (max(sizes), max(sizes)))
+                image.load()
+                return self.add(image, digest, sizes, when)
+        except Exception as e:
+            print(f"Error writing thumbnails of {img_path}: {str(e)}")
+            return 0
+
+    def lookup(self, img_path, size, wait_ms=None):
+        """
+        Find the thumbnail of an image file, generating it if it is missing
+
+        At most `workers` thumbnails are generated at once. A request that
+        cannot start generating within wait_ms gets no thumbnail, so a burst
+        of requests for new images cannot pile up decoding work.
+
+        Args:
+            img_path: Path of the original
+            size: One of the configured sizes
+            wait_ms: Longest wait for a free generation slot (default from config)
+
+        Returns:
+            Tuple of (thumbnail path or None, content hash of the original)
+        """
+        digest = self.digest_for(img_path)
+        path = self.path(digest, size)
+        if os.path.exists(path):
+            THUMBNAIL_REQUESTS.labels('stored').inc()
+            return path, digest
+
+        if wait_ms is None:
+            wait_ms = config.THUMBNAIL_WAIT_MS
+        if not self._slots.acquire(timeout=wait_ms / 1000):
+            THUMBNAIL_REQUESTS.labels('busy').inc()
+            return None, digest
+        try:
+            # Another request may have written it while this one waited
+            if not os.path.exists(path):
+                self.add_file(img_path, digest, when='on_demand')
+        finally:
+            self._slots.release()
+
+        if not os.path.exists(path):
+            THUMBNAIL_REQUESTS.labels('failed').inc()
+            return None, digest
+        THUMBNAIL_REQUESTS.labels('generated').inc()
+        return path, digest
+
+    def prune(self, digests):
+        """
+        Delete thumbnails whose original is not among digests
+
+        Returns:
+            Number of files deleted
+        """
+        removed = 0
+        if not os.path.isdir(self.directory):
+            return removed
+        for prefix in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, prefix)
+            for name in os.listdir(subdir):
+                if name.rsplit('-', 1)[0] not in digests:
+                    os.remove(os.path.join(subdir, name))
+                    removed += 1
+        return removed
+
+    def _convert(self, image):
+        """Convert to a mode the encoder writes, keeping transparency for WebP"""
+        has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+        if self.format == 'webp' and has_alpha:
+            return image if image.mode == 'RGBA' else image.convert('RGBA')
+        return image if image.mode == 'RGB' else image.convert('RGB')
+
+    def _write(self, image, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique across processes: server workers and indexing jobs may write the same thumbnail
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, self.pil_format, quality=self.quality)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def main():
+    """Write the missing thumbnails of every image in the loaded index"""
+    from similarity_search import SimilaritySearch
+
+    searcher = SimilaritySearch()
+    if not searcher.load_index():
+        return
+
+    cache = ThumbnailCache()
+    paths = [path for row, path in enumerate(searcher.image_paths) if searcher.is_live(row)]
+    print(f"Writing {cache.format} thumbnails ({', '.join(map(str, cache.sizes))} px) for {len(paths)} images...")
+    num_workers = config.DECODE_WORKERS or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        written = sum(pool.map(cache.add_file, paths))
+    print(f"Wrote {written} thumbnails to {cache.directory}")
+
+    if '--prune' in sys.argv[1:]:
+        digests = set()
+        for path in paths:
+            try:
+                digests.add(cache.digest_for(path))
+            except OSError:
+                pass
+        print(f"Removed {cache.prune(digests)} thumbnails of images no longer indexed")
+
+
+if __name__ == "__main__":
+    main()
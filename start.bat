@@ -36,7 +36,7 @@ if not exist "frontend\build\index.html" (
 )
 
 REM Check if index exists
-if not exist "models\image_features.pkl" (
+if not exist "models\features.idx" if not exist "models\image_features.pkl" (
     echo.
     echo WARNING: Image index not found!
     echo You need to build the index first by running:
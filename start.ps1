@@ -35,7 +35,7 @@ if (-not (Test-Path "frontend\build\index.html")) {
 }
 
 # Check if index exists
-if (-not (Test-Path "models\image_features.pkl")) {
+if (-not (Test-Path "models\features.idx") -and -not (Test-Path "models\image_features.pkl")) {
     Write-Host ""
     Write-Host "WARNING: Image index not found!" -ForegroundColor Red
     Write-Host "You need to build the index first by running:" -ForegroundColor Yellow
@@ -0,0 +1,63 @@
+"""
+Appending to an index whose features are PCA-reduced, with an IVF index
+and quantized codes built over the reduced vectors.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import config
+from similarity_search import SimilaritySearch
+
+
+@pytest.fixture
+def models_dir(tmp_path, monkeypatch):
+    """Point every path setting under config.MODELS_DIR at a temporary directory"""
+    for name in dir(config):
+        value = getattr(config, name)
+        if name.isupper() and isinstance(value, str) and value.startswith(config.MODELS_DIR + os.sep):
+            monkeypatch.setattr(config, name, str(tmp_path) + value[len(config.MODELS_DIR):])
+    monkeypatch.setattr(config, 'MODELS_DIR', str(tmp_path))
+    monkeypatch.setattr(config, 'DATA_DIR', str(tmp_path / 'data'))
+    return tmp_path
+
+
+def _features(n, dim, seed):
+    features = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize('quantization', ['int8', 'pq'])
+def test_append_with_pca_ann_and_quantization(models_dir, monkeypatch, quantization):
+    monkeypatch.setattr(config, 'PCA_DIM', 32)
+    monkeypatch.setattr(config, 'ANN_MIN_IMAGES', 0)
+    monkeypatch.setattr(config, 'IVF_NLIST', 8)
+    monkeypatch.setattr(config, 'QUANTIZATION', quantization)
+    monkeypatch.setattr(config, 'PQ_SUBQUANTIZERS', 8)
+    monkeypatch.setattr(config, 'KNN_GRAPH', False)
+
+    features = _features(400, 128, seed=0)
+    paths = [os.path.join(config.DATA_DIR, f"img_{i}.jpg") for i in range(len(features))]
+    searcher = SimilaritySearch()
+    searcher.fit_projection([(features, paths)], len(features))
+    assert searcher.save_index_batches([(features, paths)], 128, model='test')
+    assert searcher.build_ann_index()
+    assert searcher.build_quantized_index()
+
+    new_features = _features(20, 128, seed=1)
+    new_paths = [os.path.join(config.DATA_DIR, f"new_{i}.jpg") for i in range(len(new_features))]
+    assert searcher.append_to_index(new_features, new_paths)
+
+    # Store, ANN lists and codes agree after the append, also once reloaded
+    reloaded = SimilaritySearch()
+    assert reloaded.load_index(model='test')
+    for index in (searcher, reloaded):
+        assert index.features.shape == (420, 32)
+        assert len(index.codes) == 420
+        assert index.ann_index.ntotal == 420
+        results = index.find_similar_images(new_features[3], top_k=1, exact=True)
+        assert results[0]['path'] == new_paths[3]
@@ -0,0 +1,24 @@
+"""
+Keeping the k-NN graph equal to a full rebuild across compactions.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from knn_graph import KNNGraph
+
+
+def test_compact_refills_lists_that_lost_neighbours():
+    features = np.random.default_rng(0).standard_normal((500, 16)).astype(np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    keep = np.random.default_rng(1).random(len(features)) > 0.1
+
+    graph = KNNGraph.build(features, k=10)
+    graph.compact(keep, features[keep])
+    rebuilt = KNNGraph.build(features[keep], k=10)
+
+    assert (graph.records['ids'] >= 0).all()
+    np.testing.assert_array_equal(graph.records['ids'], rebuilt.records['ids'])
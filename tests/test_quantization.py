@@ -0,0 +1,23 @@
+"""
+Product quantization of indexes too small for 256 centroids per subspace.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from quantization import ProductQuantizer
+
+
+def test_pq_with_fewer_training_vectors_than_centroids():
+    features = np.random.default_rng(0).standard_normal((100, 64)).astype(np.float32)
+    quantizer = ProductQuantizer(n_subquantizers=16)
+    quantizer.train(features)
+    assert quantizer.codebooks.shape == (16, 100, 4)
+
+    codes = quantizer.encode(features)
+    scores = quantizer.score(codes, quantizer.prepare_query(features[7]))
+    expected = quantizer.decode(codes) @ features[7]
+    np.testing.assert_allclose(scores, expected, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,15 @@
+"""
+WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app     (Linux/macOS, pre-fork workers)
+    waitress-serve --threads=8 wsgi:app       (Windows, single process)
+
+Every worker process loads the model once, on a background thread started
+when it imports this module, so it answers /api/health/live immediately and
+/api/health/ready once the model is warmed up. The feature index is
+memory-mapped read-only, so all workers share a single copy of it through
+the OS page cache.
+"""
+from app import app, initialize_models
+
+initialize_models()